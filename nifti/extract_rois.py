@@ -7,15 +7,38 @@ $ extract_rois.py -i [pet1.nii pet2.nii ...] -a [aparc+aseg1.nii aparc+aseg2.nii
 """
 
 import argparse
+import io
+import json
+import os
 import os.path as op
+import socket
+import socketserver
 import sys
+import threading
 import time
 from collections import OrderedDict as od
+from stat import S_ISSOCK
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
 from inspect import isroutine
 
 import nibabel as nib
 import numpy as np
 import pandas as pd
+from nibabel.volumeutils import apply_read_scaling
+
+# Aggregation functions that roi_desc can compute from per-label summary
+# statistics, mapped to the statistic used to compute them
+LABEL_STAT_AGGFS = {
+    np.mean: "mean",
+    np.std: "std",
+    np.sum: "sum",
+    np.min: "min",
+    np.amin: "min",
+    np.max: "max",
+    np.amax: "max",
+    np.size: "count",
+    len: "count",
+}
 
 
 class Timer(object):
@@ -100,7 +123,308 @@ def load_rois(roi_file):
     return rois
 
 
-def roi_desc(dat, rois, subrois=None, aggf=np.mean, conv_nan=0):
+class LabelIndex(object):
+    """Flat voxel indices of a parcellation, grouped by label.
+
+    Voxels are sorted by label once, so summary statistics for every
+    label can then be computed from a single pass over a data array
+    instead of one full-volume scan per ROI.
+    """
+
+    def __init__(self, labels, voxels, starts, counts, size):
+        """Initialize the index.
+
+        Parameters
+        ----------
+        labels : ndarray
+            Sorted, unique label values.
+        voxels : ndarray
+            Flat voxel indices sorted by label.
+        starts : ndarray
+            Start position of each label's run of voxels in `voxels`.
+        counts : ndarray
+            Number of voxels with each label.
+        size : int
+            Number of voxels in the parcellation array.
+        """
+        self.labels = labels
+        self.voxels = voxels
+        self.starts = starts
+        self.counts = counts
+        self.size = size
+
+    @classmethod
+    def from_array(cls, mask, keep=None, background=None):
+        """Build the index from a parcellation array.
+
+        Parameters
+        ----------
+        mask : array-like
+            Parcellation array with one label value per voxel. Voxel
+            indices refer to the C-order flattened array.
+        keep : list of numbers, optional
+            Only index voxels whose label is in `keep`. All voxels are
+            indexed by default.
+        background : number, optional
+            Label value (e.g. 0) whose voxels are left out of the index.
+
+        Returns
+        -------
+        label_idx : LabelIndex
+        """
+        # Read the mask in memory order so Fortran-ordered NIfTI arrays
+        # aren't copied to flatten them. Voxel indices are converted to
+        # C-order at the end.
+        mask = np.asanyarray(mask)
+        shape = mask.shape
+        f_order = (mask.ndim > 1) and not mask.flags.c_contiguous
+        f_order = f_order and mask.flags.f_contiguous
+        mask = mask.reshape(-1, order="F" if f_order else "C")
+
+        # Parcellations with small, non-negative integer labels are
+        # matched through a lookup table, which is much faster than
+        # np.isin and lets numpy sort the labels with a radix sort.
+        ints = None
+        if mask.size and (mask.min() >= 0) and (mask.max() < 2**16):
+            ints = mask.astype(np.uint16)
+            if not np.array_equal(ints, mask):
+                ints = None
+
+        if keep is not None:
+            keep = np.atleast_1d(keep)
+            if background is not None:
+                keep = keep[keep != background]
+        if (keep is None) and (background is None):
+            voxels = np.arange(mask.size)
+        elif ints is not None:
+            if keep is None:
+                lut = np.ones(2**16, dtype=bool)
+                if background in range(2**16):
+                    lut[int(background)] = False
+            else:
+                keep = keep[(keep >= 0) & (keep < 2**16) & (keep == np.floor(keep))]
+                lut = np.zeros(2**16, dtype=bool)
+                lut[keep.astype(int)] = True
+            voxels = np.flatnonzero(lut[ints])
+        elif keep is None:
+            voxels = np.flatnonzero(mask != background)
+        else:
+            voxels = np.flatnonzero(np.isin(mask, keep))
+        vals = mask[voxels]
+        order = np.argsort(vals if ints is None else ints[voxels], kind="stable")
+        if f_order:
+            voxels = np.ravel_multi_index(
+                np.unravel_index(voxels, shape, order="F"), shape
+            )
+        voxels = voxels[order]
+        # ravel_multi_index returns int64, so cast once voxels are final
+        if mask.size < 2**31:
+            voxels = voxels.astype(np.int32)
+        labels, starts, counts = np.unique(
+            vals[order], return_index=True, return_counts=True
+        )
+        return cls(labels, voxels, starts, counts, mask.size)
+
+    def save(self, outfile, source=None):
+        """Save the index to an uncompressed .npz file.
+
+        Voxels are stored in CSR form, as int32 voxel indices sorted by
+        label plus the offset of each label's run. The file is written
+        atomically so concurrent readers never see a partial file.
+
+        Parameters
+        ----------
+        outfile : str
+            The .npz file to save.
+        source : str, optional
+            The parcellation file the index was built from. Its size and
+            modification time are saved so load() can tell when the
+            index is stale.
+        """
+        meta = {}
+        if source is not None:
+            file_stat = os.stat(source)
+            meta["source_size"] = np.int64(file_stat.st_size)
+            meta["source_mtime_ns"] = np.int64(file_stat.st_mtime_ns)
+        offsets = np.append(self.starts, self.voxels.size)
+        tmpf = f"{outfile}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmpf, "wb") as f:
+                np.savez(
+                    f,
+                    labels=self.labels,
+                    voxels=self.voxels,
+                    offsets=offsets,
+                    size=np.int64(self.size),
+                    **meta,
+                )
+            os.replace(tmpf, outfile)
+        finally:
+            if op.exists(tmpf):
+                os.remove(tmpf)
+
+    @classmethod
+    def load(cls, infile, source=None):
+        """Load an index saved by save().
+
+        Parameters
+        ----------
+        infile : str
+            The .npz file to load.
+        source : str, optional
+            The parcellation file the index should have been built
+            from. If given and its size or modification time differ
+            from when the index was saved, None is returned.
+
+        Returns
+        -------
+        label_idx : LabelIndex or None
+        """
+        with np.load(infile) as f:
+            if source is not None:
+                if ("source_size" not in f) or ("source_mtime_ns" not in f):
+                    return None
+                file_stat = os.stat(source)
+                if (int(f["source_size"]) != file_stat.st_size) or (
+                    int(f["source_mtime_ns"]) != file_stat.st_mtime_ns
+                ):
+                    return None
+            offsets = f["offsets"]
+            return cls(
+                f["labels"],
+                f["voxels"],
+                offsets[:-1],
+                np.diff(offsets),
+                int(f["size"]),
+            )
+
+    def positions(self, vals):
+        """Return positions in self.labels of the label values in `vals`.
+
+        Values that are not in the index are ignored.
+        """
+        vals = np.atleast_1d(vals)
+        if self.labels.size == 0:
+            return np.array([], dtype=int)
+        pos = np.clip(np.searchsorted(self.labels, vals), 0, self.labels.size - 1)
+        return np.unique(pos[self.labels[pos] == vals])
+
+    def label_stats(self, dat, stats=("sum", "sumsq", "count", "min", "max")):
+        """Return summary statistics of `dat` values for each label.
+
+        Parameters
+        ----------
+        dat : array-like
+            Data array with the same number of voxels as the
+            parcellation.
+        stats : list of str
+            Statistics to compute. Options are "sum", "sumsq", "count",
+            "min", and "max".
+
+        Returns
+        -------
+        output : OrderedDict of {str: ndarray}
+            Each statistic for each label in self.labels. Sums are
+            accumulated at float64 precision.
+        """
+        if not isinstance(dat, LazyNii):
+            dat = np.asanyarray(dat).ravel()
+        assert dat.size == self.size
+        vals = dat[self.voxels].astype(np.float64)
+        ufuncs = {
+            "sum": np.add,
+            "sumsq": np.add,
+            "min": np.minimum,
+            "max": np.maximum,
+        }
+        output = od([])
+        for stat in stats:
+            if stat == "count":
+                output[stat] = self.counts
+            elif self.voxels.size == 0:
+                output[stat] = np.array([], dtype=np.float64)
+            elif stat == "sumsq":
+                output[stat] = ufuncs[stat].reduceat(vals**2, self.starts)
+            else:
+                output[stat] = ufuncs[stat].reduceat(vals, self.starts)
+        return output
+
+    def describe(self, dat, rois, stats=("mean",)):
+        """Return summary statistics of `dat` values within each ROI.
+
+        Parameters
+        ----------
+        dat : array-like
+            Data array with the same number of voxels as the
+            parcellation.
+        rois : dict of {str: int or list}
+            Map each ROI name to a label value or list of label values
+            that comprise it.
+        stats : list of str
+            Statistics to compute. Options are "mean", "std", "sum",
+            "count", "min", and "max".
+
+        Returns
+        -------
+        output : DataFrame
+            Index is the ROI names, columns are `stats` followed by
+            "voxels" (number of voxels in the ROI).
+        """
+        if not isinstance(dat, LazyNii):
+            dat = np.asanyarray(dat)
+        if np.issubdtype(dat.dtype, np.floating):
+            out_dtype = dat.dtype.type
+        else:
+            out_dtype = np.float64
+
+        # Compute only the per-label statistics that are needed.
+        need = ["sum", "count"]
+        if "std" in stats:
+            need.append("sumsq")
+        need += [stat for stat in ("min", "max") if stat in stats]
+        label_stats = self.label_stats(dat, stats=need)
+
+        output = pd.DataFrame(index=list(rois.keys()), columns=list(stats) + ["voxels"])
+        for roi, roi_vals in rois.items():
+            pos = self.positions(roi_vals)
+            count = int(label_stats["count"][pos].sum())
+            total = label_stats["sum"][pos].sum()
+            mean = total / count if count else np.nan
+            for stat in stats:
+                if stat == "mean":
+                    val = mean
+                elif stat == "sum":
+                    val = total
+                elif stat == "count":
+                    output.at[roi, stat] = count
+                    continue
+                elif not count:
+                    val = np.nan
+                elif stat == "std":
+                    var = (label_stats["sumsq"][pos].sum() / count) - mean**2
+                    val = np.sqrt(max(var, 0))
+                elif stat == "min":
+                    val = label_stats["min"][pos].min()
+                elif stat == "max":
+                    val = label_stats["max"][pos].max()
+                else:
+                    raise ValueError(f"stat='{stat}' not valid")
+                output.at[roi, stat] = out_dtype(val)
+            output.at[roi, "voxels"] = count
+        return output
+
+
+def _is_label_stat_aggf(func):
+    """Return True if `func` can be computed from per-label statistics."""
+    try:
+        return func in LABEL_STAT_AGGFS
+    except TypeError:
+        return False
+
+
+def roi_desc(
+    dat, rois, subrois=None, aggf=np.mean, conv_nan=0, fast=True, cache_index=True
+):
     """Apply `aggf` over `dat` values within each ROI mask.
 
     Parameters
@@ -121,6 +445,15 @@ def roi_desc(dat, rois, subrois=None, aggf=np.mean, conv_nan=0):
     conv_nan : bool, number, or NoneType object
         Convert NaNs in `dat` to `conv_nan`. No conversion is applied if
         `conv_nan` is np.nan, None, or False.
+    fast : bool
+        If true and `subrois` is defined, standard aggregation functions
+        (see LABEL_STAT_AGGFS) are computed from per-label statistics
+        in a single pass over `dat`. Other `aggf` functions always loop
+        over each sub-ROI mask.
+    cache_index : bool
+        If true, the fast path saves the parcellation's label index
+        next to the parcellation file and reuses it on later calls (see
+        load_label_index).
 
     Returns
     -------
@@ -132,8 +465,9 @@ def roi_desc(dat, rois, subrois=None, aggf=np.mean, conv_nan=0):
     if (not isinstance(rois, str)) and (len(rois) > 1) and (subrois is not None):
         raise ValueError("Cannot define multiple rois and subrois")
 
-    # Load the data array.
-    dat = load_nii(dat, flatten=True, conv_nan=conv_nan)
+    # Memory-map the data array; values are only read and formatted
+    # within each ROI.
+    dat = load_nii(dat, flatten=True, conv_nan=conv_nan, lazy=True)
 
     # Format the ROIs to be dict-like.
     if isinstance(rois, str):
@@ -155,41 +489,254 @@ def roi_desc(dat, rois, subrois=None, aggf=np.mean, conv_nan=0):
         raise ValueError("rois must be str, list, tuple, or dict")
 
     # Format the aggregation functions to be dict-like.
-    if isroutine(aggf):
-        aggf = od({aggf.__name__: aggf})
-    elif not isinstance(aggf, dict):
-        aggf = od({func.__name__: func for func in aggf})
+    aggf = _format_aggf(aggf)
+    use_label_stats = fast and all(_is_label_stat_aggf(f) for f in aggf.values())
 
     # Prepare the output DataFrame.
-    if subrois is not None:
-        output_idx = list(subrois.keys())
-    else:
-        output_idx = list(rois.keys())
-    output_cols = list(aggf.keys()) + ["voxels"]
-    output = pd.DataFrame(index=output_idx, columns=output_cols)
+    output = pd.DataFrame(
+        index=list(rois.keys()), columns=list(aggf.keys()) + ["voxels"]
+    )
     output = output.rename_axis("roi")
 
     # Loop over the ROIs and sub-ROIs.
     for roi, roi_mask in rois.items():
         if subrois is not None:
-            mask = load_nii(roi_mask, flatten=True, binarize=False)
-            assert dat.shape == mask.shape
-            for subroi, subroi_vals in subrois.items():
-                mask_idx = np.where(np.isin(mask, subroi_vals))
-                for func_name, func in aggf.items():
-                    output.at[subroi, func_name] = func(dat[mask_idx])
-                output.at[subroi, "voxels"] = mask_idx[0].size
+            if use_label_stats:
+                label_idx = load_label_index(roi_mask, subrois, cache=cache_index)
+                assert dat.size == label_idx.size
+                mask = None
+            else:
+                mask = load_nii(roi_mask, flatten=True, binarize=False)
+                assert dat.shape == mask.shape
+                label_idx = None
+            output = _subroi_desc(dat, mask, subrois, aggf, label_idx)
         else:
             mask = load_nii(roi_mask, flatten=True, binarize=True)
             assert dat.shape == mask.shape
-            mask_idx = np.where(mask)
+            mask_idx = np.flatnonzero(mask)
             for func_name, func in aggf.items():
                 output.at[roi, func_name] = func(dat[mask_idx])
-            output.at[roi, "voxels"] = mask_idx[0].size
+            output.at[roi, "voxels"] = mask_idx.size
 
     return output
 
 
+def roi_desc_many(
+    images,
+    aparc,
+    rois,
+    aggf=np.mean,
+    conv_nan=0,
+    fast=True,
+    cache_index=True,
+    label_idx=None,
+):
+    """Apply `aggf` over each image's values within each parcellation ROI.
+
+    The parcellation is loaded and indexed by label once, and each image
+    is then streamed through the same index. Output is the same as
+    calling roi_desc(image, aparc, subrois=rois) for each image.
+
+    Parameters
+    ----------
+    images : list
+        Filepath strings, nifti images, or array-like objects.
+    aparc :
+        Filepath string, nifti image, or array-like parcellation that
+        is shared by all images.
+    rois : dict of {str: int or list}
+        Map each ROI to a label value or list of label values in
+        `aparc` that comprise it.
+    aggf : function, list of functions, or dict of functions
+        Function or functions to apply over image values within each
+        ROI.
+    conv_nan : bool, number, or NoneType object
+        Convert NaNs in each image to `conv_nan`. No conversion is
+        applied if `conv_nan` is np.nan, None, or False.
+    fast : bool
+        If true, standard aggregation functions are computed from
+        per-label statistics (see roi_desc).
+    cache_index : bool
+        If true, the fast path saves the parcellation's label index
+        next to the parcellation file and reuses it on later calls (see
+        load_label_index).
+    label_idx : LabelIndex, optional
+        A LabelIndex that was already built from `aparc` for `rois`
+        (e.g. by a LabelIndexCache). If given and the fast path is used,
+        `aparc` is not reloaded.
+
+    Returns
+    -------
+    outputs : list of DataFrame
+        roi_desc output for each image, in the same order as `images`.
+    """
+    aggf = _format_aggf(aggf)
+    use_label_stats = fast and all(_is_label_stat_aggf(f) for f in aggf.values())
+
+    # Load and index the parcellation once, unless it was already indexed.
+    if use_label_stats:
+        if label_idx is None:
+            label_idx = load_label_index(aparc, rois, cache=cache_index)
+        mask = None
+        mask_size = label_idx.size
+    else:
+        label_idx = None
+        mask = load_nii(aparc, flatten=True, binarize=False)
+        mask_size = mask.size
+
+    # Stream each image through the parcellation.
+    outputs = []
+    for img in images:
+        dat = load_nii(img, flatten=True, conv_nan=conv_nan, lazy=True)
+        assert dat.size == mask_size
+        outputs.append(_subroi_desc(dat, mask, rois, aggf, label_idx))
+    return outputs
+
+
+def _format_aggf(aggf):
+    """Format the aggregation functions to be dict-like."""
+    if isroutine(aggf):
+        aggf = od({aggf.__name__: aggf})
+    elif not isinstance(aggf, dict):
+        aggf = od({func.__name__: func for func in aggf})
+    return aggf
+
+
+def _subroi_labels(subrois):
+    """Return the sorted, unique label values used by any sub-ROI."""
+    return np.unique(np.concatenate([np.atleast_1d(v) for _, v in subrois.items()]))
+
+
+def label_index_cachef(aparc):
+    """Return the on-disk LabelIndex cache file for a parcellation."""
+    aparc = find_gzip(aparc, return_infile=True)
+    stem = op.basename(aparc)
+    for ext in (".gz", ".nii"):
+        if stem.endswith(ext):
+            stem = stem[: -len(ext)]
+    return op.join(op.dirname(aparc), f"{stem}_label-index.npz")
+
+
+def load_label_index(aparc, subrois=None, cache=True):
+    """Return a LabelIndex for a parcellation file.
+
+    With `cache`, all non-zero labels are indexed once and saved next to
+    the parcellation (see label_index_cachef), and later calls load the
+    saved index instead of reading the parcellation. The cache is
+    rebuilt when the parcellation's size or modification time changes.
+    A cache that can't be read or written is ignored.
+
+    Parameters
+    ----------
+    aparc : str
+        Path to the parcellation file.
+    subrois : dict of {str: int or list}, optional
+        Sub-ROIs that will be extracted. Without `cache`, only their
+        labels are indexed.
+    cache : bool
+        If true, use the on-disk cache.
+
+    Returns
+    -------
+    label_idx : LabelIndex
+    """
+    infile = find_gzip(aparc, raise_error=True)
+    keep = None if subrois is None else _subroi_labels(subrois)
+
+    # Background voxels are left out of the cache, so ROIs that include
+    # label 0 are indexed from scratch.
+    if (not cache) or ((keep is not None) and np.any(keep == 0)):
+        return LabelIndex.from_array(load_nii(infile, dtype=None), keep=keep)
+
+    cachef = label_index_cachef(infile)
+    if op.isfile(cachef):
+        try:
+            label_idx = LabelIndex.load(cachef, source=infile)
+            if label_idx is not None:
+                return label_idx
+        except (OSError, ValueError, KeyError):
+            pass
+
+    label_idx = LabelIndex.from_array(load_nii(infile, dtype=None), background=0)
+    try:
+        label_idx.save(cachef, source=infile)
+    except OSError:
+        pass
+    return label_idx
+
+
+class LabelIndexCache(object):
+    """In-memory LRU cache of parcellation LabelIndex objects.
+
+    Entries are keyed by the parcellation file's path, modification
+    time and size, and the labels that were indexed, so a parcellation
+    that changes on disk is reindexed on its next use.
+    """
+
+    def __init__(self, maxsize=8):
+        """Initialize the cache to hold up to `maxsize` indices."""
+        self.maxsize = maxsize
+        self._cache = od([])
+        self._lock = threading.Lock()
+
+    def get(self, aparc, subrois, cache_index=True):
+        """Return the LabelIndex for `aparc` and `subrois`.
+
+        Indices that aren't in memory are loaded with load_label_index.
+        The cache can be shared between threads; indices are loaded
+        outside the lock.
+        """
+        infile = op.abspath(find_gzip(aparc, raise_error=True))
+        file_stat = os.stat(infile)
+        keep = _subroi_labels(subrois)
+        key = (
+            infile,
+            file_stat.st_mtime_ns,
+            file_stat.st_size,
+            tuple(keep.tolist()),
+        )
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        label_idx = load_label_index(infile, subrois, cache=cache_index)
+        with self._lock:
+            self._cache[key] = label_idx
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return label_idx
+
+
+def _subroi_desc(dat, mask, subrois, aggf, label_idx=None):
+    """Apply `aggf` over `dat` values within each sub-ROI of `mask`.
+
+    If `label_idx` is defined, all `aggf` functions must be keys of
+    LABEL_STAT_AGGFS and are computed from per-label statistics, and
+    `mask` is not used. Otherwise each sub-ROI is masked separately.
+    """
+    output = pd.DataFrame(
+        index=list(subrois.keys()), columns=list(aggf.keys()) + ["voxels"]
+    )
+    output = output.rename_axis("roi")
+
+    if label_idx is not None:
+        stats = {name: LABEL_STAT_AGGFS[func] for name, func in aggf.items()}
+        desc = label_idx.describe(
+            dat, subrois, stats=list(dict.fromkeys(stats.values()))
+        )
+        for func_name, stat in stats.items():
+            output[func_name] = desc[stat]
+        output["voxels"] = desc["voxels"]
+        return output
+
+    for subroi, subroi_vals in subrois.items():
+        mask_idx = np.flatnonzero(np.isin(mask, subroi_vals))
+        for func_name, func in aggf.items():
+            output.at[subroi, func_name] = func(dat[mask_idx])
+        output.at[subroi, "voxels"] = mask_idx.size
+    return output
+
+
 def load_nii(
     infile,
     dtype=np.float32,
@@ -198,6 +745,7 @@ def load_nii(
     conv_nan=0,
     binarize=False,
     int_rounding="nearest",
+    lazy=False,
 ):
     """Load a NIfTI file and return the NIfTI image and data array.
 
@@ -210,7 +758,8 @@ def load_nii(
     infile : str
         The nifti file to load.
     dtype : data-type
-        Determines the data type of the data array returned.
+        Determines the data type of the data array returned. If None,
+        the (scaled) data type on disk is kept.
     flatten : bool
         If true, `dat` is returned as a flattened copy of the
         `img`.dataobj array. Otherwise `dat`.shape == `img`.shape.
@@ -226,96 +775,34 @@ def load_nii(
         `nearest` : round to the nearest integer
         `floor` : round down
         `ceil` : round up
+    lazy : bool
+        If true, return a LazyNii instead of an array. Uncompressed
+        files are memory-mapped, and the formatting above is applied
+        only to the voxels that are read from it.
 
     Returns
     -------
     img : Nifti1Image
-    dat : ndarray or ndarray subclass
+    dat : ndarray, ndarray subclass, or LazyNii
     """
-
-    # Get the right file extension.
-    def _format_array(
-        dat,
-        dtype=np.float32,
-        squeeze=True,
-        flatten=False,
-        conv_nan=0,
-        binarize=False,
-        int_rounding="nearest",
-    ):
-        """Format an array.
-
-        Formatting options:
-        - Flattening
-        - NaN handling
-        - Data type conversion
-
-        Parameters
-        ----------
-        dtype : data-type
-            Determines the data type returned.
-        flatten : bool
-            Return `dat` as a flattened copy of the input array.
-        conv_nan : bool, number, or NoneType object
-            Convert NaNs to `conv_nan`. No conversion is applied if
-            `conv_nan` is np.nan, None, or False.
-        binarize : bool
-            If true, `dat` values > 0 become 1 and all other values are 0.
-            `dat` type is recast to np.uint8.
-        int_rounding : str
-            Determines how the data array is recast if `binarize` is false
-            and `dtype` is an integer.
-            `nearest` : round to the nearest integer
-            `floor` : round down
-            `ceil` : round up
-
-        Returns
-        -------
-        dat : ndarray or ndarray subclass
-        """
-        # Flatten the array.
-        if flatten:
-            dat = dat.ravel()
-
-        # Squeeze the array.
-        elif squeeze:
-            dat = np.squeeze(dat)
-
-        # Convert NaNs.
-        if not np.any((conv_nan is None, conv_nan is False, conv_nan is np.nan)):
-            dat[np.invert(np.isfinite(dat))] = conv_nan
-
-        # Recast the data type.
-        if binarize or (dtype is bool):
-            idx = dat > 0
-            dat[idx] = 1
-            dat[~idx] = 0
-            if dtype is bool:
-                dat = dat.astype(bool)
-            else:
-                dat = dat.astype(np.uint8)
-        elif "int" in str(dtype):
-            if int_rounding == "nearest":
-                dat = np.rint(dat)
-            elif int_rounding == "floor":
-                dat = np.floor(dat)
-            elif int_rounding == "ceil":
-                dat = np.ceil(dat)
-            else:
-                raise ValueError("int_rounding='{}' not valid".format(int_rounding))
-            dat = dat.astype(dtype)
-        else:
-            dat = dat.astype(dtype)
-
-        return dat
-
     infile = find_gzip(infile)
 
     # Load a NIfTI file and get its data array.
-    img = nib.load(infile)
+    img = nib.load(infile, mmap="c")
+    if lazy:
+        return LazyNii(
+            img,
+            dtype=dtype,
+            squeeze=squeeze,
+            flatten=flatten,
+            conv_nan=conv_nan,
+            binarize=binarize,
+            int_rounding=int_rounding,
+        )
     dat = np.asanyarray(img.dataobj)
 
-    # Format the data array.
+    # Format the data array. The array is fresh from disk (or a
+    # copy-on-write memory map), so it is safe to modify in place.
     dat = _format_array(
         dat,
         dtype=dtype,
@@ -324,11 +811,198 @@ def load_nii(
         conv_nan=conv_nan,
         binarize=binarize,
         int_rounding=int_rounding,
+        inplace=True,
     )
 
     return dat
 
 
+def _format_array(
+    dat,
+    dtype=np.float32,
+    squeeze=True,
+    flatten=False,
+    conv_nan=0,
+    binarize=False,
+    int_rounding="nearest",
+    inplace=False,
+):
+    """Format an array.
+
+    Formatting options:
+    - Flattening
+    - NaN handling
+    - Data type conversion
+
+    Parameters
+    ----------
+    dtype : data-type
+        Determines the data type returned. If None, the input data type
+        is kept.
+    flatten : bool
+        Return `dat` as a flattened copy of the input array.
+    conv_nan : bool, number, or NoneType object
+        Convert NaNs to `conv_nan`. No conversion is applied if
+        `conv_nan` is np.nan, None, or False.
+    binarize : bool
+        If true, `dat` values > 0 become 1 and all other values are 0.
+        `dat` type is recast to np.uint8.
+    int_rounding : str
+        Determines how the data array is recast if `binarize` is false
+        and `dtype` is an integer.
+        `nearest` : round to the nearest integer
+        `floor` : round down
+        `ceil` : round up
+    inplace : bool
+        If true, NaN conversion and integer rounding may modify `dat`
+        in place instead of copying it. Otherwise the input array is
+        never modified.
+
+    Returns
+    -------
+    dat : ndarray or ndarray subclass
+    """
+    # Flatten the array. This is a copy unless `dat` is C-contiguous,
+    # in which case we treat it like any other view of the input.
+    if flatten:
+        flat = dat.ravel()
+        copied = not np.may_share_memory(flat, dat)
+        dat = flat
+
+    # Squeeze the array.
+    elif squeeze:
+        dat = np.squeeze(dat)
+        copied = False
+    else:
+        copied = False
+    writeable = (inplace or copied) and dat.flags.writeable
+
+    # Convert NaNs.
+    if not np.any((conv_nan is None, conv_nan is False, conv_nan is np.nan)):
+        if np.issubdtype(dat.dtype, np.inexact):
+            nonfinite = np.invert(np.isfinite(dat))
+            if nonfinite.any():
+                if not writeable:
+                    dat = dat.copy()
+                    writeable = True
+                dat[nonfinite] = conv_nan
+            del nonfinite
+
+    # Recast the data type.
+    if binarize or (dtype is bool):
+        # A boolean array is stored one byte per element, so it can be
+        # viewed as uint8 without a copy.
+        dat = dat > 0
+        if dtype is not bool:
+            dat = dat.view(np.uint8)
+    elif dtype is None:
+        pass
+    elif ("int" in str(dtype)) and np.issubdtype(dat.dtype, np.inexact):
+        rounding = {"nearest": np.rint, "floor": np.floor, "ceil": np.ceil}
+        if int_rounding not in rounding:
+            raise ValueError("int_rounding='{}' not valid".format(int_rounding))
+        if writeable:
+            dat = rounding[int_rounding](dat, out=dat)
+        else:
+            dat = rounding[int_rounding](dat)
+        dat = dat.astype(dtype, copy=False)
+    else:
+        dat = dat.astype(dtype, copy=False)
+
+    return dat
+
+
+class LazyNii(object):
+    """NIfTI data that is only scaled and formatted where it is read.
+
+    The raw array on disk is memory-mapped (if the file is
+    uncompressed), and scaling, NaN conversion and data type casting
+    are applied to the indexed voxels only, so reading a few ROIs from
+    a large image never copies the rest of it. Formatting options are
+    the same as for load_nii.
+
+    Indexing a flattened LazyNii with flat voxel indices returns the
+    same values as indexing the array that load_nii would return.
+    ``np.asarray(lazy_nii)`` returns the full formatted array.
+    """
+
+    def __init__(
+        self,
+        img,
+        dtype=np.float32,
+        squeeze=True,
+        flatten=False,
+        conv_nan=0,
+        binarize=False,
+        int_rounding="nearest",
+    ):
+        """Initialize from a nibabel image with an ArrayProxy dataobj."""
+        self.img = img
+        self.slope = img.dataobj.slope
+        self.inter = img.dataobj.inter
+        raw = img.dataobj.get_unscaled()
+        self.raw = np.squeeze(raw) if (squeeze or flatten) else raw
+        self.flatten = flatten
+        self._format_kws = {
+            "dtype": dtype,
+            "squeeze": False,
+            "flatten": False,
+            "conv_nan": conv_nan,
+            "binarize": binarize,
+            "int_rounding": int_rounding,
+        }
+        self.shape = (self.raw.size,) if flatten else self.raw.shape
+        self.size = self.raw.size
+        self.ndim = len(self.shape)
+        if binarize:
+            self.dtype = np.dtype(bool if dtype is bool else np.uint8)
+        elif dtype is None:
+            self.dtype = self._scale(self.raw.flat[:1]).dtype
+        else:
+            self.dtype = np.dtype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        """Return formatted values for the indexed voxels."""
+        if isinstance(idx, tuple) and (len(idx) == 1):
+            idx = idx[0]
+        if self.flatten:
+            vals = self._take_flat(idx)
+        else:
+            vals = np.array(self.raw[idx])
+        vals = self._scale(vals)
+        return _format_array(vals, **self._format_kws, inplace=True)
+
+    def __array__(self, dtype=None, copy=None):
+        """Return the full formatted array."""
+        dat = self._scale(np.array(self.raw))
+        if self.flatten:
+            dat = dat.ravel()
+        dat = _format_array(dat, **self._format_kws, inplace=True)
+        return dat if dtype is None else dat.astype(dtype, copy=False)
+
+    def _scale(self, vals):
+        """Apply the NIfTI scaling slope and intercept."""
+        return apply_read_scaling(vals, self.slope, self.inter)
+
+    def _take_flat(self, idx):
+        """Index the raw array with C-order flat indices without copying it."""
+        if self.raw.flags.c_contiguous:
+            return np.array(self.raw.reshape(-1)[idx])
+        if self.raw.flags.f_contiguous:
+            idx = np.arange(self.size)[idx] if isinstance(idx, slice) else idx
+            idx = np.asarray(idx)
+            if idx.dtype == bool:
+                idx = np.flatnonzero(idx)
+            idx_f = np.ravel_multi_index(
+                np.unravel_index(idx, self.raw.shape), self.raw.shape, order="F"
+            )
+            return np.array(self.raw.reshape(-1, order="F")[idx_f])
+        return np.array(self.raw).ravel()[idx]
+
+
 def find_gzip(infile, raise_error=False, return_infile=False):
     """Find the existing file, gzipped or gunzipped.
 
@@ -387,8 +1061,10 @@ def toggle_gzip(infile):
     return outfile
 
 
-def _parse_args():
+def _parse_args(argv=None):
     """Parse and return command line arguments."""
+    if argv is None:
+        argv = sys.argv[1:]
     parser = argparse.ArgumentParser(
         description="""
 $ extract_rois.py -i [pet1.nii pet2.nii ...] -m [mask1.nii mask2.nii ...]
@@ -408,9 +1084,18 @@ them by name (-r|--aparc_rois). Otherwise, all ROIs in the CSV file are extracte
 default. --list_rois can be used to print the ROI names and labels from the CSV file
 without doing any actual extractions.
 
+Images that share a parcellation file are extracted together, so each parcellation is
+loaded and indexed only once.
+
+To avoid paying Python startup and import costs on every call, extract_rois.py can also
+run as a persistent server on a Unix socket (--serve). extract_rois_client.py accepts
+the same arguments as this program and forwards them to the server, starting one in
+the background if none is running.
+
 Output is printed to the console by default, but can also be saved to a CSV file
-(-o|--outputf). It is also possible to suppress printing the output dataframe to the
-console (-q|--quiet).
+(-o|--outputf), or to one CSV file per image by passing as many output files as images.
+It is also possible to suppress printing the output dataframe to the console
+(-q|--quiet).
         """,
         formatter_class=TextFormatter,
         exit_on_error=False,
@@ -466,7 +1151,12 @@ console (-q|--quiet).
         "-o",
         "--outputf",
         type=str,
-        help="Output CSV filepath. If not specified, output is printed but not saved",
+        nargs="+",
+        help=(
+            "Output CSV filepath. If not specified, output is printed but not saved.\n"
+            + "If one filepath is given per image, output for images[i] is saved to\n"
+            + "outputf[i] for i = 1...len(images)"
+        ),
     )
     parser.add_argument(
         "-s",
@@ -486,39 +1176,93 @@ console (-q|--quiet).
         action="store_true",
         help="Don't print the output dataframe to the terminal",
     )
+    parser.add_argument(
+        "--no_index_cache",
+        action="store_false",
+        dest="cache_index",
+        help=(
+            "Don't read or write the *_label-index.npz file that caches which\n"
+            + "voxels belong to each label, next to each parcellation file"
+        ),
+    )
+    parser.add_argument(
+        "--serve",
+        type=str,
+        metavar="SOCKET",
+        help=(
+            "Run as a persistent extraction server listening on this Unix socket\n"
+            + "path instead of extracting values (see extract_rois_client.py)"
+        ),
+    )
+    parser.add_argument(
+        "--idle_timeout",
+        type=float,
+        default=600,
+        help=(
+            "With --serve, shut down after this many seconds without a job\n"
+            + "(0 to run until interrupted)\n"
+            + "Default: %(default)s"
+        ),
+    )
+    parser.add_argument(
+        "--max_cached",
+        type=int,
+        default=8,
+        help=(
+            "With --serve, number of indexed parcellations kept in memory\n"
+            + "Default: %(default)s"
+        ),
+    )
     # Print help if no arguments are given.
-    if len(sys.argv) == 1:
+    if len(argv) == 0:
         parser.print_help()
         sys.exit(0)
     else:
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
         return args
 
 
-if __name__ == "__main__":
+def main(args, label_index_cache=None, cwd=None):
+    """Run ROI extractions for parsed command line arguments.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Arguments returned by _parse_args.
+    label_index_cache : LabelIndexCache, optional
+        Cache of indexed parcellations to reuse across calls.
+    cwd : str, optional
+        Directory that relative file arguments are resolved against.
+        Defaults to the current working directory.
+
+    Returns
+    -------
+    returncode : int
+        0 if extractions completed, otherwise 1.
+    """
     timer = Timer()
 
-    # Get command line arguments.
-    args = _parse_args()
+    def in_cwd(path):
+        return path if cwd is None else op.join(cwd, path)
 
     # Print ROI names and labels in a nicely-formatted table.
     if args.list_rois:
-        all_rois = pd.read_csv(args.roi_file)
+        all_rois = pd.read_csv(in_cwd(args.roi_file))
         all_rois["n_labels"] = all_rois.iloc[:, 1].apply(lambda x: len(x.split(";")))
         all_rois.iloc[:, 1] = all_rois.iloc[:, 1].apply(_fmt_long_str)
         print(all_rois.to_markdown(index=False, tablefmt="rst"))
         print(args.roi_file, end="\n" * 2)
-        sys.exit(0)
+        return 0
 
     # Load the ROI dictionary
-    all_rois = load_rois(args.roi_file)
+    all_rois = load_rois(in_cwd(args.roi_file))
 
     # Check that at least one of masks or aparcs is specified
     if args.masks is None and args.aparcs is None:
         print(
             "ERROR: At least one of --masks (-m) or --aparcs (-a) must be specified\n"
         )
-        sys.exit(1)
+        return 1
 
     # Check that the number of images and parcellations match
     if args.aparcs is not None:
@@ -530,13 +1274,27 @@ if __name__ == "__main__":
                     len(args.images), len(args.aparcs)
                 )
             )
-            sys.exit(1)
+            return 1
+
+    # Check that the number of images and output files match
+    if args.outputf is not None:
+        if (len(args.outputf) > 1) and (len(args.images) != len(args.outputf)):
+            print(
+                "ERROR: Number of images and output files must match,\n"
+                + "or there must be only one output file specified.\n"
+                + "Found {} images and {} output files".format(
+                    len(args.images), len(args.outputf)
+                )
+            )
+            return 1
 
     # Extract ROI values from masks
     output = []
     if args.masks is not None:
         for img in args.images:
-            _output = roi_desc(dat=img, rois=args.masks)
+            _output = roi_desc(
+                dat=in_cwd(img), rois=[in_cwd(mask) for mask in args.masks]
+            )
             _output = _output.reset_index()
             _output.insert(0, "image_file", img)
             _output.insert(1, "roi_file", args.masks)
@@ -557,13 +1315,28 @@ if __name__ == "__main__":
         # Broadcast inputs if needed
         if (len(args.images) > 1) and (len(args.aparcs) == 1):
             args.aparcs = args.aparcs * len(args.images)
-        # Extract ROI values
+        # Extract ROI values, loading each parcellation only once
+        aparc_images = od([])
         for img, aparc in zip(args.images, args.aparcs):
-            _output = roi_desc(dat=img, rois=aparc, subrois=keep_rois)
-            _output = _output.reset_index()
-            _output.insert(0, "image_file", img)
-            _output.insert(1, "roi_file", aparc)
-            output.append(_output)
+            aparc_images.setdefault(aparc, []).append(img)
+        for aparc, imgs in aparc_images.items():
+            label_idx = None
+            if label_index_cache is not None:
+                label_idx = label_index_cache.get(
+                    in_cwd(aparc), keep_rois, cache_index=args.cache_index
+                )
+            _outputs = roi_desc_many(
+                [in_cwd(img) for img in imgs],
+                in_cwd(aparc),
+                keep_rois,
+                cache_index=args.cache_index,
+                label_idx=label_idx,
+            )
+            for img, _output in zip(imgs, _outputs):
+                _output = _output.reset_index()
+                _output.insert(0, "image_file", img)
+                _output.insert(1, "roi_file", aparc)
+                output.append(_output)
 
     output = pd.concat(output).reset_index(drop=True)
     output = output.rename(columns={"voxels": "voxel_count"})
@@ -580,8 +1353,15 @@ if __name__ == "__main__":
 
     # Save output.
     if args.outputf is not None:
-        output.to_csv(args.outputf, index=False)
-        print(f"\nSaved output to {op.abspath(args.outputf)}")
+        if len(args.outputf) == 1:
+            output.to_csv(in_cwd(args.outputf[0]), index=False)
+            print(f"\nSaved output to {op.abspath(in_cwd(args.outputf[0]))}")
+        else:
+            for img, outputf in zip(args.images, args.outputf):
+                output.loc[output["image_file"] == img].to_csv(
+                    in_cwd(outputf), index=False
+                )
+                print(f"\nSaved output to {op.abspath(in_cwd(outputf))}")
 
     # Print output.
     if not args.quiet:
@@ -603,4 +1383,154 @@ if __name__ == "__main__":
         )
 
     print(timer)
-    sys.exit(0)
+    return 0
+
+
+def serve(socket_path, idle_timeout=600, max_cached=8):
+    """Serve ROI extraction jobs on a Unix socket until idle.
+
+    Each job is one JSON line with keys "argv" (a list of extract_rois.py
+    command line arguments) and "cwd" (the client's working directory).
+    The server replies with one JSON line with keys "returncode" and
+    "output" (everything the job printed). Each connection is handled
+    in its own thread, so jobs from different clients run concurrently,
+    and indexed parcellations are cached between jobs.
+
+    Parameters
+    ----------
+    socket_path : str
+        Path to the Unix socket to listen on.
+    idle_timeout : float
+        Shut down after this many seconds without a job. If 0 or None,
+        run until interrupted.
+    max_cached : int
+        Number of indexed parcellations kept in memory.
+
+    Returns
+    -------
+    None
+    """
+    label_index_cache = LabelIndexCache(maxsize=max_cached)
+
+    class _JobHandler(socketserver.StreamRequestHandler):
+        def setup(self):
+            super().setup()
+            with self.server.lock:
+                self.server.n_active += 1
+
+        def handle(self):
+            for line in self.rfile:
+                result = _run_job(json.loads(line), label_index_cache)
+                self.wfile.write((json.dumps(result) + "\n").encode())
+                self.wfile.flush()
+
+        def finish(self):
+            with self.server.lock:
+                self.server.n_active -= 1
+            super().finish()
+
+    class _JobServer(socketserver.ThreadingUnixStreamServer):
+        timed_out = False
+        n_active = 0
+        lock = threading.Lock()
+
+        def handle_timeout(self):
+            # Don't shut down while a client is still connected
+            with self.lock:
+                self.timed_out = self.n_active == 0
+
+    # Don't clobber the socket of another running server, but remove
+    # the socket file left behind by one that died.
+    if op.exists(socket_path):
+        if not S_ISSOCK(os.stat(socket_path).st_mode):
+            raise FileExistsError(f"{socket_path} exists and is not a socket")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(socket_path)
+                print(f"An extraction server is already running on {socket_path}")
+                return
+            except OSError:
+                os.remove(socket_path)
+
+    # Job threads share sys.stdout and sys.stderr, so each one captures
+    # its output through a per-thread stream
+    stdout, stderr = _ThreadOutput(sys.stdout), _ThreadOutput(sys.stderr)
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        with _JobServer(socket_path, _JobHandler) as server:
+            server.timeout = idle_timeout or None
+            print(f"Serving ROI extractions on {socket_path}")
+            try:
+                while not server.timed_out:
+                    server.handle_request()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.remove(socket_path)
+
+
+class _ThreadOutput(io.TextIOBase):
+    """Text stream that each thread can redirect to its own target.
+
+    Writes go to `stream` unless the writing thread is inside
+    capture().
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    @contextmanager
+    def capture(self, target):
+        """Send writes from the current thread to `target`."""
+        self._local.target = target
+        try:
+            yield target
+        finally:
+            self._local.target = None
+
+    def _target(self):
+        target = getattr(self._local, "target", None)
+        return self.stream if target is None else target
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        return self._target().write(s)
+
+    def flush(self):
+        self._target().flush()
+
+
+def _run_job(job, label_index_cache=None):
+    """Run one server job and return its exit code and printed output.
+
+    Relative paths in the job's arguments are resolved against its
+    "cwd" rather than changing the server's working directory, which
+    is shared by all job threads. Output is captured through the
+    _ThreadOutput streams that serve() installs.
+    """
+    stdout = io.StringIO()
+    with sys.stdout.capture(stdout), sys.stderr.capture(stdout):
+        try:
+            returncode = main(
+                _parse_args(job["argv"]), label_index_cache, cwd=job.get("cwd")
+            )
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            print(f"ERROR: {e!r}")
+            returncode = 1
+    return {"returncode": returncode, "output": stdout.getvalue()}
+
+
+if __name__ == "__main__":
+    # Get command line arguments.
+    args = _parse_args()
+
+    # Run as a server, or run the extractions once.
+    if args.serve is not None:
+        serve(args.serve, idle_timeout=args.idle_timeout, max_cached=args.max_cached)
+        sys.exit(0)
+    else:
+        sys.exit(main(args))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+$ extract_rois_client.py [extract_rois.py arguments]
+
+Forward extract_rois.py arguments to a persistent extraction server
+(`extract_rois.py --serve`) so each call skips Python startup and the
+pandas/nibabel imports. If no server is listening on the socket, one is
+started in the background and shuts itself down after 10 minutes idle.
+If a server cannot be reached, extract_rois.py is run directly.
+
+This module only uses the standard library so it starts quickly.
+
+Environment variables
+---------------------
+EXTRACT_ROIS_SOCKET : Unix socket path of the server
+    Default: <tmpdir>/extract_rois_<user>.sock
+EXTRACT_ROIS_SPAWN : set to 0 to not start a server if none is running
+"""
+
+import getpass
+import json
+import os
+import os.path as op
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+EXTRACT_ROIS_PY = op.join(op.dirname(op.abspath(__file__)), "extract_rois.py")
+
+
+def default_socket():
+    """Return the socket path of the extraction server."""
+    return os.environ.get(
+        "EXTRACT_ROIS_SOCKET",
+        op.join(tempfile.gettempdir(), f"extract_rois_{getpass.getuser()}.sock"),
+    )
+
+
+def connect(socket_path, spawn=True, timeout=60):
+    """Return a socket connected to the extraction server.
+
+    Parameters
+    ----------
+    socket_path : str
+        Path to the server's Unix socket.
+    spawn : bool
+        If true and no server is running, start one in the background
+        and wait for it to start listening.
+    timeout : float
+        Maximum number of seconds to wait for a new server.
+
+    Returns
+    -------
+    sock : socket.socket or None
+        The connected socket, or None if no server could be reached.
+    """
+    sock = _try_connect(socket_path)
+    if (sock is not None) or (not spawn):
+        return sock
+
+    subprocess.Popen(
+        [sys.executable, EXTRACT_ROIS_PY, "--serve", socket_path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    start = time.time()
+    while time.time() - start < timeout:
+        time.sleep(0.1)
+        sock = _try_connect(socket_path)
+        if sock is not None:
+            return sock
+    return None
+
+
+def _try_connect(socket_path):
+    """Return a socket connected to socket_path, or None."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        return sock
+    except OSError:
+        sock.close()
+        return None
+
+
+def run(argv, socket_path=None, spawn=True):
+    """Run extract_rois.py with `argv` on the server.
+
+    Output from the job is printed to the console.
+
+    Returns
+    -------
+    returncode : int
+        The extract_rois.py exit code.
+    """
+    if socket_path is None:
+        socket_path = default_socket()
+    sock = connect(socket_path, spawn=spawn)
+
+    # Fall back to running extract_rois.py in place of this process.
+    if sock is None:
+        os.execv(sys.executable, [sys.executable, EXTRACT_ROIS_PY] + argv)
+
+    job = {"argv": argv, "cwd": os.getcwd()}
+    with sock, sock.makefile("rwb") as f:
+        f.write((json.dumps(job) + "\n").encode())
+        f.flush()
+        line = f.readline()
+    if not line:
+        print(f"ERROR: Extraction server on {socket_path} closed the connection")
+        return 1
+    result = json.loads(line)
+    print(result["output"], end="")
+    return result["returncode"]
+
+
+if __name__ == "__main__":
+    spawn = os.environ.get("EXTRACT_ROIS_SPAWN", "1") != "0"
+    sys.exit(run(sys.argv[1:], spawn=spawn))
@@ -10,9 +10,11 @@ function outfiles = run_pet_roi_extractions(suvr_files, maskfs, aparcf, roif, fi
         overwrite logical = false
     end
 
-    % Define path to the extract_rois.py program
+    % Define path to the extract_rois.py client, which forwards the
+    % extraction to a persistent extract_rois.py server (started on first
+    % use) so we don't pay Python startup costs for every scan
     code_dir = fileparts(fileparts(mfilename('fullpath')));
-    extract_rois_py = fullfile(code_dir, 'nifti', 'extract_rois.py');
+    extract_rois_py = fullfile(code_dir, 'nifti', 'extract_rois_client.py');
 
     % Get the output file paths
     suvr_fields = fieldnames(suvr_files);
@@ -53,31 +55,38 @@ function outfiles = run_pet_roi_extractions(suvr_files, maskfs, aparcf, roif, fi
         end
     end
 
-    % Extract ROI means from each PET image
+    % Find the PET images that still need ROI extractions
     log_append(fid, '- Extracting ROI means from PET SUVRs in native MRI space:');
+    outfiles_to_write = cell(size(suvr_files));
+    keep = true(size(suvr_files));
     for ii = 1:length(suvr_files)
-        suvr_file = suvr_files{ii};
         roi_field = roi_fields{ii};
         outfile = outfiles.(roi_field);
+        outfiles_to_write{ii} = outfile;
 
         % Check if the output file already exists
         if isfile(outfile) && ~overwrite
             log_append(fid, sprintf('  * %s exists, will not overwrite', basename(outfile)));
-            continue
+            keep(ii) = false;
         end
+    end
+    suvr_files = suvr_files(keep);
+    outfiles_to_write = outfiles_to_write(keep);
 
-        % Construct the ROI extraction command
-        cmd = sprintf('%s --images %s', extract_rois_py, suvr_file);
-        if ~isempty(maskfs)
-            cmd = sprintf('%s --masks %s', cmd, strjoin(maskfs));
-        end
-        if ~isempty(aparcf)
-            cmd = sprintf('%s --aparcs %s --roi_file %s', cmd, aparcf, roif);
-        end
-        cmd = sprintf('%s --shape long --outputf %s --quiet', cmd, outfile);
-        fprintf(cmd);
-
-        % Run the command
-        system(cmd);
+    % Construct the ROI extraction command. All PET images are passed in
+    % a single call so the parcellation is only loaded once
+    cmd = sprintf('%s --images %s', extract_rois_py, strjoin(suvr_files));
+    if ~isempty(maskfs)
+        cmd = sprintf('%s --masks %s', cmd, strjoin(maskfs));
     end
+    if ~isempty(aparcf)
+        cmd = sprintf('%s --aparcs %s --roi_file %s', cmd, aparcf, roif);
+    end
+    cmd = sprintf( ...
+        '%s --shape long --outputf %s --quiet', cmd, strjoin(outfiles_to_write) ...
+    );
+    fprintf(cmd);
+
+    % Run the command
+    system(cmd);
 end
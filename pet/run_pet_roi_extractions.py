@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+
+"""
+Run ROI extractions for every processed PET scan in parallel.
+
+This is the Python counterpart to run_pet_roi_extractions.m and the
+reference region step of save_pet_suvrs.m. For each PET directory in
+data/processed, the linked MRI's aparc+aseg and reference region masks
+are used to save the same *_roi-extractions.csv and
+*_ref-region-means.csv files that the MATLAB pipeline writes, so ROI
+extractions can be regenerated (e.g. after adding an ROI to
+config/fsroi_list_<TRACER>.csv) without rerunning PET processing.
+"""
+
+import argparse
+import io
+import os
+import os.path as op
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import redirect_stdout
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+utils_dir = op.join(op.dirname(__file__), "..", "utils")
+if utils_dir not in sys.path:
+    sys.path.append(utils_dir)
+import utilities as uts
+
+nifti_dir = op.join(op.dirname(__file__), "..", "nifti")
+if nifti_dir not in sys.path:
+    sys.path.append(nifti_dir)
+import extract_rois as er
+
+# Define globals
+CONFIG_DIR = op.abspath(op.join(op.dirname(__file__), "..", "config"))
+
+# Approximate peak memory used per image voxel while extracting one
+# PET scan (full-size PET, mask and index arrays held at once)
+MEM_BYTES_PER_VOXEL = 32
+
+
+def load_ref_regions(ref_region_file=None):
+    """Return the reference region table from config/ref_regions.csv.
+
+    Returns
+    -------
+    ref_regions : DataFrame
+        Columns are "tracer", "ref_region", and "masks", where "masks"
+        lists the semicolon-separated mask names that define each
+        reference region.
+    """
+    if ref_region_file is None:
+        ref_region_file = op.join(CONFIG_DIR, "ref_regions.csv")
+    ref_regions = pd.read_csv(ref_region_file, encoding="utf-8-sig")
+    return ref_regions
+
+
+def get_pet_dirs(proc_dir, tracers):
+    """Return all processed PET directories for the given tracers.
+
+    Parameters
+    ----------
+    proc_dir : str
+        Path to the processed data directory, which contains one
+        subdirectory per subject.
+    tracers : list of str
+        Only PET directories named "<TRACER>_<date>" for these tracers
+        are returned.
+
+    Returns
+    -------
+    pet_dirs : list of str
+        Sorted paths to the processed PET directories.
+    """
+    proc_dir = op.abspath(proc_dir)
+    prefixes = tuple(f"{tracer}_" for tracer in tracers)
+    pet_dirs = []
+    with os.scandir(proc_dir) as subj_dirs:
+        for subj_dir in subj_dirs:
+            if not subj_dir.is_dir():
+                continue
+            with os.scandir(subj_dir.path) as scan_dirs:
+                pet_dirs.extend(
+                    entry.path
+                    for entry in scan_dirs
+                    if entry.is_dir() and entry.name.startswith(prefixes)
+                )
+    return sorted(pet_dirs)
+
+
+def get_pet_files(pet_dir, ref_regions, roi_dir=None):
+    """Return the input and output files for one PET scan's extractions.
+
+    File names follow get_suvr_files.m, get_processed_pet_files.m and
+    process_single_pet.m.
+
+    Parameters
+    ----------
+    pet_dir : str
+        Path to the processed PET directory. Must contain an "mri"
+        symlink to the processed MRI directory.
+    ref_regions : DataFrame
+        Reference region table returned by load_ref_regions.
+    roi_dir : str, optional
+        Directory with the fsroi_list_<TRACER>.csv files. Default is
+        the config directory of this repository.
+
+    Returns
+    -------
+    pet_files : dict
+        Paths to the resliced PET ("rpet"), reference region masks
+        ("masks", a dict of {ref_region: [mask files]}), SUVRs
+        ("suvrs", a dict of {ref_region: suvr file}), aparc+aseg
+        ("aparc"), ROI list ("roi_file"), reference region means output
+        ("rrmeans"), and ROI extraction outputs ("roi_extractions", in
+        the same order as "suvrs").
+    """
+    if roi_dir is None:
+        roi_dir = CONFIG_DIR
+    pet_dir = op.abspath(pet_dir)
+    pet_tag = uts.get_scan_tag(pet_dir)
+    _, tracer, _ = uts.parse_scan_tag(pet_tag)
+
+    # Resolve the MRI tag from the symlink target, but keep paths
+    # relative to the link like the MATLAB pipeline
+    mri_dir = op.join(pet_dir, "mri")
+    if not op.isdir(mri_dir):
+        raise FileNotFoundError(f"MRI directory not found: {mri_dir}")
+    mri_tag = uts.get_scan_tag(op.realpath(mri_dir))
+
+    tracer_ref_regions = ref_regions.loc[ref_regions["tracer"] == tracer]
+    masks = {}
+    suvrs = {}
+    for ref_region, mask_names in zip(
+        tracer_ref_regions["ref_region"], tracer_ref_regions["masks"]
+    ):
+        masks[ref_region] = [
+            op.join(mri_dir, f"{mri_tag}_mask-{mask_name.strip()}.nii")
+            for mask_name in mask_names.split(";")
+        ]
+        suvrs[ref_region] = op.join(pet_dir, f"r{pet_tag}_suvr-{ref_region}.nii")
+
+    pet_files = {
+        "rpet": op.join(pet_dir, f"r{pet_tag}.nii"),
+        "masks": masks,
+        "suvrs": suvrs,
+        "aparc": op.join(mri_dir, f"{mri_tag}_aparc+aseg.nii"),
+        "roi_file": op.join(roi_dir, f"fsroi_list_{tracer}.csv"),
+        "rrmeans": op.join(pet_dir, f"r{pet_tag}_ref-region-means.csv"),
+        "roi_extractions": [
+            suvrf.replace(".nii", "_roi-extractions.csv") for suvrf in suvrs.values()
+        ],
+    }
+    return pet_files
+
+
+def save_ref_region_means(pet_files, overwrite=False):
+    """Save the reference region means CSV file for one PET scan.
+
+    Mirrors save_pet_suvrs.m: the mean PET value is calculated within
+    each mask, excluding non-finite voxels, and reference regions
+    defined by multiple masks take the unweighted mean of the mask
+    means. SUVR images are not written.
+
+    Returns
+    -------
+    outfile : str or None
+        The saved CSV file, or None if it already existed.
+    """
+    outfile = pet_files["rrmeans"]
+    if op.isfile(outfile) and not overwrite:
+        return None
+
+    dat = er.load_nii(pet_files["rpet"], dtype=np.float64, flatten=True, conv_nan=None)
+    dat_is_finite = np.isfinite(dat)
+    mask_means = {}
+    rows = []
+    for maskfs in pet_files["masks"].values():
+        # Masks shared by multiple reference regions are loaded once
+        for maskf in maskfs:
+            if maskf not in mask_means:
+                mask = er.load_nii(maskf, flatten=True, binarize=True)
+                assert dat.shape == mask.shape
+                mask = mask.astype(bool)
+                mask_means[maskf] = (
+                    np.mean(dat[mask & dat_is_finite]),
+                    np.count_nonzero(mask),
+                )
+        rows.append(
+            {
+                "image_file": pet_files["rpet"],
+                "mask_file": ";\n".join(maskfs),
+                "mean": np.mean([mask_means[maskf][0] for maskf in maskfs]),
+                "voxel_count": ";\n".join(
+                    str(mask_means[maskf][1]) for maskf in maskfs
+                ),
+            }
+        )
+    pd.DataFrame(rows).to_csv(outfile, index=False)
+    return outfile
+
+
+def save_roi_extractions(pet_files, overwrite=False, cache_index=True):
+    """Save ROI extraction CSV files for each SUVR of one PET scan.
+
+    Runs the same extraction as run_pet_roi_extractions.m: reference
+    region masks and aparc+aseg ROIs from fsroi_list_<TRACER>.csv are
+    extracted from every SUVR, in long format.
+
+    Returns
+    -------
+    outfiles : list of str
+        The saved CSV files. Existing files are skipped unless
+        `overwrite` is true.
+    """
+    images = []
+    outfiles = []
+    for suvrf, outfile in zip(
+        pet_files["suvrs"].values(), pet_files["roi_extractions"]
+    ):
+        if op.isfile(outfile) and not overwrite:
+            continue
+        images.append(suvrf)
+        outfiles.append(outfile)
+    if len(images) == 0:
+        return []
+
+    maskfs = sorted({f for maskfs in pet_files["masks"].values() for f in maskfs})
+    argv = ["--images", *images]
+    if len(maskfs) > 0:
+        argv += ["--masks", *maskfs]
+    argv += [
+        "--aparcs",
+        pet_files["aparc"],
+        "--roi_file",
+        pet_files["roi_file"],
+        "--shape",
+        "long",
+        "--outputf",
+        *outfiles,
+        "--quiet",
+    ]
+    if not cache_index:
+        argv.append("--no_index_cache")
+    args = er._parse_args(argv)
+    with redirect_stdout(io.StringIO()) as f:
+        returncode = er.main(args)
+    if returncode != 0:
+        raise RuntimeError(f.getvalue().strip())
+    return outfiles
+
+
+def process_pet_dir(
+    pet_dir,
+    ref_regions,
+    roi_dir=None,
+    save_rrmeans=True,
+    save_rois=True,
+    overwrite=False,
+    cache_index=True,
+):
+    """Save reference region means and ROI extractions for one PET scan.
+
+    Returns
+    -------
+    result : dict
+        "pet_dir", "saved" (list of saved files), "error" (error message
+        or None), and "seconds" (elapsed time).
+    """
+    start = time.time()
+    result = {"pet_dir": pet_dir, "saved": [], "error": None}
+    try:
+        pet_files = get_pet_files(pet_dir, ref_regions, roi_dir)
+        if save_rrmeans:
+            outfile = save_ref_region_means(pet_files, overwrite)
+            if outfile is not None:
+                result["saved"].append(outfile)
+        if save_rois:
+            result["saved"] += save_roi_extractions(pet_files, overwrite, cache_index)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = time.time() - start
+    return result
+
+
+def estimate_mem(pet_dir):
+    """Return the approximate peak memory in bytes to process pet_dir."""
+    pet_tag = uts.get_scan_tag(pet_dir)
+    rpetf = op.join(pet_dir, f"r{pet_tag}.nii")
+    try:
+        shape = nib.load(rpetf).shape
+    except Exception:
+        return 0
+    return int(np.prod(shape)) * MEM_BYTES_PER_VOXEL
+
+
+def run_pet_roi_extractions(
+    pet_dirs,
+    ref_regions,
+    roi_dir=None,
+    save_rrmeans=True,
+    save_rois=True,
+    overwrite=False,
+    cache_index=True,
+    n_workers=None,
+    mem_budget=None,
+    verbose=True,
+):
+    """Process PET directories in parallel within a memory budget.
+
+    Parameters
+    ----------
+    pet_dirs : list of str
+        Processed PET directories.
+    ref_regions : DataFrame
+        Reference region table returned by load_ref_regions.
+    roi_dir : str, optional
+        Directory with the fsroi_list_<TRACER>.csv files.
+    save_rrmeans : bool
+        If true, save *_ref-region-means.csv files.
+    save_rois : bool
+        If true, save *_roi-extractions.csv files.
+    overwrite : bool
+        If true, overwrite existing output files.
+    cache_index : bool
+        If true, reuse on-disk parcellation label indices (see
+        extract_rois.load_label_index).
+    n_workers : int, optional
+        Number of worker processes. Default is os.cpu_count().
+    mem_budget : int, optional
+        Maximum estimated memory in bytes used by scans that are
+        processed at once. A scan is always started if no others are
+        running. Default is no limit.
+    verbose : bool
+        If true, print progress for each scan.
+
+    Returns
+    -------
+    results : DataFrame
+        One row per PET directory with columns "pet_dir", "saved",
+        "error", and "seconds".
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if mem_budget is None:
+        mem_budget = np.inf
+
+    queue = [(pet_dir, estimate_mem(pet_dir)) for pet_dir in pet_dirs]
+    queue.reverse()
+    results = []
+    running = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        while queue or running:
+            # Start scans while there are free workers and memory
+            mem_used = sum(running.values())
+            while queue and (len(running) < n_workers):
+                pet_dir, mem = queue[-1]
+                if running and (mem_used + mem > mem_budget):
+                    break
+                queue.pop()
+                future = executor.submit(
+                    process_pet_dir,
+                    pet_dir,
+                    ref_regions,
+                    roi_dir,
+                    save_rrmeans,
+                    save_rois,
+                    overwrite,
+                    cache_index,
+                )
+                running[future] = mem
+                mem_used += mem
+
+            # Collect finished scans
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                result = future.result()
+                results.append(result)
+                if verbose:
+                    _print_result(result, len(results), len(pet_dirs))
+
+    results = pd.DataFrame(results, columns=["pet_dir", "saved", "error", "seconds"])
+    return results
+
+
+def _print_result(result, i, n):
+    """Print the outcome of processing one PET directory."""
+    pet_tag = uts.get_scan_tag(result["pet_dir"])
+    if result["error"] is not None:
+        msg = f"ERROR: {result['error']}"
+    elif len(result["saved"]) == 0:
+        msg = "outputs exist, skipped"
+    else:
+        msg = f"saved {len(result['saved'])} files"
+    print(f"  * [{i}/{n}] {pet_tag}: {msg} ({result['seconds']:.1f}s)")
+
+
+def _parse_args():
+    """Parse and return command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=(
+            "Save ROI extraction and reference region mean CSV files for processed\n"
+            + "PET scans, running scans in parallel"
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "-p",
+        "--proj-dir",
+        default="/mnt/coredata/processing/leads",
+        help=(
+            "Full path to the top-level project directory, from which subdirectory\n"
+            "paths are inferred. Default: %(default)s"
+        ),
+    )
+    parser.add_argument(
+        "-s",
+        "--scan-dirs",
+        nargs="+",
+        help="Processed PET directories to run. Default: all PET directories",
+    )
+    parser.add_argument(
+        "-t",
+        "--tracers",
+        nargs="+",
+        help="Only run PET scans for these tracers. Default: all in ref_regions.csv",
+    )
+    parser.add_argument(
+        "--outputs",
+        choices=["all", "rois", "rrmeans"],
+        default="all",
+        help=(
+            "Which files to save: *_roi-extractions.csv (rois),\n"
+            "*_ref-region-means.csv (rrmeans), or both (all). Default: %(default)s"
+        ),
+    )
+    parser.add_argument(
+        "-o",
+        "--overwrite",
+        action="store_true",
+        help="Overwrite existing output files",
+    )
+    parser.add_argument(
+        "-n",
+        "--n-workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes. Default: %(default)s",
+    )
+    parser.add_argument(
+        "-m",
+        "--mem-gb",
+        type=float,
+        help="Memory budget in GB for scans processed at once. Default: no limit",
+    )
+    parser.add_argument(
+        "--no-index-cache",
+        action="store_false",
+        dest="cache_index",
+        help="Don't read or write *_label-index.npz files next to each aparc+aseg",
+    )
+    return parser.parse_args()
+
+
+def main():
+    """Run ROI extractions over the processed PET directories."""
+    start_time = time.time()
+
+    # Get command line arguments.
+    args = _parse_args()
+    ref_regions = load_ref_regions()
+    tracers = args.tracers
+    if tracers is None:
+        tracers = list(ref_regions["tracer"].unique())
+
+    # Find the PET directories to process.
+    if args.scan_dirs is None:
+        proc_dir = op.join(args.proj_dir, "data", "processed")
+        pet_dirs = get_pet_dirs(proc_dir, tracers)
+    else:
+        pet_dirs = [op.abspath(scan_dir) for scan_dir in args.scan_dirs]
+    print(f"Running ROI extractions for {len(pet_dirs)} PET scans")
+
+    mem_budget = None if args.mem_gb is None else int(args.mem_gb * 1024**3)
+    results = run_pet_roi_extractions(
+        pet_dirs,
+        ref_regions,
+        save_rrmeans=args.outputs in ["all", "rrmeans"],
+        save_rois=args.outputs in ["all", "rois"],
+        overwrite=args.overwrite,
+        cache_index=args.cache_index,
+        n_workers=args.n_workers,
+        mem_budget=mem_budget,
+    )
+
+    # Report results and elapsed time.
+    n_failed = results["error"].notna().sum()
+    n_saved = results["saved"].apply(len).sum()
+    print(f"\nSaved {n_saved} files, {n_failed} scans failed")
+    elapsed = time.time() - start_time
+    minutes, seconds = divmod(elapsed, 60)
+    print(f"Elapsed time: {int(minutes)} min, {int(seconds)} s", end="\n" * 2)
+
+    sys.exit(1 if n_failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Layered drawing of QC slice images with a single image per axes.
+
+Each row of a QC PNG is an underlay (MRI or SUVR slices) with overlays
+on top of it: slice lines, masks, reference regions and their contours.
+These used to be drawn with one sns.heatmap call per layer. seaborn
+draws a QuadMesh with one patch per voxel and redraws the whole figure
+on every call, which made rendering the large strips at dpi=500 slow
+and memory hungry.
+
+heatmap() takes the same arguments as the sns.heatmap calls it
+replaces, but maps the layer to RGBA with a NumPy colormap lookup and
+alpha-blends it into an RGB image that is drawn with one imshow per
+axes. Later calls on the same axes blend into that image. Colors follow
+seaborn and matplotlib:
+
+- vmin and vmax default to the range of the unmasked data.
+- NaN and masked values are transparent, values below vmin get the
+  colormap's under color and values above vmax its over color.
+- alpha replaces the alpha of every color that is not transparent.
+
+Layers are blended over a black background, the figure color used by
+all QC plots, and rows are drawn top to bottom like a heatmap, so
+text placed in data coordinates lands where it did before.
+"""
+
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.colors import Colormap, ListedColormap
+
+# Identifies the composite image of an axes among its images
+COMPOSITE_GID = "qc_composite"
+BACKGROUND = (0, 0, 0)
+
+
+def get_colormap(cmap):
+    """
+    Return the Colormap for a colormap name, list of colors or Colormap.
+    """
+    if isinstance(cmap, Colormap):
+        return cmap
+    if isinstance(cmap, str):
+        return matplotlib.colormaps[cmap]
+    return ListedColormap(cmap)
+
+
+def layer_rgba(data, cmap, vmin=None, vmax=None, alpha=None, mask=None):
+    """
+    Map a 2D array to RGBA colors as sns.heatmap would draw it.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        2D image array.
+    cmap : str, list or matplotlib.colors.Colormap
+        The colormap.
+    vmin, vmax : float, optional
+        Values mapped to the bottom and top of the colormap. Default to
+        the minimum and maximum of the unmasked data.
+    alpha : float, optional
+        Opacity of the layer.
+    mask : numpy.ndarray of bool, optional
+        Pixels where mask is True are transparent.
+
+    Returns
+    -------
+    numpy.ndarray
+        float32 array of shape data.shape + (4,).
+    """
+    values = np.array(data, dtype=np.float64)
+    if mask is not None:
+        values[np.asarray(mask, dtype=bool)] = np.nan
+    valid = ~np.isnan(values)
+    if not valid.any():
+        return np.zeros(values.shape + (4,), dtype=np.float32)
+    vmin = values[valid].min() if vmin is None else vmin
+    vmax = values[valid].max() if vmax is None else vmax
+
+    # Scale to [0, 1], leaving NaN (bad) and values outside [vmin, vmax]
+    # (under and over) for the colormap to handle
+    if vmax > vmin:
+        scaled = (values - vmin) / (vmax - vmin)
+    elif vmax == vmin:
+        scaled = np.where(valid, 0.0, np.nan)
+    else:
+        # e.g. an empty contour drawn with vmin=0.1
+        scaled = np.where(valid, np.where(values < vmin, -1.0, 2.0), np.nan)
+    return get_colormap(cmap)(scaled, alpha=alpha).astype(np.float32)
+
+
+def blend(rgb, rgba):
+    """
+    Return rgba alpha-blended over an RGB image.
+    """
+    alpha = rgba[..., 3:]
+    return rgba[..., :3] * alpha + rgb * (1 - alpha)
+
+
+def heatmap(
+    data, cmap=None, vmin=None, vmax=None, alpha=None, mask=None, cbar=False, ax=None
+):
+    """
+    Draw a 2D array on ax, over any layers already drawn there.
+
+    Takes the arguments of sns.heatmap that the QC plots use (see
+    layer_rgba). The first call on an axes creates its composite image;
+    later calls blend into it, so each axes holds a single image however
+    many layers are drawn.
+
+    Parameters
+    ----------
+    cbar : bool
+        Must be False. Colorbars are added with add_colorbar.
+    ax : matplotlib.axes.Axes, optional
+        The axes to draw on. Defaults to the current axes.
+
+    Returns
+    -------
+    matplotlib.axes.Axes
+        The axes, as returned by sns.heatmap.
+    """
+    if cbar:
+        raise ValueError("heatmap does not draw colorbars; use add_colorbar")
+    if ax is None:
+        ax = plt.gca()
+    rgba = layer_rgba(data, cmap, vmin, vmax, alpha, mask)
+    nrows, ncols = rgba.shape[:2]
+
+    image = next((im for im in ax.images if im.get_gid() == COMPOSITE_GID), None)
+    if image is None:
+        rgb = np.empty((nrows, ncols, 3), dtype=np.float32)
+        rgb[:] = BACKGROUND
+        image = ax.imshow(
+            blend(rgb, rgba),
+            interpolation="nearest",
+            extent=(0, ncols, nrows, 0),
+        )
+        image.set_gid(COMPOSITE_GID)
+    else:
+        rgb = np.asarray(image.get_array())
+        if rgb.shape[:2] != (nrows, ncols):
+            raise ValueError(
+                f"Layer shape {(nrows, ncols)} does not match the image already "
+                + f"drawn on this axes {rgb.shape[:2]}"
+            )
+        image.set_data(blend(rgb, rgba))
+    return ax
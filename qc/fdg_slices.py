@@ -1,11 +1,7 @@
 import os
 import sys
-import shutil
 import warnings
-import subprocess
-import numpy as np
 import nibabel as nib
-import seaborn as sns
 import matplotlib.pyplot as plt
 from matplotlib.cm import ScalarMappable
 from nibabel.orientations import io_orientation, axcodes2ornt
@@ -19,16 +15,13 @@ sys.path.append(rablab_pkg_path)
 
 from plotter import QCImageGenerator
 from processing import ImageProcessor
+import compositor
+import reslicer
+from qc_session import QCSession
 
 #  ________________________________________________________________ FILE PATHS _______________________________________________________________ #
 tpm_file = os.path.join(rablab_pkg_path,'TPM.nii')
 
-rtpm_path = os.path.join(rablab_pkg_path, 'reslice', 'rT1.nii') # Resliced T1 file to 1mm isotropic resolution
-reslice_matlab_script = os.path.join(rablab_pkg_path,'reslice', 'reslice.m')
-
-mask_reslice_matlab_script = os.path.join(rablab_pkg_path, 'reslice', 'mask_reslice.m')
-
-tmp_folder = os.path.join('/mnt/tmp-scratch/')
 #  _____________________________________________________________ CUSTOM COLORMAPS _____________________________________________________________ #
 # Notes: 
 # 1. The custom colormaps are created using the LinearSegmentedColormap class from matplotlib.colors.
@@ -147,7 +140,7 @@ class FDGQCplots:
                  reference_region_1 = None, reference_region_2 = None, reference_region_3 = None,
                  affine_nu_img = None, affine_suvr_img = None,
                  warped_nu_img=None, warped_suvr_img = None,
-                 crop_neck = True):
+                 crop_neck = True, session=None):
         
         self.suvr_img = suvr_img
         
@@ -170,6 +163,9 @@ class FDGQCplots:
 
         self.crop_neck = crop_neck
 
+        # MRI volumes are shared with other QC plots through the session
+        self.session = session if session is not None else QCSession()
+
         if self.crop_neck and self.aparc_img is None:
             self.crop_neck = False
             warnings.warn("The aparc_img is not provided. The neck will not be cropped.", UserWarning)
@@ -186,141 +182,17 @@ class FDGQCplots:
         img = img.as_reoriented(img_ornt)
         return img.get_fdata()
 
-    def generate_matlab_script(self, path, output_script_path):
-        """
-        This function generates a MATLAB script to reslice the image.
-        """
-        #with open('/home/mac/pmaiti/Desktop/leads_qc/reslice_test/reslice.m', 'r') as template_file:
-        with open(reslice_matlab_script, 'r') as template_file:
-            script_content = template_file.read()
-
-        # Replace placeholders with actual paths
-        script_content = script_content.replace('<RTPM_PATH>', rtpm_path)
-        script_content = script_content.replace('<DATA_PATH>', path)
-        
-        # Write the modified script to the output path
-        with open(output_script_path, 'w') as script_file:
-            script_file.write(script_content)
-
-
-    def generate_mask_reslice_mtlb(self, path, output_script_path):
-        """
-        This function generates a MATLAB script to reslice the mask image.
-        """
-        #with open('/home/mac/pmaiti/Desktop/leads_qc/reslice_test/mask_reslice.m', 'r') as template_file:
-        with open(mask_reslice_matlab_script, 'r') as template_file:
-            script_content = template_file.read()
-
-        script_content = script_content.replace('<RTPM_PATH>', rtpm_path)
-        script_content = script_content.replace('<DATA_PATH>', path)
-        
-        # Write the modified script to the output path
-        with open(output_script_path, 'w') as script_file:
-            script_file.write(script_content)
-
-
     def load_nii_resliced(self, path, orientation="LAS", mask=False):
         """
-        Load nifti image with specified orientation
+        Load nifti image resliced to the QC template grid (see reslicer.py)
         """
-        
-        id = path.split('/')[-1].split('.')[0]
-
-        resliced_image_path = os.path.join(tmp_folder, id, 'qc' + id + '.nii')
-        
-        if not os.path.exists(resliced_image_path):
-            
-            # Check if the temporary folder with the id exists
-            tmp_id_folder = os.path.join(tmp_folder, id)
-            if not os.path.exists(tmp_id_folder):
-                os.makedirs(tmp_id_folder)
-            
-            # Copy the image to the temporary id folder
-            tmp_file = os.path.join(tmp_id_folder, id + '.nii')
-            shutil.copy2(path, tmp_file)
-            print(tmp_file)
-            
-            if mask:
-                output_script_path = os.path.join(tmp_id_folder, 'mask_reslice.m')
-                self.generate_mask_reslice_mtlb(tmp_file, output_script_path)
-            else:
-                output_script_path = os.path.join(tmp_id_folder, 'reslice.m')
-                self.generate_matlab_script(tmp_file, output_script_path)
-                
-            # Command to run the MATLAB script
-            command = f"matlab -nodisplay -nosplash -r \"run('{output_script_path}');exit;\""
-            
-            # Run the command
-            matprocess = subprocess.run(command, shell=True, capture_output=True, text=True)
-            print("Output:\n", matprocess.stdout)
+        return reslicer.load_nii_resliced(path, orientation, mask=mask)
 
-        else:
-            print("Resliced image exists for ", id, ". Loading the resliced image...")
-            
-        img = nib.load(resliced_image_path)
-        img_ornt = io_orientation(img.affine)
-        new_ornt = axcodes2ornt(orientation)
-        img = img.as_reoriented(img_ornt)
-        return img.get_fdata()
-    
-    def load_c1_nii_resliced(self,path, orientation="LAS"):
+    def load_c1_nii_resliced(self, path, orientation="LAS"):
         """
-        Load nifti image with specified orientation
+        Load c1 image as a binary mask resliced to the QC template grid (see reslicer.py)
         """
-        id = path.split('/')[-1].split('.')[0]
-
-        reslice_mask_path = os.path.join(tmp_folder, id, 'qc'+"mask_"+id+".nii")
-        
-        if not os.path.exists(reslice_mask_path):
-            
-            # Check if the temporary folder with the id exists
-            tmp_id_folder = os.path.join(tmp_folder, id)
-            if not os.path.exists(tmp_id_folder):
-                os.makedirs(tmp_id_folder)
-            
-            # Copy the image to the temporary id folder
-            tmp_file = os.path.join(tmp_id_folder, id + '.nii')
-            shutil.copy2(path, tmp_file)
-            print(tmp_file)
-
-            # Loading the nifti image to create a mask of the image
-            img = nib.load(tmp_file)
-            img_data = img.get_fdata()
-            img_affine = img.affine
-            img_header = img.header
-
-            # Creating a mask of the image by thresholding
-            # Set values to 1 between the threshold of 0.3 and 1
-            mask = np.zeros_like(img_data)
-            mask[(img_data >= 0.3) & (img_data <= img_data.max())] = 1
-            mask = mask.astype(np.uint8)
-
-            # Save the mask as a nifti image
-            mask_img = nib.Nifti1Image(mask, img_affine, img_header)
-            mask_path = os.path.join(tmp_id_folder,"mask_"+id+".nii")
-            nib.save(mask_img, mask_path)
-            
-            output_script_path = os.path.join(tmp_id_folder, 'mask_reslice.m')
-            
-            self.generate_mask_reslice_mtlb(mask_path, output_script_path)
-            
-            # Command to run the MATLAB script
-            command = f"matlab -nodisplay -nosplash -r \"run('{output_script_path}');exit;\""
-            
-            # Run the command
-            matprocess = subprocess.run(command, shell=True, capture_output=True, text=True)
-            print("Output:\n", matprocess.stdout)
-
-        else:
-            print("Resliced image already exists for ", id, ". Loading the resliced image...")
-            
-        # Resliced mask path
-        img = nib.load(reslice_mask_path)
-        img_ornt = io_orientation(img.affine)
-        new_ornt = axcodes2ornt(orientation)
-        img = img.as_reoriented(img_ornt)
-        return img.get_fdata()
-    
+        return reslicer.load_c1_nii_resliced(path, orientation)
 
     def load_images(self):
         """
@@ -343,31 +215,31 @@ class FDGQCplots:
 
         if self.nu_img is not None:
             self.nu_img_filename = os.path.basename(self.nu_img)
-            self.nu_img = self.load_nii_resliced(self.nu_img)
+            self.nu_img = self.session.load_nii_resliced(self.nu_img)
 
         if self.aparc_img is not None:
             self.aparc_img_filename = os.path.basename(self.aparc_img)
-            self.aparc_img = self.load_nii_resliced(self.aparc_img, mask=True)
+            self.aparc_img = self.session.load_nii_resliced(self.aparc_img, mask=True)
 
         if self.c1_img is not None:
             self.c1_img_filename = os.path.basename(self.c1_img)
-            self.c1_img = self.load_c1_nii_resliced(self.c1_img)
+            self.c1_img = self.session.load_c1_nii_resliced(self.c1_img)
 
         if self.reference_region_1 is not None:
             self.reference_region_1_filename = os.path.basename(self.reference_region_1)
-            self.reference_region_1 = self.load_nii_resliced(self.reference_region_1, mask=True)
+            self.reference_region_1 = self.session.load_nii_resliced(self.reference_region_1, mask=True)
 
         if self.reference_region_2 is not None:
             self.reference_region_2_filename = os.path.basename(self.reference_region_2)
-            self.reference_region_2 = self.load_nii_resliced(self.reference_region_2, mask=True)
+            self.reference_region_2 = self.session.load_nii_resliced(self.reference_region_2, mask=True)
 
         if self.reference_region_3 is not None:
             self.reference_region_3_filename = os.path.basename(self.reference_region_3)
-            self.reference_region_3 = self.load_nii_resliced(self.reference_region_3, mask=True)
+            self.reference_region_3 = self.session.load_nii_resliced(self.reference_region_3, mask=True)
 
         if self.affine_nu_img is not None:
             self.affine_nu_img_filename = os.path.basename(self.affine_nu_img)
-            self.affine_nu_img = self.load_nii(self.affine_nu_img)
+            self.affine_nu_img = self.session.load_nii(self.affine_nu_img)
 
         if self.affine_suvr_img is not None:
             self.affine_suvr_img_filename = os.path.basename(self.affine_suvr_img)
@@ -375,7 +247,7 @@ class FDGQCplots:
 
         if self.warped_nu_img is not None:
             self.warped_nu_img_filename = os.path.basename(self.warped_nu_img)
-            self.warped_nu_img = self.load_nii(self.warped_nu_img)
+            self.warped_nu_img = self.session.load_nii(self.warped_nu_img)
 
         if self.warped_suvr_img is not None:
             self.warped_suvr_img_filename = os.path.basename(self.warped_suvr_img)
@@ -555,7 +427,7 @@ class FDGQCplots:
         """
         This function plots the suvr_img slices.
         """
-        sns.heatmap(self.suvr_img_slices(), cmap=cmap_turbo, vmin=0.1, vmax =pet_vmax , cbar=False, ax=axes)
+        compositor.heatmap(self.suvr_img_slices(), cmap=cmap_turbo, vmin=0.1, vmax =pet_vmax , cbar=False, ax=axes)
         axes.text(10, 30, 'L', fontsize=10, color='white')
         axes.text(150, 30, 'R', fontsize=10, color='white')
         axes.set_title(f" {self.suvr_img_filename}", fontsize=10, color='white', loc='left')
@@ -567,9 +439,9 @@ class FDGQCplots:
         This functions plots only the nu_img slices
         """
         # Plotting the nu_img slices
-        sns.heatmap(self.nu_img_slices(), cmap='gray', vmax=mri_vmax, cbar=False, ax=axes) 
+        compositor.heatmap(self.nu_img_slices(), cmap='gray', vmax=mri_vmax, cbar=False, ax=axes) 
         # Plotting the lines representing the slices
-        sns.heatmap(self.nu_img_lines(), cmap=cmap_yellow2, vmin=0.5, cbar=False, ax=axes)
+        compositor.heatmap(self.nu_img_lines(), cmap=cmap_yellow2, vmin=0.5, cbar=False, ax=axes)
         axes.text(10, 30, 'L', fontsize=10, color='white')
         axes.text(150, 30, 'R', fontsize=10, color='white')
         axes.set_title(f"{self.nu_img_filename}", fontsize=10, color='white', loc='left')
@@ -581,7 +453,7 @@ class FDGQCplots:
         This functions plots the mri_based_suvr_img_slices
         """
         
-        sns.heatmap(self.mri_based_suvr_img_slices(), cmap=cmap_turbo, vmin=0.1, vmax =pet_vmax , cbar=False, ax=axes)
+        compositor.heatmap(self.mri_based_suvr_img_slices(), cmap=cmap_turbo, vmin=0.1, vmax =pet_vmax , cbar=False, ax=axes)
         axes.set_title(f" {self.suvr_img_filename}", fontsize=10, color='white', loc='left')
         axes.axis('off')
         axes.set_aspect('equal')
@@ -591,16 +463,16 @@ class FDGQCplots:
         This functions plots the mri_based_suvr_img_slices
         """
         
-        sns.heatmap(self.nu_img_slices(), cmap='gray', vmax = mri_vmax, cbar=False, ax=axes)
-        sns.heatmap(self.mri_based_suvr_img_slices(), cmap=cmap_turbo, vmin=0.1, vmax =pet_vmax , cbar=False, alpha = 0.6, mask=self.mri_based_suvr_img_slices()==0, ax=axes)
+        compositor.heatmap(self.nu_img_slices(), cmap='gray', vmax = mri_vmax, cbar=False, ax=axes)
+        compositor.heatmap(self.mri_based_suvr_img_slices(), cmap=cmap_turbo, vmin=0.1, vmax =pet_vmax , cbar=False, alpha = 0.6, mask=self.mri_based_suvr_img_slices()==0, ax=axes)
         axes.set_title(f" Underlay: {self.nu_img_filename} \n Overlay: {self.suvr_img_filename}", fontsize=10, color='white', loc='left')
         axes.axis('off')
         axes.set_aspect('equal')
 
     def plot_c1_img_slices(self, axes):
 
-        sns.heatmap(self.mri_based_suvr_img_slices(), cmap="gray", vmin=0.1, vmax=pet_vmax, cbar=False, ax=axes)
-        sns.heatmap(self.c1_image_slices(), cmap=cmap_red, vmax=1, mask=(self.c1_image_slices())==0, cbar=False, ax=axes)
+        compositor.heatmap(self.mri_based_suvr_img_slices(), cmap="gray", vmin=0.1, vmax=pet_vmax, cbar=False, ax=axes)
+        compositor.heatmap(self.c1_image_slices(), cmap=cmap_red, vmax=1, mask=(self.c1_image_slices())==0, cbar=False, ax=axes)
         axes.set_title(f" Underlay: {self.suvr_img_filename} \n Overlay: {self.c1_img_filename} (voxels > 0.3)", fontsize=10, color='white', loc='left')
         axes.axis('off')
         axes.set_aspect('equal')
@@ -608,10 +480,10 @@ class FDGQCplots:
     def plot_reference_region_slices(self, axes):
         pons_ref_slices = self.reference_region_slices(self.reference_region_1)
 
-        sns.heatmap(self.nu_img_slices(), cmap='gray', vmax=mri_vmax, cbar=False, ax=axes)
+        compositor.heatmap(self.nu_img_slices(), cmap='gray', vmax=mri_vmax, cbar=False, ax=axes)
 
-        sns.heatmap(pons_ref_slices, cmap=cmap_orange, vmin=0.1, alpha=0.3, cbar=False, mask=pons_ref_slices==0, ax=axes)
-        sns.heatmap(ImageProcessor.contour_image(ImageProcessor.mask_image(pons_ref_slices, lower_threshold = 0.1, upper_threshold=pons_ref_slices.max())), cbar = False, cmap = cmap_orange, vmin = 0.1, ax = axes)
+        compositor.heatmap(pons_ref_slices, cmap=cmap_orange, vmin=0.1, alpha=0.3, cbar=False, mask=pons_ref_slices==0, ax=axes)
+        compositor.heatmap(ImageProcessor.contour_image(ImageProcessor.mask_image(pons_ref_slices, lower_threshold = 0.1, upper_threshold=pons_ref_slices.max())), cbar = False, cmap = cmap_orange, vmin = 0.1, ax = axes)
 
         axes.set_title(f" Underlay: {self.nu_img_filename} \n Overlay: {self.reference_region_1_filename}", fontsize=10, color='white', loc='left')
         axes.axis('off')
@@ -620,9 +492,9 @@ class FDGQCplots:
     def plot_affine_suvr_img_slices(self, axes):
         affine_suvr_slices, afftpm_slices = self.affine_suvr_img_slices()
         ctr_arr = ImageProcessor.contour_image(afftpm_slices)
-        sns.heatmap(affine_suvr_slices, cmap="gray", vmin = 0.1, vmax=pet_vmax, cbar=False, ax=axes)
-        sns.heatmap(afftpm_slices, cmap=cmap_pink, vmin=0.1, alpha=0.1, mask=afftpm_slices==0, cbar=False, ax=axes)
-        sns.heatmap(ctr_arr, cmap=cmap_pink, vmin=0.1, mask=ctr_arr==0, cbar=False,  ax=axes)
+        compositor.heatmap(affine_suvr_slices, cmap="gray", vmin = 0.1, vmax=pet_vmax, cbar=False, ax=axes)
+        compositor.heatmap(afftpm_slices, cmap=cmap_pink, vmin=0.1, alpha=0.1, mask=afftpm_slices==0, cbar=False, ax=axes)
+        compositor.heatmap(ctr_arr, cmap=cmap_pink, vmin=0.1, mask=ctr_arr==0, cbar=False,  ax=axes)
 
         axes.set_title(f" Underlay: {self.affine_suvr_img_filename} \n Overlay: TPM.nii (c1, voxels > 0.3)", fontsize=10, color='white', loc='left')
         axes.axis('off')
@@ -632,9 +504,9 @@ class FDGQCplots:
     def plot_warped_suvr_img_slices(self, axes):
         warped_suvr_slices, wsuvr_tpm_slices = self.warped_suvr_img_slices()
         ctr_arr = ImageProcessor.contour_image(wsuvr_tpm_slices)
-        sns.heatmap(warped_suvr_slices, cmap="gray", vmin = 0.1, vmax=pet_vmax, cbar=False, ax=axes)
-        sns.heatmap(wsuvr_tpm_slices, cmap=cmap_pink, vmin=0.1, mask=wsuvr_tpm_slices==0, alpha=0.1, cbar=False, ax=axes)
-        sns.heatmap(ctr_arr, cmap=cmap_pink, vmin=0.1, mask=ctr_arr==0, cbar=False, ax=axes)
+        compositor.heatmap(warped_suvr_slices, cmap="gray", vmin = 0.1, vmax=pet_vmax, cbar=False, ax=axes)
+        compositor.heatmap(wsuvr_tpm_slices, cmap=cmap_pink, vmin=0.1, mask=wsuvr_tpm_slices==0, alpha=0.1, cbar=False, ax=axes)
+        compositor.heatmap(ctr_arr, cmap=cmap_pink, vmin=0.1, mask=ctr_arr==0, cbar=False, ax=axes)
 
         axes.set_title(f" Underlay: {self.warped_suvr_img_filename} \n Overlay: TPM.nii (c1, voxels > 0.3)", fontsize=10, color='white', loc='left')
         axes.axis('off')
@@ -643,7 +515,7 @@ class FDGQCplots:
     #  _____________________________________________________________ Plotting the slices _____________________________________________________________ #
     def plot_slices(self,output_path):
         """
-        Plotting the slices that are in arrays using seaborn' heatmap function.
+        Plotting the slices that are in arrays, one composited image per row (see compositor.heatmap).
         1. The suvr_img_slices will be plotted as default image.
         2. If the nu_img is provided, the first row will be the nu_img_slices, the second row will be mri_based_suvr_img_slices, and the third row will be the mri_based_suvr_img_slices with the nu_img as underlay.
         3. If the c1_img is provided, the fourth row will be the c1_img_slices.
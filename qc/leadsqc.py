@@ -2,25 +2,44 @@
 
 """
 $ leadsqc.py /home/mac/pmaiti/Desktop/leads_qc/mimic_processed_daniel/LDS1770688/FTP_2024-06-04
+
+Batch mode, for several scans or all processed scans with incomplete QC:
+$ leadsqc.py <scan_dir> <scan_dir> ... [-n N_PROCS] [--report report.csv]
+$ leadsqc.py --incomplete [--proj-dir /mnt/coredata/processing/leads]
+
+In batch mode, scans are grouped by the MRI their QC images are made
+from, and each group is rendered in one worker process of a pool, so
+the MRI volumes are loaded once per group (see qc_session.py).
 """
+
 import os
+import io
 import sys
-import shutil
+import time
 import argparse
-import subprocess
+import contextlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
 
-import nibabel as nib
-from nibabel.orientations import io_orientation
+# QC images are only ever saved to file
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import pandas as pd
 
 # Importing the necessary classes from the rablabqc package
 rablab_pkg_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(rablab_pkg_path)
 
+import qc_evals
 from mri_slices import MRIQCplots
 from fbb_slices import FBBQCplots
 from ftp_slices import FTPQCplots
 from fdg_slices import FDGQCplots
-from slice_selector import SliceSelector
+from reslicer import set_cache
+from qc_session import QCSession
+from reslice_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_GB, ResliceCache
 
 
 def build_parser():
@@ -31,107 +50,77 @@ def build_parser():
     p.add_argument(
         "path",
         type=str,
-        help="Path to the modality directory containing the MRI and PET files",
+        nargs="*",
+        help=(
+            "Path to the modality directory containing the MRI and PET files.\n"
+            + "Pass several to render them in batch mode"
+        ),
+    )
+    p.add_argument(
+        "--incomplete",
+        action="store_true",
+        help=(
+            "Render QC images for every processed scan in --proj-dir whose QC\n"
+            + "eval is incomplete (see qc_evals.py)"
+        ),
+    )
+    p.add_argument(
+        "--proj-dir",
+        type=str,
+        default="/mnt/coredata/processing/leads",
+        help="Top-level project directory used with --incomplete (default: %(default)s)",
+    )
+    p.add_argument(
+        "-n",
+        "--n-procs",
+        type=int,
+        default=None,
+        help="Number of worker processes in batch mode (default: number of CPUs, up to 8)",
+    )
+    p.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="Save the per-scan status and timing of a batch run to this CSV file",
+    )
+    p.add_argument(
+        "--log-dir",
+        type=str,
+        default=None,
+        help="Save the output of each scan in a batch run to <log-dir>/<scan_tag>_qc.log",
+    )
+    p.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory to cache resliced images in. Pass '' to turn caching off\n"
+            + f"(default: $LEADS_QC_CACHE_DIR, or {DEFAULT_CACHE_DIR})"
+        ),
+    )
+    p.add_argument(
+        "--cache-gb",
+        type=float,
+        default=None,
+        help=(
+            "Size limit of the cache in GB; least recently used images are\n"
+            + f"deleted beyond it (default: $LEADS_QC_CACHE_GB, or {DEFAULT_MAX_GB})"
+        ),
     )
     return p
 
 
-# Functions to Load Images
-rtpm_path = os.path.join(
-    rablab_pkg_path, "reslice", "rT1.nii"
-)  # Resliced T1 file to 1mm isotropic resolution
-reslice_matlab_script = os.path.join(rablab_pkg_path, "reslice", "reslice.m")
-
-mask_reslice_matlab_script = os.path.join(rablab_pkg_path, "reslice", "mask_reslice.m")
-
-tmp_folder = os.path.join('/mnt/tmp-scratch/')
-
-
-def generate_matlab_script(path, output_script_path):
-    """
-    This function generates a MATLAB script to reslice the image.
-    """
-
-    with open(reslice_matlab_script, "r") as template_file:
-        script_content = template_file.read()
-
-    script_content = script_content.replace("<RTPM_PATH>", rtpm_path)
-    script_content = script_content.replace("<DATA_PATH>", path)
-
-    with open(output_script_path, "w") as script_file:
-        script_file.write(script_content)
-
-
-def generate_mask_reslice_mtlb(path, output_script_path):
-    """
-    This function generates a MATLAB script to reslice the mask image.
+# _______________________________________________ Function to Process Images _______________________________________________
+def process_qc_images(results, modality, session=None):
     """
+    Generate the QC image for one scan directory.
 
-    # with open('/home/mac/pmaiti/Desktop/leads_qc/reslice_test/mask_reslice.m', 'r') as template_file:
-    with open(mask_reslice_matlab_script, "r") as template_file:
-        script_content = template_file.read()
-
-    # Replace placeholders with actual paths
-    script_content = script_content.replace("<RTPM_PATH>", rtpm_path)
-    script_content = script_content.replace("<DATA_PATH>", path)
-
-    # Write the modified script to the output path
-    with open(output_script_path, "w") as script_file:
-        script_file.write(script_content)
-
-
-def load_nii_resliced(path, orientation="LAS", mask=False):
+    MRI volumes and slice selections are taken from session (a QCSession)
+    so that scans sharing an MRI only load it once. A new session is used
+    if none is given.
     """
-    Load nifti image with specified orientation
-    """
-
-    id = path.split("/")[-1].split(".")[0]
-
-    tmp_folder = os.path.join('/mnt/tmp-scratch/')
-
-    resliced_image_path = os.path.join(tmp_folder, id, "qc" + id + ".nii")
-
-    if not os.path.exists(resliced_image_path):
-
-        # Check if the temporary folder with the id exists
-        tmp_id_folder = os.path.join(tmp_folder, id)
-        if not os.path.exists(tmp_id_folder):
-            os.makedirs(tmp_id_folder)
-
-        # Copy the image to the temporary id folder
-        tmp_file = os.path.join(tmp_id_folder, id + ".nii")
-        shutil.copy2(path, tmp_file)
-        print(tmp_file)
-
-        if mask:
-            output_script_path = os.path.join(tmp_id_folder, "mask_reslice.m")
-            generate_mask_reslice_mtlb(tmp_file, output_script_path)
-        else:
-            output_script_path = os.path.join(tmp_id_folder, "reslice.m")
-            generate_matlab_script(tmp_file, output_script_path)
-
-        # Command to run the MATLAB script
-        command = (
-            f"matlab -nodisplay -nosplash -r \"run('{output_script_path}');exit;\""
-        )
-
-        # Run the command
-        matprocess = subprocess.run(command, shell=True, capture_output=True, text=True)
-        print("Output:\n", matprocess.stdout)
-
-    else:
-        print(
-            "Resliced image already exists for ", id, ". Loading the resliced image..."
-        )
-
-    img = nib.load(resliced_image_path)
-    img_ornt = io_orientation(img.affine)
-    img = img.as_reoriented(img_ornt)
-    return img.get_fdata()
-
-
-# _______________________________________________ Function to Process Images _______________________________________________
-def process_qc_images(results, modality):
+    if session is None:
+        session = QCSession()
 
     id = (results.path.rstrip("/")).split("/")[-2]
     folder = results.path.rstrip("/").split("/")[-1]
@@ -160,9 +149,7 @@ def process_qc_images(results, modality):
         ):
             print("All the files are present, proceeding with slice selection")
             select_axial_slices, select_coronal_slices, select_sagittal_slices = (
-                SliceSelector(
-                    load_nii_resliced(aparc_aseg_img, mask=True)
-                ).select_leads_slices()
+                session.select_leads_slices(aparc_aseg_img)
             )
             print(
                 "Selected slices for MRI QC : ",
@@ -180,6 +167,7 @@ def process_qc_images(results, modality):
                 axial_slices=select_axial_slices,
                 coronal_slices=select_coronal_slices,
                 sagittal_slices=select_sagittal_slices,
+                session=session,
             ).plot_slices(results.path)
 
             print(" -- MRI QC Image Generated -- ")
@@ -253,9 +241,9 @@ def process_qc_images(results, modality):
         ):
 
             print("All the files are present, proceeding with slice selection")
-            fbb_axial_slices, fbb_coronal_slices, fbb_sagittal_slices = SliceSelector(
-                load_nii_resliced(fbb_aparc_aseg_img, mask=True)
-            ).select_leads_slices()
+            fbb_axial_slices, fbb_coronal_slices, fbb_sagittal_slices = (
+                session.select_leads_slices(fbb_aparc_aseg_img)
+            )
 
             FBBQCplots(
                 suvr_img=fbb_suvr_img,
@@ -272,6 +260,7 @@ def process_qc_images(results, modality):
                 axial_slices=fbb_axial_slices,
                 coronal_slices=fbb_coronal_slices,
                 sagittal_slices=fbb_sagittal_slices,
+                session=session,
             ).plot_slices(results.path)
 
             print(" -- FBB QC Image Generated -- ")
@@ -342,9 +331,9 @@ def process_qc_images(results, modality):
         ):
 
             print("All the files are present, proceeding with slice selection")
-            ftp_axial_slices, ftp_coronal_slices, ftp_sagittal_slices = SliceSelector(
-                load_nii_resliced(ftp_aparc_aseg_img, mask=True)
-            ).select_leads_slices()
+            ftp_axial_slices, ftp_coronal_slices, ftp_sagittal_slices = (
+                session.select_leads_slices(ftp_aparc_aseg_img)
+            )
 
             FTPQCplots(
                 suvr_img=ftp_suvr_img,
@@ -360,6 +349,7 @@ def process_qc_images(results, modality):
                 axial_slices=ftp_axial_slices,
                 coronal_slices=ftp_coronal_slices,
                 sagittal_slices=ftp_sagittal_slices,
+                session=session,
             ).plot_slices(results.path)
 
             print(" -- FTP QC Image Generated -- ")
@@ -425,9 +415,9 @@ def process_qc_images(results, modality):
         ):
 
             print("All the files are present, proceeding with slice selection")
-            fdg_axial_slices, fdg_coronal_slices, fdg_sagittal_slices = SliceSelector(
-                load_nii_resliced(fdg_aparc_aseg_img, mask=True)
-            ).select_leads_slices()
+            fdg_axial_slices, fdg_coronal_slices, fdg_sagittal_slices = (
+                session.select_leads_slices(fdg_aparc_aseg_img)
+            )
 
             FDGQCplots(
                 suvr_img=fdg_suvr_img,
@@ -442,6 +432,7 @@ def process_qc_images(results, modality):
                 axial_slices=fdg_axial_slices,
                 coronal_slices=fdg_coronal_slices,
                 sagittal_slices=fdg_sagittal_slices,
+                session=session,
             ).plot_slices(results.path)
 
             print(" -- FDG QC Image Generated -- ")
@@ -451,11 +442,274 @@ def process_qc_images(results, modality):
             return
 
 
+def configure_cache(cache_dir=None, cache_gb=None):
+    """
+    Set the reslice cache from command line options, falling back to the
+    environment for options that are None. An empty cache_dir turns
+    caching off.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get("LEADS_QC_CACHE_DIR", DEFAULT_CACHE_DIR)
+    if cache_gb is None:
+        cache_gb = float(os.environ.get("LEADS_QC_CACHE_GB", DEFAULT_MAX_GB))
+    if cache_dir:
+        set_cache(ResliceCache(cache_dir, int(cache_gb * 1024**3)))
+    else:
+        set_cache(None)
+
+
+# _______________________________________________ Batch Processing _______________________________________________
+MODALITIES = {"MRI-T1": "MRI", "FBB": "FBB", "FTP": "FTP", "FDG": "FDG"}
+
+
+def get_modality(scan_dir):
+    """
+    Return the QC modality (MRI, FBB, FTP or FDG) of a scan directory.
+    """
+    prefix = os.path.basename(scan_dir.rstrip("/")).split("_")[0]
+    if prefix not in MODALITIES:
+        raise ValueError(f"Modality {prefix} not recognized! Cannot generate QC image")
+    return MODALITIES[prefix]
+
+
+def get_mri_dir(scan_dir):
+    """
+    Return the MRI directory that a scan's QC image is made from.
+
+    This is the scan directory itself for MRIs, and the target of the
+    mri link for PET scans.
+    """
+    if get_modality(scan_dir) == "MRI":
+        return os.path.realpath(scan_dir)
+    return os.path.realpath(os.path.join(scan_dir, "mri"))
+
+
+def group_by_mri(scan_dirs):
+    """
+    Group scan directories by the MRI their QC images are made from.
+
+    Returns
+    -------
+    dict
+        {mri_dir: [scan_dir, ...]}, with the MRI itself (if included)
+        first in each group.
+    """
+    groups = {}
+    for scan_dir in scan_dirs:
+        groups.setdefault(get_mri_dir(scan_dir), []).append(scan_dir)
+    for scan_dirs in groups.values():
+        scan_dirs.sort(key=lambda d: (get_modality(d) != "MRI", os.path.basename(d)))
+    return groups
+
+
+def render_scans(scan_dirs, log_dir=None):
+    """
+    Generate QC images for scans that share an MRI, in one QCSession.
+
+    Parameters
+    ----------
+    scan_dirs : list of str
+        Scan directories to render, in order.
+    log_dir : str or None
+        If given, the output of each scan is saved to
+        <log_dir>/<scan_tag>_qc.log.
+
+    Returns
+    -------
+    list of dict
+        One row per scan with scan_dir, modality, status ('ok',
+        'skipped' if QC inputs were missing, or 'failed'), seconds, and
+        message.
+    """
+    session = QCSession()
+    rows = []
+    for scan_dir in scan_dirs:
+        start = time.time()
+        output = io.StringIO()
+        status = "ok"
+        message = ""
+        modality = None
+        try:
+            modality = get_modality(scan_dir)
+            with contextlib.redirect_stdout(output):
+                process_qc_images(argparse.Namespace(path=scan_dir), modality, session)
+        except Exception as e:
+            status = "failed"
+            message = f"{type(e).__name__}: {e}"
+            output.write(traceback.format_exc())
+        finally:
+            plt.close("all")
+
+        if status == "ok":
+            # process_qc_images returns without an image if inputs are missing
+            qc_png_file = qc_evals.get_qc_png_file(scan_dir)
+            if qc_png_file is None or os.stat(qc_png_file).st_mtime < start - 1:
+                status = "skipped"
+                lines = output.getvalue().strip().splitlines()
+                message = lines[-1] if lines else "No QC image was saved"
+
+        if log_dir is not None:
+            log_file = os.path.join(
+                log_dir,
+                os.path.basename(os.path.dirname(scan_dir))
+                + "_"
+                + os.path.basename(scan_dir)
+                + "_qc.log",
+            )
+            with open(log_file, "w") as f:
+                f.write(output.getvalue())
+
+        rows.append(
+            {
+                "scan_dir": scan_dir,
+                "modality": modality,
+                "status": status,
+                "seconds": round(time.time() - start, 1),
+                "message": message,
+            }
+        )
+    return rows
+
+
+def _init_worker(cache_dir, cache_gb):
+    """Configure the reslice cache in a batch worker process."""
+    if cache_dir is not None or cache_gb is not None:
+        configure_cache(cache_dir, cache_gb)
+
+
+def run_batch(scan_dirs, n_procs=None, cache_dir=None, cache_gb=None, log_dir=None):
+    """
+    Generate QC images for many scans in a pool of worker processes.
+
+    Scans are grouped by MRI (see group_by_mri) and each group is
+    rendered by one worker, largest groups first.
+
+    Parameters
+    ----------
+    scan_dirs : list of str
+        Scan directories to render.
+    n_procs : int or None
+        Number of worker processes. Defaults to the number of CPUs, up
+        to 8.
+    cache_dir, cache_gb : str, float, or None
+        Reslice cache options passed to configure_cache in each worker.
+    log_dir : str or None
+        Directory to save the output of each scan to.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per scan (see render_scans).
+    """
+    if n_procs is None:
+        n_procs = min(8, os.cpu_count())
+    if log_dir is not None:
+        os.makedirs(log_dir, exist_ok=True)
+
+    rows = []
+    valid_scan_dirs = []
+    for scan_dir in scan_dirs:
+        try:
+            get_modality(scan_dir)
+        except ValueError as e:
+            rows.append(
+                {
+                    "scan_dir": scan_dir,
+                    "modality": None,
+                    "status": "failed",
+                    "seconds": 0.0,
+                    "message": str(e),
+                }
+            )
+            continue
+        valid_scan_dirs.append(scan_dir)
+    groups = group_by_mri(valid_scan_dirs)
+    n_scans = sum(len(group) for group in groups.values())
+    print(
+        f"  * Generating QC images for {n_scans:,} scans using {len(groups):,} MRIs "
+        + f"across {n_procs} processes"
+    )
+
+    start = time.time()
+    with ProcessPoolExecutor(
+        max_workers=n_procs, initializer=_init_worker, initargs=(cache_dir, cache_gb)
+    ) as executor:
+        future_to_group = {
+            executor.submit(render_scans, group, log_dir): group
+            for group in sorted(groups.values(), key=len, reverse=True)
+        }
+        for future in as_completed(future_to_group):
+            try:
+                group_rows = future.result()
+            except Exception as e:
+                group_rows = [
+                    {
+                        "scan_dir": scan_dir,
+                        "modality": get_modality(scan_dir),
+                        "status": "failed",
+                        "seconds": 0.0,
+                        "message": f"Worker failed: {type(e).__name__}: {e}",
+                    }
+                    for scan_dir in future_to_group[future]
+                ]
+            for row in group_rows:
+                if row["status"] == "ok":
+                    print(f"    - {row['scan_dir']} ({row['seconds']:.1f}s)")
+                else:
+                    print(
+                        f"!!  - {row['scan_dir']} {row['status'].upper()}: {row['message']}"
+                    )
+            rows.extend(group_rows)
+    elapsed = time.time() - start
+
+    report = pd.DataFrame(
+        rows, columns=["scan_dir", "modality", "status", "seconds", "message"]
+    )
+    counts = report["status"].value_counts()
+    ok_seconds = report.loc[report["status"] == "ok", "seconds"]
+    print(
+        f"  * {counts.get('ok', 0):,} QC images generated, {counts.get('skipped', 0):,} skipped, "
+        + f"{counts.get('failed', 0):,} failed in {elapsed:.1f}s"
+        + (
+            f" ({ok_seconds.mean():.1f}s per image per process)"
+            if len(ok_seconds)
+            else ""
+        )
+    )
+    return report
+
+
 def main():
     parser = build_parser()
     results = parser.parse_args()
-    results.path = os.path.abspath(results.path)
+    if results.cache_dir is not None or results.cache_gb is not None:
+        configure_cache(results.cache_dir, results.cache_gb)
+
+    scan_dirs = [os.path.abspath(path) for path in results.path]
+    if results.incomplete:
+        incomplete = qc_evals.find_scans_with_incomplete_qc(results.proj_dir)
+        scan_dirs += [d for scan_type in incomplete for d in incomplete[scan_type]]
+    if len(scan_dirs) == 0:
+        parser.error("Pass one or more scan directories, or --incomplete")
+
+    if len(scan_dirs) > 1 or results.incomplete:
+        missing = [d for d in scan_dirs if not os.path.isdir(d)]
+        for scan_dir in missing:
+            print(f"Error: Input path {scan_dir} does not exist.")
+        scan_dirs = list(dict.fromkeys(d for d in scan_dirs if d not in missing))
+        report = run_batch(
+            scan_dirs,
+            n_procs=results.n_procs,
+            cache_dir=results.cache_dir,
+            cache_gb=results.cache_gb,
+            log_dir=results.log_dir,
+        )
+        if results.report is not None:
+            report.to_csv(results.report, index=False)
+            print(f"  * Saved {results.report}")
+        return
 
+    results.path = scan_dirs[0]
     if not os.path.exists(results.path):
         print("Error: Input path does not exist.")
         return
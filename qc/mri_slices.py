@@ -1,13 +1,9 @@
 import os
-import shutil
-import subprocess
 import sys
 import warnings
 
 import matplotlib.pyplot as plt
 import nibabel as nib
-import numpy as np
-import seaborn as sns
 from matplotlib.colors import LinearSegmentedColormap
 from nibabel.orientations import axcodes2ornt, io_orientation
 
@@ -18,18 +14,13 @@ sys.path.append(rablab_pkg_path)
 
 from plotter import QCImageGenerator
 from processing import ImageProcessor
+import compositor
+import reslicer
+from qc_session import QCSession
 
 #  ________________________________________________________________ FILE PATHS _______________________________________________________________ #
 tpm_file = os.path.join(rablab_pkg_path, "TPM.nii")
 
-rtpm_path = os.path.join(
-    rablab_pkg_path, "reslice", "rT1.nii"
-)  # Resliced T1 file to 1mm isotropic resolution
-reslice_matlab_script = os.path.join(rablab_pkg_path, "reslice", "reslice.m")
-
-mask_reslice_matlab_script = os.path.join(rablab_pkg_path, "reslice", "mask_reslice.m")
-
-tmp_folder = os.path.join("/mnt/tmp-scratch/")
 #  _____________________________________________________________ CUSTOM COLORMAPS _____________________________________________________________ #
 # Notes:
 # 1. The custom colormaps are created using the LinearSegmentedColormap class from matplotlib.colors.
@@ -105,6 +96,7 @@ class MRIQCplots:
         affine_nu_img=None,
         warped_nu_img=None,
         crop_neck=True,
+        session=None,
     ):
         self.nu_img = nu_img
         self.aparc_img = aparc_img
@@ -118,6 +110,9 @@ class MRIQCplots:
 
         self.crop_neck = crop_neck
 
+        # MRI volumes are shared with other QC plots through the session
+        self.session = session if session is not None else QCSession()
+
         if self.crop_neck and self.aparc_img is None:
             self.crop_neck = False
             warnings.warn(
@@ -137,148 +132,17 @@ class MRIQCplots:
         img = img.as_reoriented(img_ornt)
         return img.get_fdata()
 
-    def generate_matlab_script(self, path, output_script_path):
-        """
-        This function generates a MATLAB script to reslice the image.
-        """
-        # with open('/home/mac/pmaiti/Desktop/leads_qc/reslice_test/reslice.m', 'r') as template_file:
-        with open(reslice_matlab_script, "r") as template_file:
-            script_content = template_file.read()
-
-        # Replace placeholders with actual paths
-        script_content = script_content.replace("<RTPM_PATH>", rtpm_path)
-        script_content = script_content.replace("<DATA_PATH>", path)
-
-        # Write the modified script to the output path
-        with open(output_script_path, "w") as script_file:
-            script_file.write(script_content)
-
-    def generate_mask_reslice_mtlb(self, path, output_script_path):
-        """
-        This function generates a MATLAB script to reslice the mask image.
-        """
-        # with open('/home/mac/pmaiti/Desktop/leads_qc/reslice_test/mask_reslice.m', 'r') as template_file:
-        with open(mask_reslice_matlab_script, "r") as template_file:
-            script_content = template_file.read()
-
-        script_content = script_content.replace("<RTPM_PATH>", rtpm_path)
-        script_content = script_content.replace("<DATA_PATH>", path)
-
-        # Write the modified script to the output path
-        with open(output_script_path, "w") as script_file:
-            script_file.write(script_content)
-
     def load_nii_resliced(self, path, orientation="LAS", mask=False):
         """
-        Load nifti image with specified orientation
+        Load nifti image resliced to the QC template grid (see reslicer.py)
         """
-
-        id = path.split("/")[-1].split(".")[0]
-
-        resliced_image_path = os.path.join(tmp_folder, id, "qc" + id + ".nii")
-
-        if not os.path.exists(resliced_image_path):
-            # Check if the temporary folder with the id exists
-            tmp_id_folder = os.path.join(tmp_folder, id)
-            if not os.path.exists(tmp_id_folder):
-                os.makedirs(tmp_id_folder)
-
-            # Copy the image to the temporary id folder
-            tmp_file = os.path.join(tmp_id_folder, id + ".nii")
-            shutil.copy2(path, tmp_file)
-            print(tmp_file)
-
-            if mask:
-                output_script_path = os.path.join(tmp_id_folder, "mask_reslice.m")
-                self.generate_mask_reslice_mtlb(tmp_file, output_script_path)
-            else:
-                output_script_path = os.path.join(tmp_id_folder, "reslice.m")
-                self.generate_matlab_script(tmp_file, output_script_path)
-
-            # Command to run the MATLAB script
-            command = (
-                f"matlab -nodisplay -nosplash -r \"run('{output_script_path}');exit;\""
-            )
-
-            # Run the command
-            matprocess = subprocess.run(
-                command, shell=True, capture_output=True, text=True
-            )
-            print("Output:\n", matprocess.stdout)
-
-        else:
-            print("Resliced image exists for ", id, ". Loading the resliced image...")
-
-        img = nib.load(resliced_image_path)
-        img_ornt = io_orientation(img.affine)
-        new_ornt = axcodes2ornt(orientation)
-        img = img.as_reoriented(img_ornt)
-        return img.get_fdata()
+        return reslicer.load_nii_resliced(path, orientation, mask=mask)
 
     def load_c1_nii_resliced(self, path, orientation="LAS"):
         """
-        Load nifti image with specified orientation
+        Load c1 image as a binary mask resliced to the QC template grid (see reslicer.py)
         """
-        id = path.split("/")[-1].split(".")[0]
-
-        reslice_mask_path = os.path.join(tmp_folder, id, "qc" + "mask_" + id + ".nii")
-
-        if not os.path.exists(reslice_mask_path):
-            # Check if the temporary folder with the id exists
-            tmp_id_folder = os.path.join(tmp_folder, id)
-            if not os.path.exists(tmp_id_folder):
-                os.makedirs(tmp_id_folder)
-
-            # Copy the image to the temporary id folder
-            tmp_file = os.path.join(tmp_id_folder, id + ".nii")
-            shutil.copy2(path, tmp_file)
-            print(tmp_file)
-
-            # Loading the nifti image to create a mask of the image
-            img = nib.load(tmp_file)
-            img_data = img.get_fdata()
-            img_affine = img.affine
-            img_header = img.header
-
-            # Creating a mask of the image by thresholding
-            # Set values to 1 between the threshold of 0.3 and 1
-            mask = np.zeros_like(img_data)
-            mask[(img_data >= 0.3) & (img_data <= img_data.max())] = 1
-            mask = mask.astype(np.uint8)
-
-            # Save the mask as a nifti image
-            mask_img = nib.Nifti1Image(mask, img_affine, img_header)
-            mask_path = os.path.join(tmp_id_folder, "mask_" + id + ".nii")
-            nib.save(mask_img, mask_path)
-
-            output_script_path = os.path.join(tmp_id_folder, "mask_reslice.m")
-
-            self.generate_mask_reslice_mtlb(mask_path, output_script_path)
-
-            # Command to run the MATLAB script
-            command = (
-                f"matlab -nodisplay -nosplash -r \"run('{output_script_path}');exit;\""
-            )
-
-            # Run the command
-            matprocess = subprocess.run(
-                command, shell=True, capture_output=True, text=True
-            )
-            print("Output:\n", matprocess.stdout)
-
-        else:
-            print(
-                "Resliced image already exists for ",
-                id,
-                ". Loading the resliced image...",
-            )
-
-        # Resliced mask path
-        img = nib.load(reslice_mask_path)
-        img_ornt = io_orientation(img.affine)
-        new_ornt = axcodes2ornt(orientation)
-        img = img.as_reoriented(img_ornt)
-        return img.get_fdata()
+        return reslicer.load_c1_nii_resliced(path, orientation)
 
     def load_images(self):
         """
@@ -296,23 +160,23 @@ class MRIQCplots:
         """
         self.basename = os.path.basename(self.nu_img)
         self.nu_img_filename = os.path.basename(self.nu_img)
-        self.nu_img = self.load_nii_resliced(self.nu_img)
+        self.nu_img = self.session.load_nii_resliced(self.nu_img)
 
         if self.aparc_img is not None:
             self.aparc_img_filename = os.path.basename(self.aparc_img)
-            self.aparc_img = self.load_nii_resliced(self.aparc_img, mask=True)
+            self.aparc_img = self.session.load_nii_resliced(self.aparc_img, mask=True)
 
         if self.c1_img is not None:
             self.c1_img_filename = os.path.basename(self.c1_img)
-            self.c1_img = self.load_c1_nii_resliced(self.c1_img)
+            self.c1_img = self.session.load_c1_nii_resliced(self.c1_img)
 
         if self.affine_nu_img is not None:
             self.affine_nu_img_filename = os.path.basename(self.affine_nu_img)
-            self.affine_nu_img = self.load_nii(self.affine_nu_img)
+            self.affine_nu_img = self.session.load_nii(self.affine_nu_img)
 
         if self.warped_nu_img is not None:
             self.warped_nu_img_filename = os.path.basename(self.warped_nu_img)
-            self.warped_nu_img = self.load_nii(self.warped_nu_img)
+            self.warped_nu_img = self.session.load_nii(self.warped_nu_img)
 
     # ______________________________________________________________________________________________________________________________________________ #
     # The following functions generate the slices for the provided images. The slices are generated using the QCImageGenerator class from the plotter.py file.
@@ -537,11 +401,11 @@ class MRIQCplots:
         This functions plots only the nu_img slices
         """
         # Plotting the nu_img slices
-        sns.heatmap(
+        compositor.heatmap(
             self.nu_img_slices(), cmap="gray", vmax=mri_vmax, cbar=False, ax=axes
         )
         # Plotting the lines representing the slices
-        sns.heatmap(
+        compositor.heatmap(
             self.nu_img_lines(), cmap=cmap_yellow2, vmin=0.5, cbar=False, ax=axes
         )
         axes.text(10, 30, "L", fontsize=10, color="white")
@@ -556,7 +420,7 @@ class MRIQCplots:
         """
         This function the aparc+aseg and the subcortical regions overlaid on the nu_img slices.
         """
-        sns.heatmap(
+        compositor.heatmap(
             self.nu_img_slices(),
             cmap="gray",
             vmin=0,
@@ -564,7 +428,7 @@ class MRIQCplots:
             cbar=False,
             ax=axes[0],
         )
-        sns.heatmap(
+        compositor.heatmap(
             self.nu_img_lines(), cmap=cmap_yellow2, vmin=0.5, cbar=False, ax=axes[0]
         )
         axes[0].text(10, 30, "L", fontsize=10, color="white")
@@ -576,7 +440,7 @@ class MRIQCplots:
         axes[0].set_aspect("equal")  # Set aspect ratio to be equal
 
         # nu MRI image
-        sns.heatmap(
+        compositor.heatmap(
             self.nu_img_slices(),
             cmap="gray",
             vmin=0,
@@ -585,8 +449,8 @@ class MRIQCplots:
             ax=axes[1],
         )
         # Adding the aparc+aseg slices for left hemisphere
-        # sns.heatmap(self.aparc_img_slices(), cmap=cmap_red, vmax=1, mask=self.aparc_img_slices()==0, cbar=False, ax=axes[1])
-        sns.heatmap(
+        # compositor.heatmap(self.aparc_img_slices(), cmap=cmap_red, vmax=1, mask=self.aparc_img_slices()==0, cbar=False, ax=axes[1])
+        compositor.heatmap(
             self.aparc_img_slices_ctx_lh(),
             cmap=cmap_red,
             vmax=1,
@@ -595,7 +459,7 @@ class MRIQCplots:
             ax=axes[1],
         )
         # Adding the aparc+aseg slices for right hemisphere
-        sns.heatmap(
+        compositor.heatmap(
             self.aparc_img_slices_ctx_rh(),
             cmap=cmap_red,
             vmax=1,
@@ -608,7 +472,7 @@ class MRIQCplots:
         subcortical_regions = self.generate_subcortical_slices()
         subcortical_regions_cmap = ["#3EBCD2"]
         for key, value in subcortical_regions.items():
-            sns.heatmap(
+            compositor.heatmap(
                 value,
                 cmap=subcortical_regions_cmap,
                 vmin=0.1,
@@ -620,7 +484,7 @@ class MRIQCplots:
         cblgm_regions = self.generate_cblgm_slices()
         cblgm_regions_cmap = ["#2E45B8"]
         for key, value in cblgm_regions.items():
-            sns.heatmap(
+            compositor.heatmap(
                 value,
                 cmap=cblgm_regions_cmap,
                 vmin=0.1,
@@ -644,7 +508,7 @@ class MRIQCplots:
         overlaid on the nu_img slices.
         """
         # Plotting the nu_img slices
-        sns.heatmap(
+        compositor.heatmap(
             self.nu_img_slices(),
             cmap="gray",
             vmin=0,
@@ -653,7 +517,7 @@ class MRIQCplots:
             ax=axes,
         )
         # Plotting the c1 slices
-        sns.heatmap(
+        compositor.heatmap(
             self.c1_image_slices(),
             cmap=cmap_red,
             vmax=1,
@@ -673,7 +537,7 @@ class MRIQCplots:
     def plot_affine_nu_img_slices(self, axes):
         affine_nu_image_slices, tpm_img_slices = self.affine_nu_img_slices()
 
-        sns.heatmap(
+        compositor.heatmap(
             affine_nu_image_slices,
             cmap="gray",
             vmin=0,
@@ -681,7 +545,7 @@ class MRIQCplots:
             cbar=False,
             ax=axes,
         )
-        sns.heatmap(
+        compositor.heatmap(
             tpm_img_slices,
             cmap=cmap_pink,
             vmax=1,
@@ -691,7 +555,7 @@ class MRIQCplots:
             ax=axes,
         )
         contour_arr = ImageProcessor.contour_image(tpm_img_slices)
-        sns.heatmap(
+        compositor.heatmap(
             contour_arr,
             cmap=cmap_pink,
             vmax=1,
@@ -710,7 +574,7 @@ class MRIQCplots:
 
     def plot_warped_nu_img_slices(self, axes):
         warped_nu_image_slices, wnu_tpm_img_slices = self.warped_nu_img_slices()
-        sns.heatmap(
+        compositor.heatmap(
             warped_nu_image_slices,
             cmap="gray",
             vmin=0,
@@ -718,7 +582,7 @@ class MRIQCplots:
             cbar=False,
             ax=axes,
         )
-        sns.heatmap(
+        compositor.heatmap(
             wnu_tpm_img_slices,
             cmap=cmap_pink,
             vmax=1,
@@ -728,7 +592,7 @@ class MRIQCplots:
             ax=axes,
         )
         contour_arr = ImageProcessor.contour_image(wnu_tpm_img_slices)
-        sns.heatmap(
+        compositor.heatmap(
             contour_arr,
             cmap=cmap_pink,
             vmax=1,
@@ -212,16 +212,11 @@ def check_if_qc_complete(scan_dir):
 def get_processed_scan_dirs(scan_type, proc_dir):
     """Return a list of all processed directories for the scan type."""
     proc_dir = op.abspath(proc_dir)
-    scan_dirs = []
-    with os.scandir(proc_dir) as subj_dirs:
-        for subj_dir in subj_dirs:
-            # Get all directories in the subject directory
-            subj_scan_dirs = [
-                entry.path
-                for entry in os.scandir(subj_dir)
-                if entry.is_dir() and entry.name.startswith(scan_type)
-            ]
-            scan_dirs.extend(subj_scan_dirs)
+    scan_dirs = list(
+        uts.walk_files(
+            proc_dir, pattern=f"{scan_type}*", dirs=True, min_depth=2, max_depth=2
+        )
+    )
     return scan_dirs
 
 
@@ -307,13 +302,14 @@ def find_scans_with_incomplete_qc(
 
         # Find processed vs. unprocessed scans
         if scan_type == "MRI-T1":
-            processed_scans[scan_type] = [
-                d for d in scan_dirs[scan_type] if sstp.check_if_mri_processed(d)
-            ]
+            outputs = sstp.check_mri_outputs(scan_dirs[scan_type])
+            complete = outputs["mri_processing_complete"]
         else:
-            processed_scans[scan_type] = [
-                d for d in scan_dirs[scan_type] if sstp.check_if_pet_processed(d)
-            ]
+            outputs = sstp.check_pet_outputs(scan_dirs[scan_type])
+            complete = outputs["pet_processing_complete"]
+        processed_scans[scan_type] = [
+            d for d in scan_dirs[scan_type] if complete[d] == 1
+        ]
         unprocessed_scans[scan_type] = [
             d for d in scan_dirs[scan_type] if d not in processed_scans[scan_type]
         ]
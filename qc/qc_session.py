@@ -0,0 +1,111 @@
+"""
+Per-process memoization of MRI volumes used in QC images.
+
+FBB, FTP and FDG scans that share an MRI all show the same nu, aparc+aseg,
+c1, affine and warped MRIs and the same MRI reference region masks, and
+their slices are chosen from the same aparc+aseg. A QCSession loads each
+of these once and hands the same (read-only) arrays to every QC plot
+class that asks for them, so a QC run over a subject with three tracers
+does the MRI work once.
+
+Volumes are keyed by path, size and mtime, so a file that is rewritten
+during a long batch run is loaded again. The least recently used volumes
+are dropped once more than max_volumes are held.
+"""
+
+import os
+from collections import OrderedDict
+
+import reslicer
+from slice_selector import SliceSelector
+
+# Enough for every MRI volume used by one scan (nu, aparc+aseg, c1,
+# affine and warped nu, and up to three reference region masks)
+MAX_VOLUMES = 12
+
+
+class QCSession:
+    """
+    Memoizes loaded and resliced MRI volumes and slice selections.
+
+    Parameters
+    ----------
+    max_volumes : int
+        Maximum number of volumes to hold at once.
+    """
+
+    def __init__(self, max_volumes=MAX_VOLUMES):
+        self.max_volumes = max_volumes
+        self._volumes = OrderedDict()
+        self._slices = {}
+        self.n_loaded = 0
+        self.n_reused = 0
+
+    def _file_key(self, path):
+        """Return a key that changes whenever the file at path changes."""
+        st = os.stat(path)
+        return (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+    def _memoize(self, key, load):
+        """Return the volume stored under key, loading it with load() if needed."""
+        if key in self._volumes:
+            self._volumes.move_to_end(key)
+            self.n_reused += 1
+            return self._volumes[key]
+        data = load()
+        data.setflags(write=False)
+        self._volumes[key] = data
+        self.n_loaded += 1
+        while len(self._volumes) > self.max_volumes:
+            self._volumes.popitem(last=False)
+        return data
+
+    def load_nii(self, path):
+        """
+        Load nifti image without reslicing (see reslicer.load_nii)
+        """
+        return self._memoize(
+            ("nii",) + self._file_key(path), lambda: reslicer.load_nii(path)
+        )
+
+    def load_nii_resliced(self, path, mask=False):
+        """
+        Load nifti image resliced to the QC template grid (see reslicer.load_nii_resliced)
+        """
+        return self._memoize(
+            ("resliced", mask) + self._file_key(path),
+            lambda: reslicer.load_nii_resliced(path, mask=mask),
+        )
+
+    def load_c1_nii_resliced(self, path):
+        """
+        Load c1 image as a binary mask resliced to the QC template grid (see reslicer.load_c1_nii_resliced)
+        """
+        return self._memoize(
+            ("c1",) + self._file_key(path),
+            lambda: reslicer.load_c1_nii_resliced(path),
+        )
+
+    def select_leads_slices(self, aparc_path):
+        """
+        Return the axial, coronal and sagittal slices chosen from an aparc+aseg image
+
+        Returns
+        -------
+        tuple of list
+            (axial_slices, coronal_slices, sagittal_slices), as returned by
+            SliceSelector.select_leads_slices.
+        """
+        key = self._file_key(aparc_path)
+        if key not in self._slices:
+            self._slices[key] = SliceSelector(
+                self.load_nii_resliced(aparc_path, mask=True)
+            ).select_leads_slices()
+        else:
+            self.n_reused += 1
+        return tuple(list(slices) for slices in self._slices[key])
+
+    def clear(self):
+        """Drop all memoized volumes and slice selections."""
+        self._volumes.clear()
+        self._slices.clear()
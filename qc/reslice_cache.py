@@ -0,0 +1,185 @@
+"""
+Disk cache of resliced QC volumes.
+
+Resliced volumes are stored as float32 .npy files under the cache
+directory:
+
+    <cache_dir>/<key[:2]>/<key>.npy
+
+The key is a hash of the source image's contents plus everything else
+that determines the result: the template grid (shape and affine), the
+interpolation order, and the threshold applied to c1 masks. Reprocessed
+images therefore never reuse a stale result, and a thresholded mask
+never collides with the plain image it was made from.
+
+Entries are written to a temporary file and renamed into place, so
+concurrent QC jobs can share one cache without reading partial files.
+Each hit refreshes the entry's mtime, and when the cache grows past
+max_bytes the least recently used entries are deleted until it is back
+under LOW_WATER of the limit.
+
+The cache directory and size limit default to the LEADS_QC_CACHE_DIR
+and LEADS_QC_CACHE_GB environment variables. Set LEADS_QC_CACHE_DIR to
+an empty string to turn caching off.
+"""
+
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = "/mnt/tmp-scratch/leads_qc_reslice_cache"
+DEFAULT_MAX_GB = 50
+CACHE_VERSION = 1
+CHUNK_BYTES = 4 * 1024**2
+
+# Fraction of max_bytes to evict down to once the limit is exceeded
+LOW_WATER = 0.9
+
+
+def file_sha1(path):
+    """
+    Return the SHA-1 hex digest of a file's contents.
+    """
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_BYTES):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ResliceCache:
+    """
+    Size-bounded LRU cache of resliced volumes, shared between processes.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory to store cached volumes in. Created if needed.
+    max_bytes : int
+        Total size the cache is allowed to grow to.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_GB * 1024**3):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def source_digest(self, path):
+        """
+        Return the content hash of a source image.
+
+        Hashes are remembered for as long as the file's inode, size and
+        mtime are unchanged, so each file is read once per process.
+        """
+        st = os.stat(path)
+        stamp = (os.path.abspath(path), st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(stamp)
+        if digest is None:
+            digest = file_sha1(path)
+            with self._lock:
+                self._digests[stamp] = digest
+        return digest
+
+    def key(self, path, ref_shape, ref_affine, order, threshold=None):
+        """
+        Return the cache key for reslicing path with the given parameters.
+        """
+        h = hashlib.sha1(f"v{CACHE_VERSION}\n{self.source_digest(path)}\n".encode())
+        h.update(f"{tuple(ref_shape)}\n{order}\n{threshold!r}\n".encode())
+        h.update(np.ascontiguousarray(ref_affine, dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        """Return the file that stores key."""
+        return os.path.join(self.cache_dir, key[:2], key + ".npy")
+
+    def get(self, key):
+        """
+        Return the cached volume for key, or None if it is not cached.
+        """
+        entry = self.entry_path(key)
+        try:
+            data = np.load(entry)
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        return data
+
+    def put(self, key, data):
+        """
+        Store a volume under key, then evict old entries if needed.
+        """
+        entry = self.entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp_entry = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_entry, "wb") as f:
+                np.save(f, np.asarray(data, dtype=np.float32))
+            os.replace(tmp_entry, entry)
+        finally:
+            if os.path.exists(tmp_entry):
+                os.remove(tmp_entry)
+        self.evict()
+
+    def entries(self):
+        """
+        Return (mtime, size, path) for every cached volume.
+        """
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for subdir in os.scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if not entry.name.endswith(".npy"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """
+        Delete least recently used entries if the cache is over max_bytes.
+
+        Returns
+        -------
+        removed : list of str
+            The entries that were deleted.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        if total <= self.max_bytes:
+            return removed
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * LOW_WATER:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed.append(path)
+        return removed
+
+
+def default_cache():
+    """
+    Return a ResliceCache configured from the environment, or None.
+
+    LEADS_QC_CACHE_DIR sets the cache directory (an empty string turns
+    caching off) and LEADS_QC_CACHE_GB sets its size limit.
+    """
+    cache_dir = os.environ.get("LEADS_QC_CACHE_DIR", DEFAULT_CACHE_DIR)
+    if not cache_dir:
+        return None
+    max_gb = float(os.environ.get("LEADS_QC_CACHE_GB", DEFAULT_MAX_GB))
+    return ResliceCache(cache_dir, int(max_gb * 1024**3))
@@ -0,0 +1,265 @@
+"""
+In-process reslicing of images onto the QC template grid.
+
+Every image shown in the QC PNGs is first resampled onto the grid of
+reslice/rT1.nii (1mm isotropic). This used to be done by writing an SPM
+coreg.write batch (reslice.m or mask_reslice.m) and starting MATLAB for
+each image. Here the same resampling is done with NumPy and SciPy:
+
+- The voxel-to-voxel affine is inv(source affine) @ template affine,
+  taken from the NIfTI headers exactly as SPM does.
+- order=1 matches coreg.write with interp=1 (trilinear) and order=0
+  matches interp=0 (nearest neighbour, rounding half up like SPM).
+- As with mask=0 and no wrapping, voxels that fall outside the source
+  field of view are set to 0.
+
+Resliced volumes are float32 and are kept in a ResliceCache (see
+reslice_cache.py) so that repeat QC runs skip the resampling.
+"""
+
+import os
+import warnings
+from functools import lru_cache
+
+import numpy as np
+import nibabel as nib
+from nibabel.orientations import io_orientation
+from scipy import ndimage
+
+from reslice_cache import default_cache
+
+rablab_pkg_path = os.path.dirname(os.path.abspath(__file__))
+
+# Resliced T1 file to 1mm isotropic resolution
+rtpm_path = os.path.join(rablab_pkg_path, "reslice", "rT1.nii")
+
+NEAREST = 0
+TRILINEAR = 1
+
+# SPM samples trilinearly up to this far (in voxels) outside the source volume
+SPM_TINY = 5e-2
+
+# Threshold used to turn c1 (grey matter probability) images into masks
+C1_THRESHOLD = 0.3
+
+_cache = None
+_cache_configured = False
+
+
+def set_cache(cache):
+    """
+    Use cache (a ResliceCache, or None to turn caching off) from now on.
+    """
+    global _cache, _cache_configured
+    _cache = cache
+    _cache_configured = True
+
+
+def get_cache():
+    """
+    Return the ResliceCache in use, or None if caching is off.
+
+    Unless set_cache has been called, the cache is configured from the
+    environment the first time it is needed (see reslice_cache.default_cache).
+    """
+    if not _cache_configured:
+        set_cache(default_cache())
+    return _cache
+
+
+@lru_cache(maxsize=None)
+def load_ref_grid(ref_path=rtpm_path):
+    """
+    Return the shape and affine of the template grid.
+
+    Parameters
+    ----------
+    ref_path : str
+        Path to the template image.
+
+    Returns
+    -------
+    shape : tuple of int
+    affine : numpy.ndarray
+    """
+    ref = nib.load(ref_path)
+    return tuple(ref.shape[:3]), ref.affine
+
+
+def reslice(data, affine, order=TRILINEAR, ref_path=rtpm_path):
+    """
+    Resample a 3D array onto the template grid.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        The 3D image data.
+    affine : numpy.ndarray
+        The 4x4 voxel-to-world affine of data.
+    order : int
+        0 for nearest neighbour or 1 for trilinear interpolation.
+    ref_path : str
+        Path to the template image.
+
+    Returns
+    -------
+    numpy.ndarray
+        The resampled float32 data, in the voxel order of the template.
+    """
+    if order not in (NEAREST, TRILINEAR):
+        raise ValueError(f"order must be {NEAREST} or {TRILINEAR}, not {order}")
+    ref_shape, ref_affine = load_ref_grid(ref_path)
+    vox2vox = np.linalg.solve(affine, ref_affine)
+    data = np.asarray(data, dtype=np.float64)
+
+    resliced = ndimage.affine_transform(
+        data,
+        vox2vox[:3, :3],
+        offset=vox2vox[:3, 3],
+        output_shape=ref_shape,
+        output=np.float32,
+        order=order,
+        mode="nearest",
+    )
+    resliced[~_inside_fov(vox2vox, data.shape, ref_shape, order)] = 0
+    return resliced
+
+
+def _inside_fov(vox2vox, src_shape, ref_shape, order):
+    """
+    Return a boolean array of template voxels that SPM would sample.
+
+    Nearest neighbour sampling keeps voxels whose rounded source
+    coordinates are inside the volume; trilinear sampling keeps voxels
+    within SPM_TINY of it.
+    """
+    if order == NEAREST:
+        lower = [-0.5] * 3
+        upper = [n - 0.5 for n in src_shape]
+    else:
+        lower = [-SPM_TINY] * 3
+        upper = [n - 1 + SPM_TINY for n in src_shape]
+
+    i, j = np.meshgrid(
+        np.arange(ref_shape[0], dtype=np.float32),
+        np.arange(ref_shape[1], dtype=np.float32),
+        indexing="ij",
+    )
+    inside = np.ones(ref_shape, dtype=bool)
+    # Work one template slice at a time to keep memory use low
+    for k in range(ref_shape[2]):
+        for axis in range(3):
+            coord = (
+                vox2vox[axis, 0] * i
+                + vox2vox[axis, 1] * j
+                + (vox2vox[axis, 2] * k + vox2vox[axis, 3])
+            )
+            if order == NEAREST:
+                inside[:, :, k] &= (coord >= lower[axis]) & (coord < upper[axis])
+            else:
+                inside[:, :, k] &= (coord >= lower[axis]) & (coord <= upper[axis])
+    return inside
+
+
+def reslice_nii(path, order=TRILINEAR, threshold=None, ref_path=rtpm_path):
+    """
+    Resample a NIfTI image onto the template grid.
+
+    Parameters
+    ----------
+    path : str
+        Path to the image. Only the first volume of 4D images is used.
+    order : int
+        0 for nearest neighbour or 1 for trilinear interpolation.
+    threshold : float or None
+        If given, the image is binarized (data >= threshold) before it
+        is resampled.
+    ref_path : str
+        Path to the template image.
+
+    Returns
+    -------
+    nibabel.Nifti1Image
+        The resampled image, with the template affine.
+    """
+    ref_shape, ref_affine = load_ref_grid(ref_path)
+    cache = get_cache()
+    if cache is not None:
+        key = cache.key(path, ref_shape, ref_affine, order, threshold)
+        resliced = cache.get(key)
+        if resliced is not None:
+            return nib.Nifti1Image(resliced, ref_affine)
+
+    img = nib.load(path)
+    data = np.asanyarray(img.dataobj)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3] + (-1,))[..., 0]
+    data = data.astype(np.float64)
+    if threshold is not None:
+        data = (data >= threshold).astype(np.float64)
+
+    resliced = reslice(data, img.affine, order, ref_path)
+    if cache is not None:
+        try:
+            cache.put(key, resliced)
+        except OSError as e:
+            warnings.warn(f"Could not cache resliced {path}: {e}", UserWarning)
+    return nib.Nifti1Image(resliced, ref_affine)
+
+
+def load_nii_resliced(path, orientation="LAS", mask=False):
+    """
+    Load nifti image resliced to the QC template grid
+
+    Parameters
+    ----------
+    path : str
+        Path to the image.
+    orientation : str
+        Unused; the image is reoriented to its closest canonical
+        orientation, as before.
+    mask : bool
+        If True, use nearest neighbour interpolation (for label images
+        and masks); otherwise use trilinear interpolation.
+
+    Returns
+    -------
+    numpy.ndarray
+        The resliced image data.
+    """
+    img = reslice_nii(path, order=NEAREST if mask else TRILINEAR)
+    return _reoriented_data(img)
+
+
+def load_c1_nii_resliced(path, orientation="LAS", threshold=C1_THRESHOLD):
+    """
+    Load a c1 image as a binary mask resliced to the QC template grid
+
+    Voxels with values >= threshold are set to 1 and the mask is
+    resliced with nearest neighbour interpolation.
+
+    Returns
+    -------
+    numpy.ndarray
+        The resliced mask.
+    """
+    img = reslice_nii(path, order=NEAREST, threshold=threshold)
+    return _reoriented_data(img)
+
+
+def load_nii(path, orientation="LAS"):
+    """
+    Load nifti image without reslicing, reoriented like load_nii_resliced
+
+    Returns
+    -------
+    numpy.ndarray
+        The image data.
+    """
+    return _reoriented_data(nib.load(path))
+
+
+def _reoriented_data(img):
+    """Return the data of img reoriented to its closest canonical orientation."""
+    img = img.as_reoriented(io_orientation(img.affine))
+    return img.get_fdata()
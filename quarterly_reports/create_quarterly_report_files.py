@@ -11,7 +11,6 @@ import os.path as op
 import re
 import sys
 import time
-import warnings
 
 import numpy as np
 import pandas as pd
@@ -19,6 +18,8 @@ import pandas as pd
 utils_dir = op.join(op.dirname(__file__), "..", "utils")
 if utils_dir not in sys.path:
     sys.path.append(utils_dir)
+import extraction_store as xs
+import scan_index
 import utilities as uts
 
 # Define globals
@@ -86,6 +87,7 @@ class QReport:
             self.paths["extraction"], "quarterly_report_files"
         )
         self.paths["rois"] = op.join(self.paths["extraction"], "internal_roi_files")
+        self.paths["roi_store"] = op.join(self.paths["extraction"], "roi_store")
         self.paths["proc"] = op.join(self.paths["data"], "processed")
 
     def get_report_period(self, report_date=None):
@@ -170,9 +172,9 @@ class QReport:
     def load_processed_pet_index(self):
         """Load the dataframe with all processed PET scans.
 
-        This is the raw_PET_index*.csv file created by
+        This is the latest raw PET index saved by
         `select_scans_to_process.py` in the Setup Module of the
-        processing pipeline.
+        processing pipeline (see scan_index.py).
 
         Creates
         -------
@@ -181,7 +183,7 @@ class QReport:
         self.pet_idx : dict
             Dictionary of processed PET scan dataframes, one per tracer
         """
-        # Load the latest PET index CSV file from scans_to_process
+        # Load the latest PET index from scans_to_process
         keep_cols = [
             "subj",
             "tracer",
@@ -198,10 +200,12 @@ class QReport:
             "abs_days_mri_to_pet",
             "pet_proc_dir",
         ]
-        pet_scan_idx = pd.read_csv(
-            uts.glob_sort_mtime(
-                op.join(self.paths["scans_to_process"], "raw_PET_index*.csv")
-            )[0]
+        pet_scan_idx = scan_index.to_plain_dtypes(
+            scan_index.load_index(
+                self.paths["scans_to_process"],
+                "PET",
+                columns=keep_cols + ["pet_processing_complete"],
+            )
         )
 
         # Remove PET scans that have not been fully processed
@@ -687,6 +691,9 @@ class QReport:
     def load_ref_region_dat(self):
         """Load reference region scaling factors for each tracer.
 
+        Reference region means files are read concurrently and pivoted
+        to wide format together.
+
         Creates
         -------
         self.ref_region_dat : dict
@@ -694,106 +701,69 @@ class QReport:
             factors for each tracer
         """
 
-        def get_ref_region_means(pet_proc_dir):
-            def find_ref_region_means_file(pet_proc_dir):
-                """Return the filepath to the ROI mean CSV file."""
-                subj, tracer, pet_date = uts.parse_scan_tag(
-                    uts.get_scan_tag(pet_proc_dir)
-                )
-                filepath = op.join(
-                    pet_proc_dir,
-                    f"r{subj}_{tracer}_{pet_date}_ref-region-means.csv",
-                )
-                if op.isfile(filepath):
-                    return filepath
-                else:
-                    warnings.warn(f"File not found: {filepath}")
-
-            def load_ref_region_means_file(filepath):
-                """Load and format the ROI extractions CSV file."""
-
-                def scrape_ref_regions(mask_file):
-                    ref_regions = [
-                        op.basename(x).split(".")[0].split("_")[3].split("-")[1]
-                        for x in mask_file.split(";")
-                    ]
-                    if len(ref_regions) > 1:
-                        return "compwm"
-                    else:
-                        return ref_regions[0]
-
-                # Load the CSV file
-                df = pd.read_csv(filepath)
-
-                # Parse the PET proc dir
-                subj, _, pet_date = uts.parse_scan_tag(uts.get_scan_tag(filepath))
-
-                # Add subject_id and pet_date columns
-                df.insert(0, "subject_id", subj)
-                df.insert(1, "pet_date", pet_date)
-                df.insert(
-                    2,
-                    "ref_region",
-                    df["mask_file"].apply(scrape_ref_regions),
-                )
-
-                return df
-
-            def format_ref_region_means(df):
-                """Format ROI extractions dataframe for LEADS quarterly reports."""
-                # Format ROI names
-                df["ref_region"] = df["ref_region"].apply(lambda x: x.replace("-", "_"))
-                df["ref_region"] = df["ref_region"].astype(
-                    pd.CategoricalDtype(df["ref_region"], ordered=True)
-                )
-
-                # Remove unnecessary columns
-                df = df.drop(columns=["image_file", "mask_file", "voxel_count"])
+        def scrape_ref_regions(mask_file):
+            ref_regions = [
+                op.basename(x).split(".")[0].split("_")[3].split("-")[1]
+                for x in mask_file.split(";")
+            ]
+            if len(ref_regions) > 1:
+                return "compwm"
+            else:
+                return ref_regions[0]
+
+        def format_ref_region_means(df):
+            """Format reference region means dataframe for LEADS quarterly reports."""
+            # Format ROI names
+            df["ref_region"] = df["ref_region"].str.replace("-", "_")
+            df["ref_region"] = df["ref_region"].astype(
+                pd.CategoricalDtype(df["ref_region"].unique(), ordered=True)
+            )
 
-                # Rename columns
-                df = df.rename(
-                    columns={
-                        "mean": "ScalingFactor",
-                    }
-                )
+            # Remove unnecessary columns
+            df = df.drop(
+                columns=["image_file", "mask_file", "voxel_count", "source_file"]
+            )
 
-                # Pivot the dataframe from long to wide format
-                df = df.set_index(["subject_id", "pet_date", "ref_region"]).unstack(
-                    "ref_region"
-                )
+            # Rename columns
+            df = df.rename(
+                columns={
+                    "mean": "ScalingFactor",
+                }
+            )
 
-                # Flatten the column index
-                df.columns = ["_".join(col).strip() for col in df.columns.values]
+            # Pivot the dataframe from long to wide format
+            df = df.set_index(["subject_id", "pet_date", "ref_region"]).unstack(
+                "ref_region", sort=False
+            )
 
-                # Reset the index
-                df = df.reset_index()
+            # Flatten the column index
+            df.columns = ["_".join(col).strip() for col in df.columns.values]
 
-                return df
+            # Reset the index
+            df = df.reset_index()
 
-            try:
-                rr_dat = format_ref_region_means(
-                    load_ref_region_means_file(find_ref_region_means_file(pet_proc_dir))
-                )
-                return rr_dat
-            except Exception as e:
-                print(e)
-                return None
+            return df
 
         # Load reference region scaling factors for each tracer
         self.ref_region_dat = {}
         for tracer in self.tracers:
-            self.ref_region_dat[tracer] = pd.concat(
-                list(
-                    self.pet_idx[tracer].apply(
-                        lambda x: get_ref_region_means(x["pet_proc_dir"]), axis=1
-                    )
-                ),
-                ignore_index=True,
+            files = [
+                xs.scan_csv_file(pet_proc_dir, "ref-region-means")
+                for pet_proc_dir in self.pet_idx[tracer]["pet_proc_dir"]
+            ]
+            df = xs.add_scan_columns(
+                xs.load_scan_csvs(files, xs.SCAN_CSV_DTYPES["ref-region-means"])
             )
+            df.insert(2, "ref_region", df["mask_file"].apply(scrape_ref_regions))
+            self.ref_region_dat[tracer] = format_ref_region_means(df)
 
     def load_roi_dat(self):
         """Load ROI extraction means for each tracer.
 
+        ROI extractions are read from the consolidated extraction store,
+        which is first synced with any new or modified ROI extraction
+        files in the processed PET directories.
+
         Creates
         -------
         self.roi_dat : dict
@@ -801,80 +771,37 @@ class QReport:
             factors for each tracer
         """
 
-        def get_roi_extractions(pet_proc_dir, ref_region):
-            def find_roi_extractions_file(pet_proc_dir, ref_region):
-                """Return the filepath to the ROI mean CSV file."""
-                subj, tracer, pet_date = uts.parse_scan_tag(
-                    uts.get_scan_tag(pet_proc_dir)
-                )
-                filepath = op.join(
-                    pet_proc_dir,
-                    f"r{subj}_{tracer}_{pet_date}_suvr-{ref_region}_roi-extractions.csv",
-                )
-                if op.isfile(filepath):
-                    return filepath
-                else:
-                    warnings.warn(f"File not found: {filepath}")
-
-            def load_roi_extractions_file(filepath):
-                """Load and format the ROI extractions CSV file."""
-                # Load the CSV file
-                df = pd.read_csv(filepath)
-
-                # Add subject_id and pet_date columns
-                df.insert(
-                    0,
-                    "subject_id",
-                    df["image_file"].apply(lambda x: op.basename(x).split("_")[0][1:]),
-                )
-                df.insert(
-                    1,
-                    "pet_date",
-                    df["image_file"].apply(lambda x: op.basename(x).split("_")[2]),
-                )
-
-                return df
-
-            def format_roi_extractions(df):
-                """Format ROI extractions dataframe for LEADS quarterly reports."""
-                # Format ROI names
-                df["roi"] = df["roi"].apply(lambda x: x.replace("-", "_"))
-                df["roi"] = df["roi"].astype(
-                    pd.CategoricalDtype(df["roi"], ordered=True)
-                )
+        def format_roi_extractions(df):
+            """Format ROI extractions dataframe for LEADS quarterly reports."""
+            # Format ROI names
+            df["roi"] = df["roi"].str.replace("-", "_")
+            df["roi"] = df["roi"].astype(
+                pd.CategoricalDtype(df["roi"].unique(), ordered=True)
+            )
 
-                # Remove unnecessary columns
-                df = df.drop(columns=["image_file", "roi_file"])
+            # Remove unnecessary columns
+            df = df.drop(columns=["image_file", "roi_file"])
 
-                # Rename columns
-                df = df.rename(
-                    columns={
-                        "mean": "MRIBASED_SUVR",
-                        "voxel_count": "ClustSize",
-                    }
-                )
-
-                # Pivot the dataframe from long to wide format
-                df = df.set_index(["subject_id", "pet_date", "roi"]).unstack("roi")
+            # Rename columns
+            df = df.rename(
+                columns={
+                    "mean": "MRIBASED_SUVR",
+                    "voxel_count": "ClustSize",
+                }
+            )
 
-                # Flatten the column index
-                df.columns = ["_".join(col[::-1]).strip() for col in df.columns.values]
+            # Pivot the dataframe from long to wide format
+            df = df.set_index(["subject_id", "pet_date", "roi"]).unstack(
+                "roi", sort=False
+            )
 
-                # Reset the index
-                df = df.reset_index()
+            # Flatten the column index
+            df.columns = ["_".join(col[::-1]).strip() for col in df.columns.values]
 
-                return df
+            # Reset the index
+            df = df.reset_index()
 
-            try:
-                roi_dat = format_roi_extractions(
-                    load_roi_extractions_file(
-                        find_roi_extractions_file(pet_proc_dir, ref_region)
-                    )
-                )
-                return roi_dat
-            except Exception as e:
-                print(e)
-                return None
+            return df
 
         # Define reference regions for each tracer
         ref_regions = {
@@ -884,115 +811,74 @@ class QReport:
         }
 
         # Load ROI extractions for each tracer
+        store = xs.ExtractionStore(self.paths["roi_store"])
         self.roi_dat = {}
         for tracer, ref_region in ref_regions.items():
-            self.roi_dat[tracer] = pd.concat(
-                list(
-                    self.pet_idx[tracer].apply(
-                        lambda x: get_roi_extractions(x["pet_proc_dir"], ref_region),
-                        axis=1,
-                    )
-                ),
-                ignore_index=True,
+            self.roi_dat[tracer] = format_roi_extractions(
+                store.read(tracer, ref_region, self.pet_idx[tracer]["pet_proc_dir"])
             )
 
     def load_centiloid_dat(self):
         """Load Centiloid values for amyloid PET.
 
+        Amyloid cortical summary files are read concurrently and pivoted
+        to wide format together.
+
         Creates
         -------
         self.centiloid_dat : DataFrame
         """
 
-        def get_centiloids(pet_proc_dir):
-            def find_centiloid_file(pet_proc_dir):
-                """Return the filepath to the ROI mean CSV file."""
-                subj, tracer, pet_date = uts.parse_scan_tag(
-                    uts.get_scan_tag(pet_proc_dir)
-                )
-                filepath = op.join(
-                    pet_proc_dir,
-                    f"r{subj}_{tracer}_{pet_date}_amyloid-cortical-summary.csv",
-                )
-                if op.isfile(filepath):
-                    return filepath
-                else:
-                    warnings.warn(f"File not found: {filepath}")
-
-            def load_centiloid_file(filepath):
-                """Load and format the ROI extractions CSV file."""
-
-                def _scrape_ref_region(image_file):
-                    ref_region = (
-                        op.basename(image_file)
-                        .split(".")[0]
-                        .split("_")[3]
-                        .split("-")[1]
-                    )
-                    return ref_region
-
-                # Load the CSV file
-                df = pd.read_csv(filepath)
-
-                # Parse the PET proc dir
-                subj, _, pet_date = uts.parse_scan_tag(
-                    uts.get_scan_tag(op.dirname(filepath))
-                )
-
-                # Add subject_id and pet_date columns
-                df.insert(0, "subject_id", subj)
-                df.insert(1, "pet_date", pet_date)
-                df.insert(
-                    2,
-                    "ref_region",
-                    df["image_file"].apply(_scrape_ref_region),
-                )
-
-                return df
-
-            def format_centiloid_dat(df):
-                """Format ROI extractions dataframe for LEADS quarterly reports."""
-                # Format ROI names
-                df["ref_region"] = df["ref_region"].apply(lambda x: x.replace("-", "_"))
-                df["ref_region"] = df["ref_region"].astype(
-                    pd.CategoricalDtype(df["ref_region"], ordered=True)
-                )
+        def scrape_ref_region(image_file):
+            ref_region = (
+                op.basename(image_file).split(".")[0].split("_")[3].split("-")[1]
+            )
+            return ref_region
+
+        def format_centiloid_dat(df):
+            """Format Centiloid dataframe for LEADS quarterly reports."""
+            # Format ROI names
+            df["ref_region"] = df["ref_region"].str.replace("-", "_")
+            df["ref_region"] = df["ref_region"].astype(
+                pd.CategoricalDtype(df["ref_region"].unique(), ordered=True)
+            )
 
-                # Remove unnecessary columns
-                df = df.drop(columns=["image_file", "mask_file", "mean_suvr"])
+            # Remove unnecessary columns
+            df = df.drop(
+                columns=["image_file", "mask_file", "mean_suvr", "source_file"]
+            )
 
-                # Pivot the dataframe from long to wide format
-                df = df.set_index(["subject_id", "pet_date", "ref_region"]).unstack(
-                    "ref_region"
-                )
+            # Pivot the dataframe from long to wide format
+            df = df.set_index(["subject_id", "pet_date", "ref_region"]).unstack(
+                "ref_region", sort=False
+            )
 
-                # Flatten the column index
-                df.columns = ["_".join(col) for col in df.columns.values]
+            # Flatten the column index
+            df.columns = ["_".join(col) for col in df.columns.values]
 
-                # Reset the index
-                df = df.reset_index()
+            # Reset the index
+            df = df.reset_index()
 
-                return df
+            return df
 
-            try:
-                rr_dat = format_centiloid_dat(
-                    load_centiloid_file(find_centiloid_file(pet_proc_dir))
-                )
-                return rr_dat
-            except Exception as e:
-                print(e)
-                return None
+        def load_centiloids(tracer):
+            files = [
+                xs.scan_csv_file(pet_proc_dir, "amyloid-cortical-summary")
+                for pet_proc_dir in self.pet_idx[tracer]["pet_proc_dir"]
+            ]
+            df = xs.add_scan_columns(
+                xs.load_scan_csvs(files, xs.SCAN_CSV_DTYPES["amyloid-cortical-summary"])
+            )
+            df.insert(
+                2,
+                "ref_region",
+                df["image_file"].apply(scrape_ref_region),
+            )
+            return format_centiloid_dat(df)
 
         # Load Centiloid values for each reference region
         tracer = "fbb"
-        self.centiloid_dat = pd.concat(
-            list(
-                self.pet_idx[tracer].apply(
-                    lambda x: get_centiloids(x["pet_proc_dir"]), axis=1
-                )
-            ),
-            ignore_index=True,
-        )
+        self.centiloid_dat = load_centiloids(tracer)
 
     def create_qreport_files(self, save_output=True, overwrite=True):
         def format_tracer(self, tracer):
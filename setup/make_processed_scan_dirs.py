@@ -2,26 +2,48 @@
 
 """
 Create processed MRI and PET directories and link PET scans to their associated MRIs
-"""
 
+Work is done in two phases. First every scheduled scan is checked and
+the filesystem changes it needs are collected into a plan. Then the plan
+is applied concurrently, one transaction per scan directory:
+
+1. The new directory and its symlinks are built in a hidden staging
+   directory next to the final location (.<scan_dir>.staging)
+2. When overwriting, the existing directory is renamed out of the way
+   (.<scan_dir>.trash)
+3. The staging directory is renamed into place
+4. The old directory, if any, is deleted
+
+Each transaction is recorded in a journal file in scans_to_process_dir
+before it starts and after it is committed. If a run is interrupted,
+the next run rolls back any transaction that was not committed (so no
+scan is left half-built) and then replans, so rerunning is always safe.
+Symlinks in existing directories are added or replaced atomically.
+"""
 
 import argparse
+import json
 import os
 import os.path as op
 import shutil
 import sys
-
-import pandas as pd
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 utils_dir = op.join(op.dirname(__file__), "..", "utils")
 if utils_dir not in sys.path:
     sys.path.append(utils_dir)
-import utilities as uts
+import scan_index
+
+# Define globals
+JOURNAL_BASENAME = "make_processed_scan_dirs.journal"
 
 
 def make_processed_scan_dirs(
     scans_to_process_dir="/mnt/coredata/processing/leads/metadata/scans_to_process",
     overwrite=False,
+    relink=False,
+    n_threads=16,
 ):
     """Create processed MRI and PET directories and link PET scans to their associated MRIs
 
@@ -50,174 +72,76 @@ def make_processed_scan_dirs(
         argument will not affect which scans will be processed, which is
         determined by the 'scheduled_for_processing' column in the
         raw_mris and raw_pets DataFrames
+    relink : bool, optional
+        If True, replace symlinks in existing directories that point to
+        an unexpected location (e.g. after a PET scan's closest MRI has
+        changed). If False, these are reported as problems and left as
+        they are
+    n_threads : int, optional
+        Number of scans to check and set up at once
 
     Returns
     -------
     None
     """
+    # Roll back any scan directories left half-built by an interrupted run
+    journalf = op.join(scans_to_process_dir, JOURNAL_BASENAME)
+    n_rolled_back = recover_journal(journalf)
+    if n_rolled_back:
+        print(
+            f"  * Rolled back {n_rolled_back:,} scan directories left incomplete by an interrupted run"
+        )
 
-    def print_tag(scan_tag, already_printed=False):
-        """Print the scan tag if it hasn't already been printed"""
-        if already_printed:
-            return already_printed
-        else:
-            print(f"  * {scan_tag}")
-            already_printed = True
-            return already_printed
-
-    # Load the most recently modified raw_MRI-T1_index* CSV file in
-    # scans_to_process_dir
+    # Load the latest raw MRI and PET indexes in scans_to_process_dir
     try:
-        raw_mrisf = uts.glob_sort_mtime(
-            op.join(scans_to_process_dir, "raw_MRI-T1_index*.csv")
-        )[0]
-    except IndexError:
-        print(f"ERROR: No raw_MRI-T1_index*.csv file found in {scans_to_process_dir}")
+        raw_mris = scan_index.load_index(scans_to_process_dir, "MRI-T1")
+        raw_pets = scan_index.load_index(scans_to_process_dir, "PET")
+    except FileNotFoundError as e:
+        print(f"ERROR: {e}")
         sys.exit(1)
-    raw_mris = pd.read_csv(raw_mrisf)
 
-    # Load the most recently saved raw_PET_index* CSV file in
-    # scans_to_process_dir
+    # Plan the changes for each MRI and PET scan to be processed
+    mri_plan, pet_plan = plan_processed_scan_dirs(
+        raw_mris, raw_pets, overwrite=overwrite, relink=relink, n_threads=n_threads
+    )
+    for scan_plan in mri_plan + pet_plan:
+        if scan_plan["problems"]:
+            print(f"  * {scan_plan['scan_tag']}")
+            for msg in scan_plan["problems"]:
+                print(f"!!  - {msg}")
+
+    # Apply the plan
+    journal = Journal(journalf)
     try:
-        raw_petsf = uts.glob_sort_mtime(
-            op.join(scans_to_process_dir, "raw_PET_index*.csv")
-        )[0]
-    except IndexError:
-        print(f"ERROR: No raw_PET_index_*.csv file found in {scans_to_process_dir}")
-        sys.exit(1)
-    raw_pets = pd.read_csv(raw_petsf)
-
-    # Loop over each MRI to be processed and setup the processed
-    # directory structure
-    count_problems_mri = 0
-    for _, scan in raw_mris.query("(scheduled_for_processing==1)").iterrows():
-        # Print the scan tag
-        already_printed = False
-        mri_tag = f"{scan['subj']}_MRI-T1_{scan['mri_date']}"
-
-        # Make sure the raw MRI file exists
-        if not op.isfile(scan["mri_raw_niif"]):
-            already_printed = print_tag(mri_tag, already_printed)
-            print(f"!!  - {scan['mri_raw_niif']} DOES NOT EXIST; SKIPPING SCAN")
-            count_problems_mri += 1
-            continue
-
-        # Create the processed MRI directory
-        if op.isdir(scan["mri_proc_dir"]):
-            if overwrite:
-                if not already_printed:
-                    print(f"  * {mri_tag}")
-                    already_printed = True
-                shutil.rmtree(scan["mri_proc_dir"])
-                print(f"    $ rm -rf {scan['mri_proc_dir']}")
-                os.makedirs(scan["mri_proc_dir"])
-                print(f"    $ mkdir {scan['mri_proc_dir']}")
-        else:
-            already_printed = print_tag(mri_tag, already_printed)
-            os.makedirs(scan["mri_proc_dir"])
-            print(f"    $ mkdir {scan['mri_proc_dir']}")
-
-        # Create a symlink to the raw MRI directory
-        link_src = op.dirname(scan["mri_raw_niif"])
-        link_dst = op.join(scan["mri_proc_dir"], "raw")
-        if not op.islink(link_dst):
-            already_printed = print_tag(mri_tag, already_printed)
-            os.symlink(link_src, link_dst)
-            print(f"    $ ln -s {link_src} {link_dst}")
-        # If the symlink already exists, alert the user if it points to
-        # an unexpected location
-        else:
-            if op.realpath(link_dst) != link_src:
-                already_printed = print_tag(mri_tag, already_printed)
-                print(
-                    f"!!  - {link_dst} ALREADY EXISTS BUT POINTS TO {op.realpath(link_dst)}; EXPECTED LOCATION IS {link_src}"
-                )
-                count_problems_mri += 1
-
-    # Loop over each PET scan to be processed and setup the processed
-    # directory structure
-    count_problems_pet = 0
-    for _, scan in raw_pets.query("(scheduled_for_processing==1)").iterrows():
-        # Print the scan tag
-        already_printed = False
-        pet_tag = f"{scan['subj']}_{scan['tracer']}_{scan['pet_date']}"
-
-        # Make sure the raw PET file exists
-        if not op.isfile(scan["pet_raw_niif"]):
-            already_printed = print_tag(pet_tag, already_printed)
-            print(f"!!  - {scan['pet_raw_niif']} DOES NOT EXIST; SKIPPING SCAN")
-            count_problems_pet += 1
-            continue
-
-        # Make sure the raw PET file ends in .nii
-        if not scan["pet_raw_niif"].endswith(".nii"):
-            already_printed = print_tag(pet_tag, already_printed)
-            print(f"!!  - {scan['pet_raw_niif']} DOES NOT END IN .nii; SKIPPING SCAN")
-            count_problems_pet += 1
-            continue
-
-        # Make sure the processed MRI directory exists
-        mri_image_id = scan["mri_image_id"]
-        result = raw_mris.loc[raw_mris["mri_image_id"] == mri_image_id, "mri_proc_dir"]
-        if result.empty:
-            already_printed = print_tag(pet_tag, already_printed)
-            print(
-                f"!!  - {scan['pet_raw_niif']} IS MISSING AN ACCOMPANYING MRI; SKIPPING SCAN"
-            )
-            count_problems_pet += 1
-            continue
-        else:
-            mri_proc_dir = result.iloc[0]
-
-        # Create the processed PET directory
-        if op.isdir(scan["pet_proc_dir"]):
-            if overwrite:
-                already_printed = print_tag(pet_tag, already_printed)
-                shutil.rmtree(scan["pet_proc_dir"])
-                print(f"    $ rm -rf {scan['pet_proc_dir']}")
-                os.makedirs(scan["pet_proc_dir"])
-                print(f"    $ mkdir {scan['pet_proc_dir']}")
-        else:
-            already_printed = print_tag(pet_tag, already_printed)
-            os.makedirs(scan["pet_proc_dir"])
-            print(f"    $ mkdir {scan['pet_proc_dir']}")
-
-        # Create a symlink to the raw PET directory
-        link_src = op.dirname(scan["pet_raw_niif"])
-        link_dst = op.join(scan["pet_proc_dir"], "raw")
-        if not op.islink(link_dst):
-            already_printed = print_tag(pet_tag, already_printed)
-            os.symlink(link_src, link_dst)
-            print(f"    $ ln -s {link_src} {link_dst}")
-        # If the symlink already exists, alert the user if it points to
-        # an unexpected location
-        else:
-            if op.realpath(link_dst) != link_src:
-                already_printed = print_tag(pet_tag, already_printed)
-                print(
-                    f"!!  - {link_dst} ALREADY EXISTS BUT POINTS TO {op.realpath(link_dst)}; EXPECTED LOCATION IS {link_src}"
-                )
-                count_problems_pet += 1
-
-        # Create a symlink to the processed MRI directory
-        link_src = mri_proc_dir
-        link_dst = op.join(scan["pet_proc_dir"], "mri")
-        if not op.islink(link_dst):
-            already_printed = print_tag(pet_tag, already_printed)
-            os.symlink(link_src, link_dst)
-            print(f"    $ ln -s {link_src} {link_dst}")
-        # If the symlink already exists, alert the user if it points to
-        # an unexpected location
-        else:
-            if op.realpath(link_dst) != link_src:
-                already_printed = print_tag(pet_tag, already_printed)
-                print(
-                    f"!!  - {link_dst} ALREADY EXISTS BUT POINTS TO {op.realpath(link_dst)}; EXPECTED LOCATION IS {link_src}"
-                )
-                count_problems_pet += 1
+        results = apply_plan(mri_plan + pet_plan, journal, n_threads=n_threads)
+    finally:
+        journal.close()
+    n_failed = 0
+    for scan_plan, error in zip(mri_plan + pet_plan, results):
+        if error is not None:
+            print(f"  * {scan_plan['scan_tag']}")
+            print(f"!!  - FAILED TO SET UP {scan_plan['scan_dir']}: {error}")
+            n_failed += 1
+    if n_failed == 0:
+        os.remove(journalf)
+
+    # Summarize the changes
+    print("")
+    for action, desc in [
+        ("create", "Created"),
+        ("recreate", "Recreated"),
+        ("update", "Updated symlinks in"),
+    ]:
+        n = sum(
+            (scan_plan["action"] == action) and (error is None)
+            for scan_plan, error in zip(mri_plan + pet_plan, results)
+        )
+        if n:
+            print(f"  * {desc} {n:,} processed scan directories")
 
     # Notify the user of any problems detected
-    print("")
+    count_problems_mri = sum(len(scan_plan["problems"]) > 0 for scan_plan in mri_plan)
+    count_problems_pet = sum(len(scan_plan["problems"]) > 0 for scan_plan in pet_plan)
     if count_problems_mri > 0:
         print(
             f"!! {count_problems_mri} PROBLEMS DETECTED WITH MRI SCANS; SEE ABOVE FOR DETAILS"
@@ -236,6 +160,316 @@ def make_processed_scan_dirs(
             "  * No conflicts detected between existing data structure and latest PET index"
         )
 
+    if n_failed > 0:
+        print(f"!! FAILED TO SET UP {n_failed:,} SCAN DIRECTORIES; RERUN TO RETRY THEM")
+
+
+def plan_processed_scan_dirs(
+    raw_mris, raw_pets, overwrite=False, relink=False, n_threads=16
+):
+    """Return the planned changes for each scheduled MRI and PET scan.
+
+    Parameters
+    ----------
+    raw_mris, raw_pets : DataFrame
+        Raw MRI and PET indexes saved by select_scans_to_process.py.
+    overwrite, relink : bool
+        See make_processed_scan_dirs.
+    n_threads : int
+        Number of scans to check at once.
+
+    Returns
+    -------
+    mri_plan, pet_plan : list of dict
+        Output of plan_scan_dir for each scheduled scan, in index order.
+    """
+    # Index processed MRI directories by image ID, keeping the first
+    # match for each ID
+    mri_proc_dirs = (
+        raw_mris.drop_duplicates("mri_image_id")
+        .set_index("mri_image_id")["mri_proc_dir"]
+        .to_dict()
+    )
+
+    def plan_mri(scan):
+        mri_tag = f"{scan.subj}_MRI-T1_{scan.mri_date:%Y-%m-%d}"
+        if not op.isfile(scan.mri_raw_niif):
+            return _skip_scan(
+                mri_tag,
+                scan.mri_proc_dir,
+                f"{scan.mri_raw_niif} DOES NOT EXIST; SKIPPING SCAN",
+            )
+        return plan_scan_dir(
+            mri_tag,
+            scan.mri_proc_dir,
+            {"raw": op.dirname(scan.mri_raw_niif)},
+            overwrite=overwrite,
+            relink=relink,
+        )
+
+    def plan_pet(scan):
+        pet_tag = f"{scan.subj}_{scan.tracer}_{scan.pet_date:%Y-%m-%d}"
+        if not op.isfile(scan.pet_raw_niif):
+            return _skip_scan(
+                pet_tag,
+                scan.pet_proc_dir,
+                f"{scan.pet_raw_niif} DOES NOT EXIST; SKIPPING SCAN",
+            )
+        if not scan.pet_raw_niif.endswith(".nii"):
+            return _skip_scan(
+                pet_tag,
+                scan.pet_proc_dir,
+                f"{scan.pet_raw_niif} DOES NOT END IN .nii; SKIPPING SCAN",
+            )
+        mri_proc_dir = mri_proc_dirs.get(scan.mri_image_id)
+        if mri_proc_dir is None:
+            return _skip_scan(
+                pet_tag,
+                scan.pet_proc_dir,
+                f"{scan.pet_raw_niif} IS MISSING AN ACCOMPANYING MRI; SKIPPING SCAN",
+            )
+        return plan_scan_dir(
+            pet_tag,
+            scan.pet_proc_dir,
+            {"raw": op.dirname(scan.pet_raw_niif), "mri": mri_proc_dir},
+            overwrite=overwrite,
+            relink=relink,
+        )
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        mri_plan = list(
+            executor.map(
+                plan_mri,
+                raw_mris.query("(scheduled_for_processing==1)").itertuples(),
+            )
+        )
+        pet_plan = list(
+            executor.map(
+                plan_pet,
+                raw_pets.query("(scheduled_for_processing==1)").itertuples(),
+            )
+        )
+    return mri_plan, pet_plan
+
+
+def plan_scan_dir(scan_tag, scan_dir, links, overwrite=False, relink=False):
+    """Return the changes needed to set up one processed scan directory.
+
+    Parameters
+    ----------
+    scan_tag : str
+        The scan tag, used in messages.
+    scan_dir : str
+        The processed scan directory.
+    links : dict
+        {symlink name in scan_dir: path the symlink should point to}
+    overwrite, relink : bool
+        See make_processed_scan_dirs.
+
+    Returns
+    -------
+    scan_plan : dict
+        scan_tag, scan_dir, action ('create', 'recreate', 'update', or
+        None if nothing needs to change), links (the symlinks to create
+        or replace), and problems (list of messages).
+    """
+    scan_plan = {
+        "scan_tag": scan_tag,
+        "scan_dir": scan_dir,
+        "action": None,
+        "links": {},
+        "problems": [],
+    }
+    if not op.isdir(scan_dir):
+        scan_plan["action"] = "create"
+        scan_plan["links"] = links
+        return scan_plan
+    if overwrite:
+        scan_plan["action"] = "recreate"
+        scan_plan["links"] = links
+        return scan_plan
+
+    for name, link_src in links.items():
+        link_dst = op.join(scan_dir, name)
+        if not op.islink(link_dst):
+            if op.lexists(link_dst):
+                scan_plan["problems"].append(
+                    f"{link_dst} ALREADY EXISTS AND IS NOT A SYMLINK; EXPECTED A LINK TO {link_src}"
+                )
+            else:
+                scan_plan["links"][name] = link_src
+        # If the symlink already exists, alert the user if it points to
+        # an unexpected location
+        elif op.realpath(link_dst) != link_src:
+            if relink:
+                scan_plan["links"][name] = link_src
+            else:
+                scan_plan["problems"].append(
+                    f"{link_dst} ALREADY EXISTS BUT POINTS TO {op.realpath(link_dst)}; EXPECTED LOCATION IS {link_src}"
+                )
+    if scan_plan["links"]:
+        scan_plan["action"] = "update"
+    return scan_plan
+
+
+def _skip_scan(scan_tag, scan_dir, msg):
+    """Return a plan that leaves the scan directory untouched."""
+    return {
+        "scan_tag": scan_tag,
+        "scan_dir": scan_dir,
+        "action": None,
+        "links": {},
+        "problems": [msg],
+    }
+
+
+def apply_plan(plan, journal, n_threads=16):
+    """Apply planned changes to each scan directory concurrently.
+
+    Parameters
+    ----------
+    plan : list of dict
+        Outputs of plan_scan_dir.
+    journal : Journal
+        Records each directory transaction so it can be rolled back.
+    n_threads : int
+        Number of scan directories to set up at once.
+
+    Returns
+    -------
+    errors : list
+        For each item in plan, None if it was applied successfully, or
+        the exception that was raised.
+    """
+
+    def apply(scan_plan):
+        try:
+            if scan_plan["action"] in ("create", "recreate"):
+                _swap_in_scan_dir(scan_plan["scan_dir"], scan_plan["links"], journal)
+            elif scan_plan["action"] == "update":
+                for name, link_src in scan_plan["links"].items():
+                    _replace_symlink(link_src, op.join(scan_plan["scan_dir"], name))
+        except OSError as e:
+            return e
+        return None
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(apply, plan))
+
+
+def _staging_dirs(scan_dir):
+    """Return the staging and trash paths used to swap in scan_dir."""
+    parent, name = op.split(op.normpath(scan_dir))
+    return op.join(parent, f".{name}.staging"), op.join(parent, f".{name}.trash")
+
+
+def _swap_in_scan_dir(scan_dir, links, journal):
+    """Build a new scan directory in staging and rename it into place."""
+    staging_dir, trash_dir = _staging_dirs(scan_dir)
+    for d in (staging_dir, trash_dir):
+        if op.lexists(d):
+            shutil.rmtree(d)
+    existed = op.isdir(scan_dir)
+    journal.write(op="begin", scan_dir=scan_dir, existed=existed)
+
+    os.makedirs(staging_dir)
+    for name, link_src in links.items():
+        os.symlink(link_src, op.join(staging_dir, name))
+    if existed:
+        os.rename(scan_dir, trash_dir)
+    os.rename(staging_dir, scan_dir)
+
+    journal.write(op="commit", scan_dir=scan_dir)
+    if op.isdir(trash_dir):
+        shutil.rmtree(trash_dir)
+
+
+def _replace_symlink(link_src, link_dst):
+    """Atomically create or replace the symlink link_dst -> link_src."""
+    tmp_dst = f"{link_dst}.tmp{os.getpid()}"
+    if op.lexists(tmp_dst):
+        os.remove(tmp_dst)
+    os.symlink(link_src, tmp_dst)
+    os.replace(tmp_dst, link_dst)
+
+
+class Journal:
+    """Append-only record of scan directory transactions.
+
+    Each line is a JSON object with 'op' ('begin' or 'commit') and
+    'scan_dir'; 'begin' records also note whether scan_dir already
+    existed. Lines are flushed to disk before the filesystem change
+    they describe is made.
+    """
+
+    def __init__(self, journalf):
+        self.journalf = journalf
+        self._f = open(journalf, "a")
+        self._lock = threading.Lock()
+
+    def write(self, **record):
+        """Append a record and flush it to disk."""
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._f.write(line)
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def close(self):
+        """Close the journal file."""
+        self._f.close()
+
+
+def recover_journal(journalf):
+    """Roll back uncommitted transactions in journalf and remove it.
+
+    For each scan directory that was begun but not committed, the
+    staging directory is removed, and if an existing directory had been
+    moved aside it is restored, replacing any partially swapped-in
+    directory. Leftover trash from committed transactions is deleted.
+
+    Returns
+    -------
+    n_rolled_back : int
+        Number of uncommitted transactions that were rolled back.
+    """
+    if not op.isfile(journalf):
+        return 0
+
+    last_records = {}
+    with open(journalf) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be cut off if the run was killed
+                # mid-write, in which case its change was never made
+                continue
+            last_records[record["scan_dir"]] = record
+
+    n_rolled_back = 0
+    for scan_dir, record in last_records.items():
+        staging_dir, trash_dir = _staging_dirs(scan_dir)
+        if record["op"] == "begin":
+            if op.lexists(staging_dir):
+                shutil.rmtree(staging_dir)
+            if op.isdir(trash_dir):
+                # The old directory was moved aside, and the new one may
+                # have been renamed into place
+                if op.lexists(scan_dir):
+                    shutil.rmtree(scan_dir)
+                os.rename(trash_dir, scan_dir)
+            elif not record["existed"] and op.isdir(scan_dir):
+                # The new directory was renamed into place but not
+                # committed
+                shutil.rmtree(scan_dir)
+            n_rolled_back += 1
+        elif op.isdir(trash_dir):
+            shutil.rmtree(trash_dir)
+
+    os.remove(journalf)
+    return n_rolled_back
+
 
 def _parse_args():
     """Parse and return command line arguments."""
@@ -256,6 +490,29 @@ def _parse_args():
         action="store_true",
         help="Overwrite existing files in processed",
     )
+    parser.add_argument(
+        "--relink",
+        action="store_true",
+        help=(
+            "Replace symlinks in existing processed directories that point\n"
+            + "to an unexpected location instead of reporting them"
+        ),
+    )
+    parser.add_argument(
+        "--rollback",
+        action="store_true",
+        help=(
+            "Only roll back scan directories left incomplete by an\n"
+            + "interrupted run, then exit"
+        ),
+    )
+    parser.add_argument(
+        "-n",
+        "--n-threads",
+        type=int,
+        default=16,
+        help="Number of scan directories to set up at once (default: %(default)s)",
+    )
 
     # Parse the command line arguments
     return parser.parse_args()
@@ -266,10 +523,18 @@ if __name__ == "__main__":
     args = _parse_args()
 
     # Call the main function
-    make_processed_scan_dirs(
-        scans_to_process_dir=args.scans_to_process_dir,
-        overwrite=args.overwrite,
-    )
+    if args.rollback:
+        n_rolled_back = recover_journal(
+            op.join(args.scans_to_process_dir, JOURNAL_BASENAME)
+        )
+        print(f"  * Rolled back {n_rolled_back:,} incomplete scan directories")
+    else:
+        make_processed_scan_dirs(
+            scans_to_process_dir=args.scans_to_process_dir,
+            overwrite=args.overwrite,
+            relink=args.relink,
+            n_threads=args.n_threads,
+        )
 
     # Exit successfully
     sys.exit(0)
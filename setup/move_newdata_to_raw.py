@@ -4,18 +4,72 @@
 Move scans from newdata to raw, keeping file hierarchies intact
 """
 
-
 import argparse
+import errno
 import os
 import os.path as op
 import shutil
 import sys
-from glob import glob
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from raw_manifest import RawManifest
+
+utils_dir = op.join(op.dirname(__file__), "..", "utils")
+if utils_dir not in sys.path:
+    sys.path.append(utils_dir)
+import utilities as uts
+
+# Define globals
+COPY_CHUNK_BYTES = 4 * 1024**2
+NIFTI_EXTS = (".nii", ".nii.gz")
+UNZIP_STAGING_DIRNAME = ".unzip_staging"
+SKIP_DIRS = ["LEADS", "ADNI", "IDEAS", "SCAN", "PAD"]
+
 
+def get_raw_dir(scan_path, raw_dir):
+    """Return the raw directory for a scan directory path in newdata.
+
+    Parameters
+    ----------
+    scan_path : str
+        Path to the scan directory relative to newdata, e.g.
+        ADNI/<subj>/<...>. A leading project directory in SKIP_DIRS
+        is dropped.
+    raw_dir : str
+        The raw directory.
 
-def move_newdata_to_raw(newdata_dir, raw_dir, overwrite=False, wipe_newdata=True):
+    Returns
+    -------
+    target_dir : str
+        <raw_dir>/<subj>/<...>
+    """
+    scan_path_parts = scan_path.split("/")
+    if scan_path_parts[0].upper() in SKIP_DIRS:
+        scan_path = op.join(*scan_path_parts[1:])
+    return op.join(raw_dir, scan_path)
+
+
+def move_newdata_to_raw(
+    newdata_dir,
+    raw_dir,
+    overwrite=False,
+    wipe_newdata=True,
+    manifest_file=None,
+    n_threads=8,
+):
     """Move scans from newdata to raw, keeping file hierarchies intact
 
+    If newdata and raw are on the same filesystem, directories are
+    moved with a single rename each; when a subject directory does not
+    exist in raw yet and everything under it in newdata is being moved,
+    the whole subject directory is renamed at once. Otherwise files are
+    copied in parallel (in the kernel where possible) into a hidden
+    staging directory next to each target, verified by CRC-32, and the
+    staging directory is renamed into place before the source is
+    removed. Files that were already copied and verified by an
+    interrupted run are not copied again.
+
     Parameters
     ----------
     newdata_dir : str
@@ -31,7 +85,17 @@ def move_newdata_to_raw(newdata_dir, raw_dir, overwrite=False, wipe_newdata=True
         directories.
     wipe_newdata : bool
         If True, remove all files and folders from newdata_dir after
-        moving everything eligible to be moved to raw_dir.
+        moving everything eligible to be moved to raw_dir. newdata_dir
+        is not wiped if any directory failed to copy, or if
+        unzip_files_in_dir.py left unfinished extractions in
+        <raw_dir>/.unzip_staging (newdata still holds their archives).
+    manifest_file : str or None
+        Path to the raw nifti manifest (see raw_manifest.py). If the
+        file exists, each moved directory is recorded in it so that
+        select_scans_to_process.py does not need to re-list it.
+    n_threads : int
+        Number of files to copy at once when newdata and raw are on
+        different filesystems.
 
     Returns
     -------
@@ -40,6 +104,13 @@ def move_newdata_to_raw(newdata_dir, raw_dir, overwrite=False, wipe_newdata=True
 
     def do_cleanup():
         """Remove all files and folders from newdata."""
+        unzip_staging_dir = op.join(raw_dir, UNZIP_STAGING_DIRNAME)
+        if op.isdir(unzip_staging_dir):
+            print(
+                f"!! UNFINISHED EXTRACTIONS IN {unzip_staging_dir}; NOT CLEANING UP {newdata_dir}"
+            )
+            print("!! Rerun unzip_files_in_dir.py to finish extracting them")
+            return
         print(f"  * Cleaning up {newdata_dir}")
         for file in os.listdir(newdata_dir):
             filepath = op.join(newdata_dir, file)
@@ -53,10 +124,7 @@ def move_newdata_to_raw(newdata_dir, raw_dir, overwrite=False, wipe_newdata=True
     raw_dir = op.abspath(raw_dir)
 
     # Find all niftis in newdata
-    check_exts = (".nii", ".nii.gz")
-    glob_files = []
-    for ext in check_exts:
-        glob_files.extend(glob(op.join(newdata_dir, f"**/*{ext}"), recursive=True))
+    glob_files = list(uts.walk_files(newdata_dir, exts=NIFTI_EXTS, skip_hidden=True))
 
     # If no niftis are found, print a message and return
     if len(glob_files) == 0:
@@ -67,44 +135,262 @@ def move_newdata_to_raw(newdata_dir, raw_dir, overwrite=False, wipe_newdata=True
         return
 
     # Find all unique nifti-containing directories in newdata
-    source_dirs = set([op.dirname(f) for f in glob_files])
+    source_dirs = sorted(set([op.dirname(f) for f in glob_files]))
     print(f"  * Found {len(source_dirs)} directories with niftis")
 
-    skip_dirs = ["LEADS", "ADNI", "IDEAS", "SCAN", "PAD"]
-    count = 0
+    # Check which scan directories are eligible to be moved
+    moves = {}
     for source_dir in source_dirs:
         # Create a matching file hierarchy in raw as in newdata
-        scan_path = op.relpath(source_dir, newdata_dir)
-        scan_path_parts = scan_path.split("/")
-        if scan_path_parts[0].upper() in skip_dirs:
-            scan_path = op.join(*scan_path_parts[1:])
-        target_dir = op.join(raw_dir, scan_path)
+        target_dir = get_raw_dir(op.relpath(source_dir, newdata_dir), raw_dir)
 
         # Check if the target directory exists
         if op.exists(target_dir):
-            # If overwrite is True, remove the existing directory
+            # If overwrite is True, the existing directory is replaced
             if overwrite:
                 print(f"  * Overwriting existing raw directory: {target_dir}")
-                shutil.rmtree(target_dir)
             else:
                 print(f"  * Skipping existing raw directory: {target_dir}")
                 continue
+        moves[source_dir] = target_dir
+
+    os.makedirs(raw_dir, exist_ok=True)
+    same_device = os.stat(newdata_dir).st_dev == os.stat(raw_dir).st_dev
+    if same_device:
+        moves = _merge_subject_moves(moves, newdata_dir, raw_dir)
+    else:
+        moves = {
+            source_dir: (target_dir, 1) for source_dir, target_dir in moves.items()
+        }
+        print(f"  * {newdata_dir} and {raw_dir} are on different filesystems; copying")
 
-        # Create the necessary directory structure, then copy source to
-        # target
-        os.makedirs(op.dirname(target_dir), exist_ok=True)
-        shutil.move(source_dir, target_dir)
-        print(f"  * Moved {source_dir} to {target_dir}")
-        count += 1
+    # Move each directory, keeping track of the highest new directory in
+    # raw for each move so the manifest can record the whole new branch
+    count = 0
+    n_bytes = 0
+    failed = []
+    scan_roots = set()
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        copies = {}
+        if not same_device:
+            for source_dir, (target_dir, _) in moves.items():
+                copies[source_dir] = copy_tree_verified(
+                    source_dir, _staging_dir(target_dir), executor
+                )
+
+        for source_dir, (target_dir, n_scans) in moves.items():
+            if not op.isdir(source_dir):
+                # Already moved along with a parent directory
+                continue
+            scan_root = _new_branch_root(target_dir, raw_dir)
+            try:
+                if same_device:
+                    os.makedirs(op.dirname(target_dir), exist_ok=True)
+                    _swap_in_dir(source_dir, target_dir)
+                else:
+                    n_bytes += sum(future.result() for future in copies[source_dir])
+                    _swap_in_dir(_staging_dir(target_dir), target_dir)
+                    shutil.rmtree(source_dir)
+            except OSError as e:
+                print(f"!! FAILED TO MOVE {source_dir} TO {target_dir}: {e}")
+                failed.append(source_dir)
+                continue
+            msg = f"  * Moved {source_dir} to {target_dir}"
+            if n_scans > 1:
+                msg += f" ({n_scans} scan directories)"
+            print(msg)
+            scan_roots.add(scan_root)
+            count += n_scans
 
     # Print how many scans we moved over
+    if not same_device:
+        print(f"  * Copied {n_bytes / 1024**3:.2f} GB")
     print(f"  * Done; {count} scan directories moved to raw")
 
+    # Record the moved scans in the raw nifti manifest
+    if (manifest_file is not None) and op.isfile(manifest_file) and scan_roots:
+        with RawManifest(manifest_file) as manifest:
+            for scan_root in sorted(scan_roots):
+                manifest.scan(scan_root)
+        print(f"  * Added {count} scan directories to {manifest_file}")
+
     # Clean up empty directories in newdata
-    if wipe_newdata:
+    if failed:
+        print(
+            f"!! {len(failed)} DIRECTORIES FAILED TO MOVE; NOT CLEANING UP {newdata_dir}"
+        )
+        print("!! Rerun to resume copying them")
+    elif wipe_newdata:
         do_cleanup()
 
 
+def _merge_subject_moves(moves, newdata_dir, raw_dir):
+    """Replace scan directory moves with whole-subject moves where possible.
+
+    A subject directory in newdata can be renamed to raw in one step if
+    its target does not exist yet and every file under it is in a scan
+    directory that is being moved.
+
+    Returns
+    -------
+    moves : dict
+        {source_dir: (target_dir, number of scan directories)}
+    """
+    by_subj = {}
+    for source_dir, target_dir in moves.items():
+        rel_parts = op.relpath(source_dir, newdata_dir).split(os.sep)
+        n_parts = 2 if rel_parts[0].upper() in SKIP_DIRS else 1
+        subj_dir = op.normpath(op.join(newdata_dir, *rel_parts[:n_parts]))
+        by_subj.setdefault(subj_dir, []).append(source_dir)
+
+    merged = {}
+    for subj_dir, subj_source_dirs in by_subj.items():
+        target_subj_dir = op.normpath(
+            get_raw_dir(op.relpath(subj_dir, newdata_dir), raw_dir)
+        )
+        moving = set(subj_source_dirs)
+        if (
+            (op.dirname(target_subj_dir) == raw_dir)
+            and not op.lexists(target_subj_dir)
+            and all(
+                op.dirname(f) in moving
+                for f in uts.walk_files(subj_dir, skip_hidden=False)
+            )
+        ):
+            merged[subj_dir] = (target_subj_dir, len(subj_source_dirs))
+        else:
+            for source_dir in subj_source_dirs:
+                merged[source_dir] = (moves[source_dir], 1)
+    return merged
+
+
+def _new_branch_root(target_dir, raw_dir):
+    """Return the highest ancestor of target_dir in raw_dir that does not exist."""
+    root = target_dir
+    while (op.dirname(root) != raw_dir) and not op.exists(op.dirname(root)):
+        root = op.dirname(root)
+    return root
+
+
+def _staging_dir(target_dir):
+    """Return the hidden directory a target is copied into before renaming."""
+    parent, name = op.split(target_dir)
+    return op.join(parent, f".{name}.partial")
+
+
+def _swap_in_dir(source_dir, target_dir):
+    """Rename source_dir to target_dir, replacing any existing target."""
+    if op.exists(target_dir):
+        parent, name = op.split(target_dir)
+        trash_dir = op.join(parent, f".{name}.trash")
+        if op.exists(trash_dir):
+            shutil.rmtree(trash_dir)
+        os.rename(target_dir, trash_dir)
+        os.rename(source_dir, target_dir)
+        shutil.rmtree(trash_dir)
+    else:
+        os.rename(source_dir, target_dir)
+
+
+def copy_tree_verified(source_dir, target_dir, executor):
+    """Start copying every file in source_dir to target_dir.
+
+    Parameters
+    ----------
+    source_dir : str
+        The directory to copy.
+    target_dir : str
+        The directory to copy to. Created if it does not exist; files
+        already in it that were copied and verified before are kept.
+    executor : concurrent.futures.Executor
+        Runs copy_file_verified for each file.
+
+    Returns
+    -------
+    futures : list
+        One future per file, each returning the number of bytes copied.
+    """
+    futures = []
+    for root, _, fnames in os.walk(source_dir):
+        dest_root = op.join(target_dir, op.relpath(root, source_dir))
+        os.makedirs(dest_root, exist_ok=True)
+        for fname in fnames:
+            futures.append(
+                executor.submit(
+                    copy_file_verified, op.join(root, fname), op.join(dest_root, fname)
+                )
+            )
+    return futures
+
+
+def copy_file_verified(src, dst):
+    """Copy src to dst and check that their CRC-32 checksums match.
+
+    The data is copied in the kernel with copy_file_range or sendfile
+    when available. Once verified, dst is given the modification time
+    of src, which marks it as complete: if dst already has the size and
+    modification time of src it is not copied again.
+
+    Returns
+    -------
+    n_bytes : int
+        Number of bytes copied (0 if dst was already complete).
+    """
+    st = os.stat(src)
+    try:
+        dst_st = os.stat(dst)
+        if (dst_st.st_size == st.st_size) and (dst_st.st_mtime_ns == st.st_mtime_ns):
+            return 0
+    except FileNotFoundError:
+        pass
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        _copy_fd(fsrc, fdst, st.st_size)
+    if file_crc32(src) != file_crc32(dst):
+        os.remove(dst)
+        raise OSError(f"Checksum mismatch after copying {src} to {dst}")
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return st.st_size
+
+
+def _copy_fd(fsrc, fdst, size):
+    """Copy size bytes between open files, in the kernel where possible."""
+    fd_in, fd_out = fsrc.fileno(), fdst.fileno()
+    copied = 0
+    copy_funcs = []
+    if hasattr(os, "copy_file_range"):
+        copy_funcs.append(
+            lambda offset, count: os.copy_file_range(fd_in, fd_out, count, offset)
+        )
+    if hasattr(os, "sendfile"):
+        copy_funcs.append(
+            lambda offset, count: os.sendfile(fd_out, fd_in, offset, count)
+        )
+    for copy_func in copy_funcs:
+        try:
+            while copied < size:
+                n = copy_func(copied, min(size - copied, COPY_CHUNK_BYTES))
+                if n == 0:
+                    break
+                copied += n
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTSUP):
+                raise
+            os.lseek(fd_out, copied, os.SEEK_SET)
+    fsrc.seek(copied)
+    shutil.copyfileobj(fsrc, fdst, COPY_CHUNK_BYTES)
+
+
+def file_crc32(filepath):
+    """Return the CRC-32 checksum of a file."""
+    crc = 0
+    with open(filepath, "rb") as f:
+        while chunk := f.read(COPY_CHUNK_BYTES):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
 def _parse_args():
     """Parse and return command line arguments."""
     parser = argparse.ArgumentParser(
@@ -134,6 +420,19 @@ def _parse_args():
             + "(default: %(default)s)"
         ),
     )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=(
+            "/mnt/coredata/processing/leads/metadata/scans_to_process/"
+            + "raw_nifti_manifest.sqlite"
+        ),
+        help=(
+            "Path to the raw nifti manifest. Moved scan directories are added to it\n"
+            + "if it exists\n"
+            + "(default: %(default)s)"
+        ),
+    )
     parser.add_argument(
         "-o", "--overwrite", action="store_true", help="Overwrite existing files in raw"
     )
@@ -143,6 +442,16 @@ def _parse_args():
         dest="wipe_newdata",
         help="Don't wipe 'newdata' after moving scans to 'raw'",
     )
+    parser.add_argument(
+        "-n",
+        "--n-threads",
+        type=int,
+        default=8,
+        help=(
+            "Number of files to copy at once when 'newdata' and 'raw' are on\n"
+            + "different filesystems (default: %(default)s)"
+        ),
+    )
 
     # Parse the command line arguments
     args = parser.parse_args()
@@ -162,6 +471,8 @@ if __name__ == "__main__":
         raw_dir=args.raw,
         overwrite=args.overwrite,
         wipe_newdata=args.wipe_newdata,
+        manifest_file=args.manifest,
+        n_threads=args.n_threads,
     )
 
     # Exit successfully
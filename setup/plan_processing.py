@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+
+"""
+Plan pending MRI and PET processing as a task graph (dry run)
+
+Reads the latest raw MRI and PET indexes from scans_to_process and
+turns every scheduled scan into processing tasks with explicit
+dependencies:
+
+    freesurfer -> mri_post_freesurfer -> qc_image -> qc_eval
+    baseline mri_post_freesurfer -> follow-up mri_post_freesurfer
+    closest MRI's mri_post_freesurfer -> pet -> qc_image -> qc_eval
+
+Follow-up MRIs waiting on their baseline and PET scans waiting on their
+MRI are included when the scan they wait on is part of the plan, so the
+schedule covers the whole chain rather than just the next pass.
+
+Each task's cost is estimated from the elapsed times recorded in
+existing processing logs, and tasks are packed onto a fixed number of
+workers (longest remaining path first) to produce a parallel schedule
+that can be saved as JSON or CSV. Nothing is processed or created
+except the schedule file.
+"""
+
+import argparse
+import heapq
+import json
+import os
+import os.path as op
+import re
+import sys
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+utils_dir = op.join(op.dirname(__file__), "..", "utils")
+if utils_dir not in sys.path:
+    sys.path.append(utils_dir)
+import scan_index
+import utilities as uts
+
+# Define globals
+STAGES = ["freesurfer", "mri_post_freesurfer", "pet", "qc_image", "qc_eval"]
+DEFAULT_STAGE_SECONDS = {
+    "freesurfer": 8 * 3600,
+    "mri_post_freesurfer": 1800,
+    "pet": 600,
+    "qc_image": 60,
+    "qc_eval": 5,
+}
+LOG_STEP_PATTERN = re.compile(r"^(\d\d):(\d\d):(\d\d)  - (.*)$")
+LOG_TIME_PATTERN = re.compile(r"^TIME: (\d\d):(\d\d):(\d\d)")
+LOG_ELAPSED_PATTERN = re.compile(r"^Elapsed time: (?:(\d+)h, )?(?:(\d+)m, )?([\d.]+)s")
+
+
+def classify_log_step(msg, scan_type):
+    """Return the task stage that a top-level log step belongs to."""
+    if ("FreeSurfer" in msg) or ("brainstem into subregions" in msg):
+        return "freesurfer"
+    if ("QC image" in msg) or ("multislice" in msg):
+        return "qc_image"
+    if "QC eval" in msg:
+        return "qc_eval"
+    if "expected output files" in msg:
+        return None
+    return "mri_post_freesurfer" if scan_type == "MRI-T1" else "pet"
+
+
+def parse_log_durations(logf):
+    """Return {stage: seconds} spent in each stage of a processing log.
+
+    Top-level log steps ("HH:MM:SS  - message") are timed from one
+    step to the next, and the last step runs until the start time plus
+    the elapsed time recorded by log_close. Logs that ended in an error
+    or were never closed return None.
+
+    Parameters
+    ----------
+    logf : str
+        Path to a <scan_tag>_processed_<datetime>.log file.
+
+    Returns
+    -------
+    durations : dict or None
+    """
+    _, scan_type, _ = uts.parse_scan_tag(op.basename(logf).split("_processed_")[0])
+    start = elapsed = None
+    steps = []
+    with open(logf, errors="replace") as f:
+        for line in f:
+            if line.startswith("!! ERROR !!") or "  !! ERROR !!" in line:
+                return None
+            m = LOG_STEP_PATTERN.match(line)
+            if m:
+                h, mm, s = (int(x) for x in m.groups()[:3])
+                steps.append((h * 3600 + mm * 60 + s, m.group(4)))
+                continue
+            m = LOG_TIME_PATTERN.match(line)
+            if m and start is None:
+                h, mm, s = (int(x) for x in m.groups())
+                start = h * 3600 + mm * 60 + s
+                continue
+            m = LOG_ELAPSED_PATTERN.match(line)
+            if m:
+                h, mm, s = m.groups()
+                elapsed = int(h or 0) * 3600 + int(mm or 0) * 60 + float(s)
+    if (start is None) or (elapsed is None):
+        return None
+
+    # Convert step times to seconds since the start of the log, allowing
+    # for runs that pass midnight
+    times = []
+    offset = 0
+    prev = start
+    for t, _ in steps:
+        if t < prev:
+            offset += 86400
+        prev = t
+        times.append(t + offset - start)
+    bounds = [0] + times + [max(elapsed, times[-1] if times else 0)]
+    labels = [classify_log_step("", scan_type)] + [
+        classify_log_step(msg, scan_type) for _, msg in steps
+    ]
+
+    durations = defaultdict(float)
+    for label, t0, t1 in zip(labels, bounds[:-1], bounds[1:]):
+        if label is not None:
+            durations[label] += t1 - t0
+    return dict(durations)
+
+
+def estimate_costs(proc_dir, n_threads=16):
+    """Return median historical seconds per scan type and stage.
+
+    Parameters
+    ----------
+    proc_dir : str
+        The processed data directory, searched for
+        <subj>/<scan>/log/*_processed_*.log files.
+    n_threads : int
+        Number of directories to list at once.
+
+    Returns
+    -------
+    costs : DataFrame
+        Columns scan_type, stage, seconds, and n_logs.
+    """
+    rows = []
+    for logf in uts.walk_files(
+        proc_dir,
+        pattern="*_processed_*.log",
+        min_depth=4,
+        max_depth=4,
+        n_threads=n_threads,
+    ):
+        try:
+            durations = parse_log_durations(logf)
+        except (OSError, ValueError):
+            continue
+        if not durations:
+            continue
+        _, scan_type, _ = uts.parse_scan_tag(op.basename(logf).split("_processed_")[0])
+        for stage, seconds in durations.items():
+            # A stage that took no time was skipped (e.g. FreeSurfer
+            # already complete), so it says nothing about its cost
+            if seconds > 0:
+                rows.append((scan_type, stage, seconds))
+    durations = pd.DataFrame(rows, columns=["scan_type", "stage", "seconds"])
+    costs = (
+        durations.groupby(["scan_type", "stage"])["seconds"]
+        .agg(seconds="median", n_logs="size")
+        .reset_index()
+    )
+    return costs
+
+
+def cost_lookup(costs):
+    """Return a function (scan_type, stage) -> estimated seconds.
+
+    Falls back to the median across scan types for the stage, and then
+    to DEFAULT_STAGE_SECONDS.
+    """
+    by_type = {(row.scan_type, row.stage): row.seconds for row in costs.itertuples()}
+    by_stage = costs.groupby("stage")["seconds"].median().to_dict()
+
+    def lookup(scan_type, stage):
+        if (scan_type, stage) in by_type:
+            return float(by_type[(scan_type, stage)])
+        if stage in by_stage:
+            return float(by_stage[stage])
+        return float(DEFAULT_STAGE_SECONDS[stage])
+
+    return lookup
+
+
+def build_task_graph(raw_mris, raw_pets, costs=None, run_qc=True):
+    """Return a dataframe of processing tasks and their dependencies.
+
+    Parameters
+    ----------
+    raw_mris, raw_pets : DataFrame
+        Raw MRI and PET indexes saved by select_scans_to_process.py.
+    costs : DataFrame or None
+        Output of estimate_costs. If None, DEFAULT_STAGE_SECONDS is used.
+    run_qc : bool
+        Include QC image and QC eval tasks.
+
+    Returns
+    -------
+    tasks : DataFrame
+        One row per task with columns task_id, scan_tag, scan_type,
+        stage, scan_dir, scheduled_now (0 if the scan is waiting on
+        another scan in the plan), est_seconds, and depends_on (list of
+        task_ids).
+    """
+    if costs is None:
+        costs = pd.DataFrame(columns=["scan_type", "stage", "seconds"])
+    est = cost_lookup(costs)
+    tasks = []
+
+    def add_task(scan_tag, scan_type, stage, scan_dir, scheduled_now, depends_on):
+        task_id = f"{scan_tag}:{stage}"
+        tasks.append(
+            {
+                "task_id": task_id,
+                "scan_tag": scan_tag,
+                "scan_type": scan_type,
+                "stage": stage,
+                "scan_dir": scan_dir,
+                "scheduled_now": int(scheduled_now),
+                "est_seconds": est(scan_type, stage),
+                "depends_on": [d for d in depends_on if d is not None],
+            }
+        )
+        return task_id
+
+    def add_qc_tasks(scan_tag, scan_type, scan_dir, scheduled_now, main_task):
+        if run_qc:
+            qc_task = add_task(
+                scan_tag, scan_type, "qc_image", scan_dir, scheduled_now, [main_task]
+            )
+            add_task(scan_tag, scan_type, "qc_eval", scan_dir, scheduled_now, [qc_task])
+
+    # MRIs that are scheduled now, plus follow-ups that are only waiting
+    # on a baseline MRI that is scheduled now
+    mris = raw_mris.sort_values(["subj", "mri_date"], kind="stable")
+    scheduled = mris["scheduled_for_processing"] == 1
+    baseline_scheduled = mris["subj"].map(
+        mris.loc[scheduled & (mris["mri_scan_number"] == 1)]
+        .drop_duplicates("subj")
+        .set_index("subj")["mri_proc_dir"]
+    )
+    waiting = (
+        ~scheduled
+        & (mris["mri_processing_complete"] == 0)
+        & (mris["mri_is_orphan"] == 0)
+        & (mris["mri_scan_number"] > 1)
+        & baseline_scheduled.notna()
+    )
+    mris = mris.loc[scheduled | waiting]
+    post_fs_tasks = {}
+    for scan in mris.itertuples():
+        scan_tag = uts.get_scan_tag(scan.mri_proc_dir)
+        scheduled_now = scan.scheduled_for_processing == 1
+        fs_task = None
+        if scan.freesurfer_complete == 0:
+            fs_task = add_task(
+                scan_tag, "MRI-T1", "freesurfer", scan.mri_proc_dir, scheduled_now, []
+            )
+        baseline_task = None
+        if scan.mri_scan_number > 1:
+            baseline_task = post_fs_tasks.get(baseline_scheduled.get(scan.Index))
+        post_fs_task = add_task(
+            scan_tag,
+            "MRI-T1",
+            "mri_post_freesurfer",
+            scan.mri_proc_dir,
+            scheduled_now,
+            [fs_task, baseline_task],
+        )
+        post_fs_tasks[scan.mri_proc_dir] = post_fs_task
+        add_qc_tasks(scan_tag, "MRI-T1", scan.mri_proc_dir, scheduled_now, post_fs_task)
+
+    # PET scans that are scheduled now, plus PET scans that are only
+    # waiting on an MRI in the plan
+    scheduled = raw_pets["scheduled_for_processing"] == 1
+    waiting = (
+        ~scheduled
+        & (raw_pets["pet_processing_complete"] == 0)
+        & (raw_pets["flag"] == 0)
+        & raw_pets["mri_proc_dir"].isin(post_fs_tasks)
+    )
+    for scan in raw_pets.loc[scheduled | waiting].itertuples():
+        scan_tag = uts.get_scan_tag(scan.pet_proc_dir)
+        scheduled_now = scan.scheduled_for_processing == 1
+        pet_task = add_task(
+            scan_tag,
+            scan.tracer,
+            "pet",
+            scan.pet_proc_dir,
+            scheduled_now,
+            [post_fs_tasks.get(scan.mri_proc_dir)],
+        )
+        add_qc_tasks(scan_tag, scan.tracer, scan.pet_proc_dir, scheduled_now, pet_task)
+
+    columns = [
+        "task_id",
+        "scan_tag",
+        "scan_type",
+        "stage",
+        "scan_dir",
+        "scheduled_now",
+        "est_seconds",
+        "depends_on",
+    ]
+    return pd.DataFrame(tasks, columns=columns)
+
+
+def schedule_tasks(tasks, n_workers):
+    """Return tasks in topological order with a simulated schedule.
+
+    Tasks are started as soon as their dependencies are done and a
+    worker is free, taking the ready task with the longest remaining
+    path (its cost plus its longest chain of dependents) first.
+
+    Parameters
+    ----------
+    tasks : DataFrame
+        Output of build_task_graph.
+    n_workers : int
+        Number of tasks that can run at once.
+
+    Returns
+    -------
+    schedule : DataFrame
+        The tasks sorted by planned start time, with added columns
+        order, level (tasks with the same level have no dependencies on
+        each other), critical_path_seconds, worker, est_start, and
+        est_end (seconds from the start of the run).
+    """
+    n_workers = max(1, int(n_workers))
+    task_ids = tasks["task_id"].tolist()
+    pos = {task_id: i for i, task_id in enumerate(task_ids)}
+    cost = tasks["est_seconds"].to_numpy(dtype=float)
+    deps = [[pos[d] for d in depends_on] for depends_on in tasks["depends_on"]]
+    children = [[] for _ in task_ids]
+    for i, ds in enumerate(deps):
+        for d in ds:
+            children[d].append(i)
+
+    # Topological order (Kahn's algorithm) and levels
+    n_deps = np.array([len(ds) for ds in deps])
+    level = np.zeros(len(task_ids), dtype=int)
+    topo = [i for i in range(len(task_ids)) if n_deps[i] == 0]
+    remaining = n_deps.copy()
+    for i in topo:
+        for c in children[i]:
+            level[c] = max(level[c], level[i] + 1)
+            remaining[c] -= 1
+            if remaining[c] == 0:
+                topo.append(c)
+    if len(topo) != len(task_ids):
+        raise ValueError("Task graph contains a dependency cycle")
+
+    # Longest path from each task to the end of the graph
+    rank = cost.copy()
+    for i in reversed(topo):
+        if children[i]:
+            rank[i] = cost[i] + max(rank[c] for c in children[i])
+
+    # Simulate list scheduling on n_workers
+    start = np.zeros(len(task_ids))
+    end = np.zeros(len(task_ids))
+    worker = np.zeros(len(task_ids), dtype=int)
+    ready = [(-rank[i], i) for i in range(len(task_ids)) if n_deps[i] == 0]
+    heapq.heapify(ready)
+    idle = list(range(n_workers))
+    running = []
+    remaining = n_deps.copy()
+    now = 0.0
+    while ready or running:
+        while ready and idle:
+            _, i = heapq.heappop(ready)
+            worker[i] = heapq.heappop(idle)
+            start[i] = now
+            end[i] = now + cost[i]
+            heapq.heappush(running, (end[i], i))
+        now, i = heapq.heappop(running)
+        heapq.heappush(idle, worker[i])
+        for c in children[i]:
+            remaining[c] -= 1
+            if remaining[c] == 0:
+                heapq.heappush(ready, (-rank[c], c))
+
+    schedule = tasks.copy()
+    schedule["level"] = level
+    schedule["critical_path_seconds"] = rank
+    schedule["worker"] = worker
+    schedule["est_start"] = start
+    schedule["est_end"] = end
+    schedule = schedule.sort_values(
+        ["est_start", "critical_path_seconds"], ascending=[True, False], kind="stable"
+    ).reset_index(drop=True)
+    schedule.insert(0, "order", np.arange(1, len(schedule) + 1))
+    return schedule
+
+
+def save_schedule(schedule, outf):
+    """Save the schedule to a .json or .csv file."""
+    if outf.endswith(".json"):
+        with open(outf, "w") as f:
+            json.dump(schedule.to_dict(orient="records"), f, indent=2)
+    elif outf.endswith(".csv"):
+        schedule = schedule.copy()
+        schedule["depends_on"] = schedule["depends_on"].apply(";".join)
+        schedule.to_csv(outf, index=False)
+    else:
+        raise ValueError(f"Schedule file must end in .json or .csv: {outf}")
+    print(f"  * Saved processing schedule to {outf}")
+
+
+def format_seconds(seconds):
+    """Return seconds formatted as e.g. '3h, 12m'."""
+    seconds = int(round(seconds))
+    hh, mm = seconds // 3600, (seconds % 3600) // 60
+    if hh:
+        return f"{hh}h, {mm}m"
+    return f"{mm}m, {seconds % 60}s"
+
+
+def main(
+    proj_dir,
+    n_workers=None,
+    outf=None,
+    run_qc=True,
+    use_log_costs=True,
+):
+    """Plan pending processing work and save the schedule.
+
+    Returns
+    -------
+    schedule : DataFrame
+        Output of schedule_tasks.
+    """
+    proc_dir = op.abspath(op.join(proj_dir, "data", "processed"))
+    scans_to_process_dir = op.abspath(op.join(proj_dir, "metadata", "scans_to_process"))
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    raw_mris = scan_index.load_index(scans_to_process_dir, "MRI-T1")
+    raw_pets = scan_index.load_index(scans_to_process_dir, "PET")
+    if use_log_costs:
+        print(f"  * Estimating task costs from processing logs in {proc_dir}")
+        costs = estimate_costs(proc_dir)
+        print(f"    - Parsed {int(costs['n_logs'].sum()):,} timed stages")
+    else:
+        costs = None
+    tasks = build_task_graph(raw_mris, raw_pets, costs, run_qc=run_qc)
+    schedule = schedule_tasks(tasks, n_workers)
+
+    # Summarize the plan
+    print(f"  * Planned {len(schedule):,} tasks")
+    for stage in STAGES:
+        n = (schedule["stage"] == stage).sum()
+        if n:
+            print(f"    - {n:,} {stage}")
+    n_waiting = schedule.loc[schedule["scheduled_now"] == 0, "scan_tag"].nunique()
+    if n_waiting:
+        print(f"    - {n_waiting:,} scans are waiting on another scan in the plan")
+    if len(schedule):
+        serial = schedule["est_seconds"].sum()
+        makespan = schedule["est_end"].max()
+        print(
+            "  * Estimated time: {} on {} workers ({} serially; critical path {})".format(
+                format_seconds(makespan),
+                n_workers,
+                format_seconds(serial),
+                format_seconds(schedule["critical_path_seconds"].max()),
+            )
+        )
+
+    if outf is None:
+        outf = op.join(scans_to_process_dir, f"processing_schedule_{uts.now()}.json")
+    save_schedule(schedule, outf)
+    return schedule
+
+
+def _parse_args():
+    """Parse and return command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=(
+            "Dry-run planner for MRI and PET processing.\n\n"
+            + "Builds a task graph from the latest raw MRI and PET indexes\n"
+            + "(FreeSurfer, post-FreeSurfer, PET, QC image, QC eval), estimates\n"
+            + "each task's cost from existing processing logs, and saves a\n"
+            + "topologically sorted schedule packed onto --n-workers workers.\n"
+            + "Nothing is processed."
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+        exit_on_error=False,
+    )
+    parser.add_argument(
+        "-p",
+        "--proj-dir",
+        default="/mnt/coredata/processing/leads",
+        help="Full path to the top-level project directory (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-n",
+        "--n-workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of tasks that can run at once (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-o",
+        "--outfile",
+        dest="outf",
+        help=(
+            "Schedule file to save (.json or .csv). Default:\n"
+            + "<proj_dir>/metadata/scans_to_process/processing_schedule_<timestamp>.json"
+        ),
+    )
+    parser.add_argument(
+        "--no-qc",
+        action="store_false",
+        dest="run_qc",
+        help="Don't plan QC image and QC eval tasks",
+    )
+    parser.add_argument(
+        "--no-log-costs",
+        action="store_false",
+        dest="use_log_costs",
+        help="Use default task costs instead of reading processing logs",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    main(
+        proj_dir=args.proj_dir,
+        n_workers=args.n_workers,
+        outf=args.outf,
+        run_qc=args.run_qc,
+        use_log_costs=args.use_log_costs,
+    )
+    sys.exit(0)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+"""
+Reversible removal of processed scan directories
+
+Instead of deleting processed scan directories outright, they are moved
+into a quarantine directory inside the processed directory:
+
+    <proc_dir>/.quarantine/<timestamp>/<subj>/<scan_dir>
+
+Because the quarantine is on the same filesystem, each move is a single
+rename no matter how large the directory is. Each batch records where
+its directories came from in a manifest.json, so a mistaken purge can
+be undone with --restore. Batches older than a set number of days are
+deleted by garbage collection, which select_scans_to_process.py starts
+as a detached background process so that indexing does not wait on it.
+"""
+
+import argparse
+import json
+import os
+import os.path as op
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+utils_dir = op.join(op.dirname(__file__), "..", "utils")
+if utils_dir not in sys.path:
+    sys.path.append(utils_dir)
+import utilities as uts
+
+# Define globals
+QUARANTINE_DIRNAME = ".quarantine"
+MANIFEST_BASENAME = "manifest.json"
+KEEP_DAYS = 7
+
+
+def quarantine_dir(proc_dir):
+    """Return the quarantine directory for a processed directory."""
+    return op.join(proc_dir, QUARANTINE_DIRNAME)
+
+
+def quarantine_scan_dirs(scan_dirs, proc_dir, n_threads=16):
+    """Move processed scan directories into a new quarantine batch.
+
+    Parameters
+    ----------
+    scan_dirs : list of str
+        Processed scan directories (<proc_dir>/<subj>/<scan_dir>).
+    proc_dir : str
+        The processed directory.
+    n_threads : int
+        Number of directories to move at once.
+
+    Returns
+    -------
+    batch_dir : str or None
+        The new quarantine batch, or None if scan_dirs was empty.
+    errors : dict
+        {scan_dir: error message} for directories that could not be
+        moved.
+    """
+    scan_dirs = sorted(set(scan_dirs))
+    if len(scan_dirs) == 0:
+        return None, {}
+
+    # Record every planned move before making any of them
+    batch_dir = op.join(quarantine_dir(proc_dir), uts.now())
+    suffix = 1
+    while op.exists(batch_dir):
+        batch_dir = op.join(quarantine_dir(proc_dir), f"{uts.now()}_{suffix}")
+        suffix += 1
+    moves = {
+        scan_dir: op.join(batch_dir, op.relpath(scan_dir, proc_dir))
+        for scan_dir in scan_dirs
+    }
+    os.makedirs(batch_dir)
+    with open(op.join(batch_dir, MANIFEST_BASENAME), "w") as f:
+        json.dump(moves, f, indent=2)
+
+    def move(scan_dir):
+        try:
+            os.makedirs(op.dirname(moves[scan_dir]), exist_ok=True)
+            os.rename(scan_dir, moves[scan_dir])
+        except OSError as e:
+            return str(e)
+        return None
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        results = executor.map(move, scan_dirs)
+    errors = {
+        scan_dir: msg for scan_dir, msg in zip(scan_dirs, results) if msg is not None
+    }
+    return batch_dir, errors
+
+
+def list_batches(proc_dir):
+    """Return quarantine batch directories, oldest first."""
+    if not op.isdir(quarantine_dir(proc_dir)):
+        return []
+    return sorted(
+        entry.path
+        for entry in os.scandir(quarantine_dir(proc_dir))
+        if entry.is_dir() and op.isfile(op.join(entry.path, MANIFEST_BASENAME))
+    )
+
+
+def restore_batch(batch_dir):
+    """Move the directories in a quarantine batch back where they came from.
+
+    Directories whose original location exists again (e.g. because the
+    scan has since been reprocessed) are left in quarantine. The batch
+    is removed once it is empty.
+
+    Returns
+    -------
+    restored : list of str
+        Original scan directories that were restored.
+    skipped : list of str
+        Original scan directories that already exist again.
+    """
+    with open(op.join(batch_dir, MANIFEST_BASENAME)) as f:
+        moves = json.load(f)
+    restored = []
+    skipped = []
+    for scan_dir, quarantined in moves.items():
+        if not op.isdir(quarantined):
+            continue
+        if op.lexists(scan_dir):
+            skipped.append(scan_dir)
+            continue
+        os.makedirs(op.dirname(scan_dir), exist_ok=True)
+        os.rename(quarantined, scan_dir)
+        restored.append(scan_dir)
+    if not skipped:
+        shutil.rmtree(batch_dir)
+    return restored, skipped
+
+
+def collect_garbage(proc_dir, keep_days=KEEP_DAYS):
+    """Delete quarantine batches that are older than keep_days.
+
+    Returns
+    -------
+    removed : list of str
+        Batch directories that were deleted.
+    """
+    cutoff = time.time() - (keep_days * 86400)
+    removed = []
+    for batch_dir in list_batches(proc_dir):
+        if os.stat(op.join(batch_dir, MANIFEST_BASENAME)).st_mtime < cutoff:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+            removed.append(batch_dir)
+    return removed
+
+
+def start_background_gc(proc_dir, keep_days=KEEP_DAYS):
+    """Run collect_garbage in a detached process and return immediately.
+
+    Output is appended to <proc_dir>/.quarantine/gc.log.
+    """
+    if not op.isdir(quarantine_dir(proc_dir)):
+        return None
+    logf = open(op.join(quarantine_dir(proc_dir), "gc.log"), "a")
+    cmd = [
+        sys.executable,
+        op.abspath(__file__),
+        "--proc-dir",
+        proc_dir,
+        "--gc",
+        "--keep-days",
+        str(keep_days),
+    ]
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=logf,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    )
+    logf.close()
+    return proc
+
+
+def _parse_args():
+    """Parse and return command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=(
+            "List, restore, or garbage collect processed scan directories that\n"
+            + "were moved to quarantine"
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+        exit_on_error=False,
+    )
+    parser.add_argument(
+        "--proc-dir",
+        default="/mnt/coredata/processing/leads/data/processed",
+        help="Path to the processed directory (default: %(default)s)",
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--restore",
+        metavar="BATCH",
+        help=(
+            "Restore the directories in a quarantine batch (a batch name\n"
+            + "from the listing, or 'latest')"
+        ),
+    )
+    group.add_argument(
+        "--gc",
+        action="store_true",
+        help="Delete quarantine batches older than --keep-days",
+    )
+    parser.add_argument(
+        "--keep-days",
+        type=float,
+        default=KEEP_DAYS,
+        help="Days to keep quarantined directories (default: %(default)s)",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    proc_dir = op.abspath(args.proc_dir)
+    if args.gc:
+        for batch_dir in collect_garbage(proc_dir, args.keep_days):
+            print(f"{uts.now()}: removed {batch_dir}")
+    elif args.restore:
+        batches = list_batches(proc_dir)
+        if args.restore == "latest":
+            if len(batches) == 0:
+                print(f"No quarantine batches in {quarantine_dir(proc_dir)}")
+                sys.exit(1)
+            batch_dir = batches[-1]
+        else:
+            batch_dir = op.join(quarantine_dir(proc_dir), args.restore)
+        restored, skipped = restore_batch(batch_dir)
+        for scan_dir in restored:
+            print(f"  * Restored {scan_dir}")
+        for scan_dir in skipped:
+            print(f"!!  - {scan_dir} ALREADY EXISTS; LEFT IN {batch_dir}")
+    else:
+        for batch_dir in list_batches(proc_dir):
+            with open(op.join(batch_dir, MANIFEST_BASENAME)) as f:
+                n = len(json.load(f))
+            print(f"  * {op.basename(batch_dir)}: {n} directories")
+    sys.exit(0)
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+"""
+Persistent manifest of the nifti files in the raw directory
+
+The manifest is a SQLite database (by default saved as
+raw_nifti_manifest.sqlite in 'metadata/scans_to_process') that records
+every directory under 'raw' with its mtime, and every *.nii file with
+its mtime, size, and the scan info parsed from its filepath. Adding,
+removing, or renaming an entry in a directory changes that directory's
+mtime, so on later runs only directories whose mtime has changed are
+re-listed, and only files that were not already in the manifest are
+parsed. Directories whose mtime is unchanged are stat'd but not read.
+"""
+
+import argparse
+import hashlib
+import os
+import os.path as op
+import sqlite3
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Define globals
+MANIFEST_BASENAME = "raw_nifti_manifest.sqlite"
+PARSED_COLS = ["subj", "scan_type", "scan_date", "image_id"]
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS niftis (
+    path TEXT PRIMARY KEY,
+    dir TEXT,
+    mtime_ns INTEGER,
+    size INTEGER,
+    parsed INTEGER DEFAULT 0,
+    subj TEXT,
+    scan_type TEXT,
+    scan_date TEXT,
+    image_id TEXT
+);
+CREATE INDEX IF NOT EXISTS niftis_dir ON niftis (dir);
+"""
+
+
+def manifest_file(scans_to_process_dir):
+    """Return the manifest filepath in scans_to_process_dir."""
+    return op.join(scans_to_process_dir, MANIFEST_BASENAME)
+
+
+def parse_key(raw_dir, scan_types):
+    """Return a key that changes whenever parsed fields could change.
+
+    Parsed fields depend on the raw directory (for subject IDs) and the
+    scan types config (for scan types), so the manifest reparses every
+    file if either of these changes between runs.
+    """
+    h = hashlib.sha1(op.abspath(raw_dir).encode())
+    for name_in in sorted(scan_types):
+        h.update(f"\n{name_in},{scan_types[name_in]}".encode())
+    return h.hexdigest()
+
+
+class RawManifest:
+    """Incrementally updated index of the *.nii files in raw."""
+
+    def __init__(self, manifest_file):
+        self.manifest_file = op.abspath(manifest_file)
+        self.conn = sqlite3.connect(self.manifest_file)
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close the database connection."""
+        self.conn.close()
+
+    def clear(self):
+        """Remove all directories and files from the manifest."""
+        with self.conn:
+            self.conn.execute("DELETE FROM dirs")
+            self.conn.execute("DELETE FROM niftis")
+            self.conn.execute("DELETE FROM meta")
+
+    def scan(self, top_dir):
+        """Bring the manifest up to date with everything under top_dir.
+
+        Each directory is stat'd. Directories with an unchanged mtime
+        are not read; their subdirectories are taken from the manifest.
+        Other directories are re-listed, and files and subdirectories
+        that no longer exist are dropped.
+
+        Parameters
+        ----------
+        top_dir : str
+            The directory to scan. Normally this is raw, but a
+            subdirectory can be passed to record newly added scans
+            without walking the rest of raw.
+
+        Returns
+        -------
+        n_listed : int
+            Number of directories that were re-listed.
+        """
+        top_dir = op.abspath(top_dir)
+        n_listed = 0
+        stack = [top_dir]
+        with self.conn:
+            while stack:
+                d = stack.pop()
+                try:
+                    mtime_ns = os.stat(d).st_mtime_ns
+                except FileNotFoundError:
+                    self._drop_tree(d)
+                    continue
+
+                row = self.conn.execute(
+                    "SELECT mtime_ns FROM dirs WHERE path = ?", (d,)
+                ).fetchone()
+                if (row is not None) and (row[0] == mtime_ns):
+                    for child in self._child_dirs(d):
+                        # Hidden directories may have been recorded before
+                        # _list_dir skipped them
+                        if op.basename(child).startswith("."):
+                            self._drop_tree(child)
+                        else:
+                            stack.append(child)
+                    continue
+
+                subdirs, files = self._list_dir(d)
+                self._update_dir(d, mtime_ns, subdirs, files)
+                stack.extend(subdirs)
+                n_listed += 1
+        return n_listed
+
+    def parse(self, raw_dir, scan_types, parse_func):
+        """Parse scan info for files that have not been parsed yet.
+
+        Parameters
+        ----------
+        raw_dir : str
+            The raw directory, passed through to parse_func.
+        scan_types : dict
+            Scan types config, passed through to parse_func.
+        parse_func : callable
+            Called as parse_func(filepaths, raw_dir, scan_types) and
+            returns a dataframe with PARSED_COLS and 'raw_niif'.
+
+        Returns
+        -------
+        n_parsed : int
+            Number of files that were parsed.
+        """
+        key = parse_key(raw_dir, scan_types)
+        with self.conn:
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE key = 'parse_key'"
+            ).fetchone()
+            if (row is None) or (row[0] != key):
+                self.conn.execute("UPDATE niftis SET parsed = 0")
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('parse_key', ?)", (key,)
+                )
+
+            filepaths = [
+                r[0]
+                for r in self.conn.execute(
+                    "SELECT path FROM niftis WHERE parsed = 0 ORDER BY path"
+                )
+            ]
+            if len(filepaths) == 0:
+                return 0
+
+            parsed = parse_func(filepaths, raw_dir, scan_types)
+            parsed = parsed.astype(object).where(parsed.notna(), None)
+            self.conn.executemany(
+                "UPDATE niftis SET parsed = 1, subj = ?, scan_type = ?, "
+                + "scan_date = ?, image_id = ? WHERE path = ?",
+                parsed[PARSED_COLS + ["raw_niif"]].itertuples(index=False, name=None),
+            )
+        return len(filepaths)
+
+    def update(self, raw_dir, scan_types, parse_func, verbose=True):
+        """Scan raw, parse new files, and return the full manifest.
+
+        Returns
+        -------
+        raw_niis : DataFrame
+            Columns subj, scan_type, scan_date, image_id, raw_niif, in
+            the same format as parse_func returns, sorted by filepath.
+        """
+        n_listed = self.scan(raw_dir)
+        n_parsed = self.parse(raw_dir, scan_types, parse_func)
+        if verbose:
+            print(
+                "    - Manifest: {:,} directories re-listed, {:,} new niftis parsed".format(
+                    n_listed, n_parsed
+                )
+            )
+        return self.load(raw_dir)
+
+    def load(self, top_dir=None):
+        """Return parsed manifest entries, optionally limited to top_dir."""
+        query = (
+            "SELECT subj, scan_type, scan_date, image_id, path AS raw_niif "
+            + "FROM niftis WHERE parsed = 1"
+        )
+        params = ()
+        if top_dir is not None:
+            prefix = op.abspath(top_dir) + os.sep
+            query += " AND substr(path, 1, ?) = ?"
+            params = (len(prefix), prefix)
+        raw_niis = pd.read_sql_query(query + " ORDER BY path", self.conn, params=params)
+        raw_niis = raw_niis.astype(object)
+        return raw_niis.where(raw_niis.notna(), np.nan)
+
+    def _child_dirs(self, d):
+        """Return subdirectories of d recorded in the manifest."""
+        return [
+            r[0]
+            for r in self.conn.execute("SELECT path FROM dirs WHERE parent = ?", (d,))
+        ]
+
+    @staticmethod
+    def _list_dir(d):
+        """Return subdirectories and {*.nii file: (mtime_ns, size)} in d.
+
+        Hidden entries are skipped, like in fast_recursive_glob_nii.
+        """
+        subdirs = []
+        files = {}
+        with os.scandir(d) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                elif entry.is_file() and entry.name.endswith(".nii"):
+                    st = entry.stat()
+                    files[entry.path] = (st.st_mtime_ns, st.st_size)
+        return subdirs, files
+
+    def _update_dir(self, d, mtime_ns, subdirs, files):
+        """Replace the manifest entries for one directory listing."""
+        subdirs = set(subdirs)
+        for child in self._child_dirs(d):
+            if child not in subdirs:
+                self._drop_tree(child)
+
+        old_files = {
+            r[0]: (r[1], r[2])
+            for r in self.conn.execute(
+                "SELECT path, mtime_ns, size FROM niftis WHERE dir = ?", (d,)
+            )
+        }
+        self.conn.executemany(
+            "DELETE FROM niftis WHERE path = ?",
+            [(f,) for f in old_files if f not in files],
+        )
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO niftis (path, dir, mtime_ns, size) "
+            + "VALUES (?, ?, ?, ?)",
+            [(f, d, *files[f]) for f in files if f not in old_files],
+        )
+        self.conn.executemany(
+            "UPDATE niftis SET mtime_ns = ?, size = ? WHERE path = ?",
+            [(*files[f], f) for f in files if old_files.get(f, files[f]) != files[f]],
+        )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+            (d, op.dirname(d), mtime_ns),
+        )
+
+    def _drop_tree(self, d):
+        """Remove d and everything below it from the manifest."""
+        prefix = d + os.sep
+        for table, col in [("dirs", "path"), ("niftis", "dir")]:
+            self.conn.execute(
+                f"DELETE FROM {table} WHERE {col} = ? OR substr({col}, 1, ?) = ?",
+                (d, len(prefix), prefix),
+            )
+
+
+def _parse_args():
+    """Parse and return command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=(
+            "Update the raw nifti manifest and print how many files it contains.\n\n"
+            + "Files are parsed the same way as select_scans_to_process.py, so this\n"
+            + "can be run ahead of time to warm the manifest."
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+        exit_on_error=False,
+    )
+    parser.add_argument(
+        "-p",
+        "--proj-dir",
+        required=True,
+        help="Full path to the top-level project directory",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Clear the manifest and rebuild it from scratch",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import select_scans_to_process as ssp
+
+    args = _parse_args()
+    raw_dir = op.abspath(op.join(args.proj_dir, "data", "raw"))
+    scan_types = ssp.load_scan_typesf(
+        op.join(args.proj_dir, "code", "config", "scan_types_and_tracers.csv")
+    )
+    scans_to_process_dir = op.join(args.proj_dir, "metadata", "scans_to_process")
+    with RawManifest(manifest_file(scans_to_process_dir)) as manifest:
+        if args.rebuild:
+            manifest.clear()
+        raw_niis = manifest.update(raw_dir, scan_types, ssp.parse_raw_niis)
+    print(f"  * {len(raw_niis):,} niftis in {raw_dir}")
+    sys.exit(0)
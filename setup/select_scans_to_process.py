@@ -6,11 +6,13 @@ Select MRI and PET scans to process and save the list to CSV files
 
 import argparse
 import datetime
+import fnmatch
+import functools
 import os
 import os.path as op
 import re
-import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 
 import numpy as np
@@ -19,10 +21,37 @@ import pandas as pd
 utils_dir = op.join(op.dirname(__file__), "..", "utils")
 if utils_dir not in sys.path:
     sys.path.append(utils_dir)
+import quarantine
+import scan_index
 import utilities as uts
+from raw_manifest import RawManifest, manifest_file
 
 # Define globals
 AMYLOID_TRACERS = ["FBB", "FBP", "FLUTE", "NAV", "PIB"]
+SCAN_TYPE_MULTI_MATCH = "FILENAME MATCHED MULTIPLE PET TRACERS OR MRI MODALITIES"
+SCAN_TYPE_NO_MATCH = "FAILED TO IDENTIFY PET TRACER OR MRI MODALITY FROM FILENAME"
+FREESURFER_OUTPUTS = [
+    "nu.mgz",
+    "aparc+aseg.mgz",
+    "brainstemSsLabels.v12.FSvoxelSpace.mgz",
+]
+MRI_SEG_OUTPUTS = {"seg_nu": "c*nu.nii"}
+MRI_PROC_OUTPUTS = {
+    "affine_nu": "a*nu.nii",
+    "c1": "c1*_nu.nii",
+    "c2": "c1*_nu.nii",
+    "fwd_deformation": "y*_nu.nii",
+    "inv_deformation": "iy*_nu.nii",
+    "mask_brainstem": "*mask-brainstem.nii",
+    "mask_eroded_subcortwm": "*mask-eroded-subcortwm.nii",
+    "mask_infcblgm": "*mask-infcblgm.nii",
+    "mask_pons": "*mask-pons.nii",
+    "mask_wcbl": "*mask-wcbl.nii",
+    "mwc1": "mwc1*_nu.nii",
+    "warp_nu": "w*_nu.nii",
+    "qc_image": "*_qc.png",
+    "suit_atlas": "*_cbl-suit.nii",
+}
 
 
 def main(
@@ -38,18 +67,24 @@ def main(
     check_brainstem=True,
     reprocess_pet_to_closest_mri=True,
     save_csv=True,
+    use_manifest=True,
+    rebuild_manifest=False,
 ):
     """Save CSV files for MRI and PET scans in the raw directory.
 
     Indicate which scans need to be processed.
 
+    If use_manifest is True, the raw directory is indexed through the
+    persistent manifest in scans_to_process (see raw_manifest.py), so
+    only directories that have changed since the last run are re-listed
+    and only new files are parsed.
+
     Returns
     -------
     None
     """
     # Define paths to the needed directories
     raw_dir = op.abspath(op.join(proj_dir, "data", "raw"))
-    raw_base = op.basename(raw_dir)
     proc_dir = op.abspath(op.join(proj_dir, "data", "processed"))
     config_dir = op.abspath(op.join(proj_dir, "code", "config"))
     scans_to_process_dir = op.abspath(op.join(proj_dir, "metadata", "scans_to_process"))
@@ -61,25 +96,18 @@ def main(
     scan_typesf = op.join(config_dir, "scan_types_and_tracers.csv")
     scan_types = load_scan_typesf(scan_typesf)
 
-    # Get a list of all directories containing .nii files
+    # Get a list of all directories containing .nii files, and find the
+    # subject ID, scan type, acquisition date, and LONI image ID for each
+    # nifti file in raw
     print(f"  * Searching {raw_dir} for all *.nii files")
-    raw_niis = fast_recursive_glob_nii(raw_dir)
-
-    # Find the subject ID, scan type, acquisition date, and LONI image ID
-    # for each nifti file in raw
-    raw_niis = pd.DataFrame(raw_niis, columns=["raw_niif"])
-    raw_niis.insert(
-        0, "subj", raw_niis["raw_niif"].apply(lambda x: get_subj(x, raw_dir))
-    )
-    raw_niis.insert(
-        1,
-        "scan_type",
-        raw_niis["raw_niif"].apply(lambda x: get_scan_type(x, scan_types, raw_base)),
-    )
-    raw_niis.insert(
-        2, "scan_date", raw_niis["raw_niif"].apply(lambda x: get_scan_date(x, raw_base))
-    )
-    raw_niis.insert(3, "image_id", raw_niis["raw_niif"].apply(get_image_id))
+    if use_manifest:
+        with RawManifest(manifest_file(scans_to_process_dir)) as manifest:
+            if rebuild_manifest:
+                manifest.clear()
+            raw_niis = manifest.update(raw_dir, scan_types, parse_raw_niis)
+    else:
+        raw_niis = fast_recursive_glob_nii(raw_dir)
+        raw_niis = parse_raw_niis(raw_niis, raw_dir, scan_types)
 
     # Convert the date column to datetime
     raw_niis["scan_date"] = pd.to_datetime(raw_niis["scan_date"])
@@ -120,7 +148,7 @@ def main(
     raw_pets.insert(
         raw_pets.columns.tolist().index("pet_date") + 1,
         "pet_res",
-        raw_pets["pet_raw_niif"].apply(get_pet_resolution),
+        get_pet_resolutions(raw_pets["pet_raw_niif"]),
     )
 
     # Report how many MRI and PET scans are in the raw directory
@@ -146,9 +174,12 @@ def main(
     # the time between them
     raw_pets = add_pet_date_columns(raw_pets)
 
-    # Match each PET scan to its closest MRI
+    # Match each PET scan to its closest MRI. When scans tie, keep the
+    # ones that already processed PET scans were set up with
     print("  * Matching each PET scan to its closest MRI")
-    raw_pets = find_closest_mri_to_pet(raw_pets, raw_mris)
+    raw_pets = find_closest_mri_to_pet(
+        raw_pets, raw_mris, linked_scans=get_linked_scans(raw_pets, proc_dir)
+    )
 
     # Figure out which MRIs are actually used for PET processing
     raw_mris = get_orphan_mris(raw_mris, raw_pets, orphan_mri_tolerance)
@@ -184,11 +215,11 @@ def main(
 
     # Add path to the processed MRI directory
     ii = raw_mris.columns.tolist().index("mri_raw_niif")
-    raw_mris["mri_proc_dir"] = raw_mris.apply(
-        lambda x: get_mri_proc_dir(x["subj"], x["mri_date"], proc_dir), axis=1
+    raw_mris["mri_proc_dir"] = get_mri_proc_dirs(
+        raw_mris["subj"], raw_mris["mri_date"], proc_dir
     )
-    raw_pets["mri_proc_dir"] = raw_pets.apply(
-        lambda x: get_mri_proc_dir(x["subj"], x["mri_date"], proc_dir), axis=1
+    raw_pets["mri_proc_dir"] = get_mri_proc_dirs(
+        raw_pets["subj"], raw_pets["mri_date"], proc_dir
     )
 
     # Add path to the processed PET directory
@@ -196,22 +227,19 @@ def main(
     raw_pets.insert(
         ii + 1,
         "pet_proc_dir",
-        raw_pets.apply(
-            lambda x: get_pet_proc_dir(x["subj"], x["tracer"], x["pet_date"], proc_dir),
-            axis=1,
+        get_pet_proc_dirs(
+            raw_pets["subj"], raw_pets["tracer"], raw_pets["pet_date"], proc_dir
         ),
     )
 
     # Determine which MRIs have been processed
-    raw_mris["freesurfer_complete"] = raw_mris["mri_proc_dir"].apply(
-        lambda x: check_if_freesurfer_run(x, check_brainstem)
-    )
-    raw_mris["mri_seg_complete"] = raw_mris["mri_proc_dir"].apply(
-        check_if_mri_seg_complete
-    )
-    raw_mris["mri_processing_complete"] = raw_mris["mri_proc_dir"].apply(
-        check_if_mri_processed
-    )
+    mri_outputs = check_mri_outputs(raw_mris["mri_proc_dir"], check_brainstem)
+    for col in [
+        "freesurfer_complete",
+        "mri_seg_complete",
+        "mri_processing_complete",
+    ]:
+        raw_mris[col] = raw_mris["mri_proc_dir"].map(mri_outputs[col])
 
     # Schedule MRIs for processing
     baseline_mri_seg_complete = (
@@ -219,16 +247,13 @@ def main(
         .set_index("subj")["mri_seg_complete"]
         .to_dict()
     )
-    raw_mris["scheduled_for_processing"] = raw_mris.apply(
-        lambda x: get_mri_to_process(
-            x["mri_scan_number"],
-            x["mri_is_orphan"],
-            x["mri_processing_complete"],
-            baseline_mri_seg_complete[x["subj"]],
-            overwrite,
-            schedule_all_mris,
-        ),
-        axis=1,
+    raw_mris["scheduled_for_processing"] = get_mris_to_process(
+        raw_mris["mri_scan_number"],
+        raw_mris["mri_is_orphan"],
+        raw_mris["mri_processing_complete"],
+        raw_mris["subj"].map(baseline_mri_seg_complete),
+        overwrite,
+        schedule_all_mris,
     )
 
     # Summarize how many MRIs have been or still need to be processed
@@ -284,11 +309,8 @@ def main(
     raw_pets.insert(
         ii + 1,
         "pet_not_processed_to_closest_mri",
-        raw_pets.apply(
-            lambda x: check_if_pet_not_processed_to_closest_mri(
-                x["pet_proc_dir"], x["mri_proc_dir"]
-            ),
-            axis=1,
+        check_pets_not_processed_to_closest_mri(
+            raw_pets["pet_proc_dir"], raw_pets["mri_proc_dir"]
         ),
     )
     if reprocess_pet_to_closest_mri:
@@ -304,42 +326,57 @@ def main(
             print(
                 f"\nNOTE: {n} PET {s1} been processed to an MRI that is not",
                 "the closest MRI in the raw directory. As `reprocess_pet_to_closest_mri`",
-                f"is set to True, the following processed PET {s2} will be removed so the",
-                "PET scan can be reprocessed:",
+                f"is set to True, the following processed PET {s2} will be moved to",
+                "quarantine so the PET scan can be reprocessed:",
+                sep="\n",
+            )
+            for pet_dir_to_reprocess in sorted(pet_dirs_to_reprocess):
+                print(f"  - {pet_dir_to_reprocess}")
+            batch_dir, errors = quarantine.quarantine_scan_dirs(
+                pet_dirs_to_reprocess, proc_dir
+            )
+            for pet_dir, msg in errors.items():
+                print(f"!!  - COULD NOT MOVE {pet_dir} TO QUARANTINE: {msg}")
+            print(
+                f"  * Moved to {batch_dir}",
+                "    (undo with: python {} --proc-dir {} --restore {})".format(
+                    op.abspath(quarantine.__file__), proc_dir, op.basename(batch_dir)
+                ),
                 sep="\n",
             )
-        for pet_dir_to_reprocess in pet_dirs_to_reprocess:
-            print(f"  - {pet_dir_to_reprocess}")
-            shutil.rmtree(pet_dir_to_reprocess)
+
+        # Delete old quarantine batches in the background
+        quarantine.start_background_gc(proc_dir)
 
         # Drop the `pet_not_processed_to_closest_mri` column from the dataframe
         raw_pets = raw_pets.drop(columns=["pet_not_processed_to_closest_mri"])
 
     # Determine which PET scans have been processed
     ii = raw_pets.columns.tolist().index("mri_raw_niif")
-    mri_processed = raw_mris.set_index("mri_image_id")[
-        "mri_processing_complete"
-    ].to_dict()
+    # MRIs without an image ID can't be matched, and map() needs unique keys
+    mri_processed = (
+        raw_mris.dropna(subset=["mri_image_id"])
+        .drop_duplicates("mri_image_id", keep="last")
+        .set_index("mri_image_id")["mri_processing_complete"]
+    )
     raw_pets.insert(
         ii + 2,
         "mri_processing_complete",
-        raw_pets["mri_image_id"].apply(lambda x: mri_processed.get(x, np.nan)),
+        raw_pets["mri_image_id"].map(mri_processed),
     )
+    pet_outputs = check_pet_outputs(raw_pets["pet_proc_dir"])
     raw_pets.insert(
         ii + 3,
         "pet_processing_complete",
-        raw_pets["pet_proc_dir"].apply(check_if_pet_processed),
+        raw_pets["pet_proc_dir"].map(pet_outputs["pet_processing_complete"]),
     )
 
     # Schedule PET scans for processing
-    raw_pets["scheduled_for_processing"] = raw_pets.apply(
-        lambda x: get_pet_to_process(
-            x["pet_processing_complete"],
-            x["mri_processing_complete"],
-            x["flag"],
-            overwrite,
-        ),
-        axis=1,
+    raw_pets["scheduled_for_processing"] = get_pets_to_process(
+        raw_pets["pet_processing_complete"],
+        raw_pets["mri_processing_complete"],
+        raw_pets["flag"],
+        overwrite,
     )
 
     # Summarize how many PET scans have been or still need to be processed
@@ -467,21 +504,128 @@ def load_scan_typesf(scan_typesf):
     return scan_types
 
 
-def fast_recursive_glob_nii(path):
-    """Return a list of all files in path that end in .nii"""
+def fast_recursive_glob_nii(path, n_threads=8):
+    """Return a sorted list of all files in path that end in .nii
+
+    Hidden files and directories are skipped, as they hold partial
+    copies and extractions (see move_newdata_to_raw.py and
+    unzip_files_in_dir.py) rather than scans.
+    """
+    return sorted(
+        uts.walk_files(path, exts=".nii", skip_hidden=True, n_threads=n_threads)
+    )
+
+
+def parse_raw_niis(raw_niifs, raw_dir, scan_types):
+    """Return the scan info parsed from each raw nifti filepath.
+
+    This is a vectorized equivalent of applying get_subj,
+    get_scan_type, get_scan_date, and get_image_id to each file, and
+    returns the same values.
+
+    Parameters
+    ----------
+    raw_niifs : list of str
+        Filepaths to the raw niftis.
+    raw_dir : str
+        The raw data directory that contains raw_niifs.
+    scan_types : dict
+        {name_in: name_out} dict returned by load_scan_typesf.
+
+    Returns
+    -------
+    raw_niis : DataFrame
+        Columns are "subj", "scan_type", "scan_date", "image_id", and
+        "raw_niif".
+    """
+    columns = ["subj", "scan_type", "scan_date", "image_id", "raw_niif"]
+    raw_niifs = pd.Series(list(raw_niifs), dtype="string")
+    if len(raw_niifs) == 0:
+        return pd.DataFrame(columns=columns, dtype=object)
+    raw_base = op.basename(raw_dir)
+    path_parts = raw_niifs.str.rpartition("/")
+    dirnames = path_parts[0]
+    basenames = path_parts[2]
+
+    # Get the part of each dirname after "raw"
+    search_parts = dirnames.str.partition(f"/{raw_base}/")
+    search_paths = search_parts[2].where(search_parts[1].str.len() > 0)
+
+    # Subject ID is the first directory under raw
+    subj = raw_niifs.str.replace(raw_dir + "/", "", regex=False).str.split("/").str[0]
+    subj = subj.where(subj.str.len() > 0, np.nan)
+
+    # Scan type is matched from the basename, then from the path after raw
+    scan_type = _match_scan_types(basenames.str.lower(), scan_types)
+    search_scan_type = _match_scan_types(search_paths.str.lower(), scan_types)
+    scan_type = scan_type.fillna(search_scan_type).fillna(SCAN_TYPE_NO_MATCH)
+
+    # Scan date is the first valid date in the basename, then in the path
+    # after raw
+    today = pd.Timestamp(datetime.date.today())
+    scan_date = _first_valid_datestr(basenames, r"(?:^|_)((?:-*\d){8})", r"-", today)
+    search_scan_date = _first_valid_datestr(
+        search_paths.loc[scan_date.isna()], r"(?:^|/)((?:[-_]*\d){8})", r"[-_]", today
+    )
+    scan_date = scan_date.fillna(search_scan_date)
+
+    # LONI image ID is the first basename part like I12345
+    image_id = basenames.str.extract(r"(?:^|_)(I[0-9]+)(?=_|$)", expand=False)
+
+    # Return object columns with NaN for missing values, like the
+    # per-file parsers
+    raw_niis = pd.concat([subj, scan_type, scan_date, image_id, raw_niifs], axis=1)
+    raw_niis.columns = columns
+    raw_niis = raw_niis.astype(object).where(raw_niis.notna(), np.nan)
+    return raw_niis
+
+
+def _match_scan_types(texts, scan_types):
+    """Return the scan type whose name_in keys are found in each text.
+
+    Each scan type is matched with a single compiled regex of its keys.
+    Texts that match more than one scan type get SCAN_TYPE_MULTI_MATCH;
+    texts that match none get "FDG" if they contain the LONI FDG
+    preprocessing description, otherwise NaN.
+    """
+    keys_by_type = {}
+    for key, scan_type in scan_types.items():
+        keys_by_type.setdefault(scan_type, []).append(re.escape(key))
+    is_match = pd.DataFrame(
+        {
+            scan_type: texts.str.contains("|".join(keys), regex=True, na=False)
+            for scan_type, keys in keys_by_type.items()
+        },
+        index=texts.index,
+    )
+    n_matches = is_match.sum(axis=1)
+    output = pd.Series(np.nan, index=texts.index, dtype=object)
+    if len(is_match.columns) > 0:
+        output.loc[n_matches == 1] = is_match.loc[n_matches == 1].idxmax(axis=1)
+    output.loc[n_matches > 1] = SCAN_TYPE_MULTI_MATCH
+    is_fdg = (n_matches == 0) & texts.str.contains(
+        "coreg,_avg,_std_img_and_vox_siz,_uniform", regex=False, na=False
+    )
+    output.loc[is_fdg] = "FDG"
+    return output
 
-    def _path_recurse(path):
-        """Recursively traverse a directory and its subdirectories"""
-        with os.scandir(path) as entries:
-            for entry in entries:
-                if entry.is_dir():
-                    _path_recurse(entry.path)
-                elif entry.is_file() and entry.name.endswith(".nii"):
-                    nii_files.append(entry.path)
 
-    nii_files = []
-    _path_recurse(path)
-    return nii_files
+def _first_valid_datestr(texts, pattern, sep, date_stop, date_start="2000-01-01"):
+    """Return the first YYYY-MM-DD date found by pattern in each text.
+
+    `pattern` captures the 8 digits (with `sep` characters between
+    them) at the start of each candidate part. Dates that don't exist
+    or are outside [date_start, date_stop] are skipped. Texts without a
+    valid date get NaN.
+    """
+    parts = texts.str.findall(pattern).explode().dropna()
+    parts = parts.astype(str).str.replace(sep, "", regex=True)
+    dates = pd.to_datetime(parts, format="%Y%m%d", errors="coerce")
+    is_valid = (dates >= pd.Timestamp(date_start)) & (dates <= date_stop)
+    parts = parts.loc[is_valid]
+    datestrs = parts.str[:4] + "-" + parts.str[4:6] + "-" + parts.str[6:8]
+    datestrs = datestrs.groupby(level=0).first()
+    return datestrs.reindex(texts.index)
 
 
 def get_subj(filepath, raw_dir):
@@ -663,6 +807,18 @@ def get_pet_resolution(filepath):
         return np.nan
 
 
+def get_pet_resolutions(filepaths):
+    """Return the PET resolution parsed from each basename.
+
+    Vectorized equivalent of applying get_pet_resolution to each file.
+    """
+    basenames = pd.Series(filepaths).map(op.basename).str.lower()
+    res = basenames.str.extract(r"uniform_([0-9])mm_res", expand=False).astype(float)
+    if res.notna().all():
+        res = res.astype(int)
+    return res
+
+
 def add_mri_date_columns(mri_scans):
     """Add info on time between PET and MRI and adjacent PET scans"""
     # Copy the input dataframe
@@ -676,14 +832,10 @@ def add_mri_date_columns(mri_scans):
 
     # Add columns for days from each PET scan to baseline and days between
     # consecutive PET scans per tracer
-    baseline_mri_dates = grp["mri_date"].min()
     mri_scans_cp.insert(
         ii + 3,
         "days_from_baseline_mri",
-        mri_scans_cp.apply(
-            lambda x: (x["mri_date"] - baseline_mri_dates[x["subj"]]).days,
-            axis=1,
-        ),
+        (mri_scans_cp["mri_date"] - grp["mri_date"].transform("min")).dt.days,
     )
     mri_scans_cp.insert(
         ii + 4, "days_from_last_mri", grp["mri_date"].diff().dt.days.fillna(0)
@@ -705,16 +857,10 @@ def add_pet_date_columns(pet_scans):
 
     # Add columns for days from each PET scan to baseline and days between
     # consecutive PET scans per tracer
-    baseline_pet_dates = grp["pet_date"].min()
     pet_scans_cp.insert(
         ii + 3,
         "days_from_baseline_pet",
-        pet_scans_cp.apply(
-            lambda x: (
-                x["pet_date"] - baseline_pet_dates[(x["subj"], x["tracer"])]
-            ).days,
-            axis=1,
-        ),
+        (pet_scans_cp["pet_date"] - grp["pet_date"].transform("min")).dt.days,
     )
     pet_scans_cp.insert(
         ii + 4, "days_from_last_pet", grp["pet_date"].diff().dt.days.fillna(0)
@@ -723,8 +869,43 @@ def add_pet_date_columns(pet_scans):
     return pet_scans_cp
 
 
-def find_closest_mri_to_pet(pet_scans, mri_scans):
-    """Return a merged dataframe with the closest MRI to each PET scan"""
+def find_closest_mri_to_pet(pet_scans, mri_scans, k=1, linked_scans=None):
+    """Return a merged dataframe with the closest MRI to each PET scan
+
+    MRIs are matched by subject with a sorted nearest-date search, so
+    only the MRIs adjacent to each PET date are compared rather than
+    every PET x MRI pair. PET scans with the same subject, tracer, and
+    date are kept once, and PET scans from subjects without an MRI are
+    kept with empty MRI columns.
+
+    When two MRIs are equally close to a PET scan, or several PET scans
+    share a subject, tracer, and date, the scans in linked_scans win so
+    that processed PET scans keep the scans they were processed with.
+    Otherwise the one that comes first in the input wins (normally the
+    earlier MRI).
+
+    Parameters
+    ----------
+    pet_scans : DataFrame
+        PET scans with subj, tracer, pet_date, and pet_image_id columns.
+    mri_scans : DataFrame
+        MRI scans with subj, mri_date, mri_scan_number, and n_mri_scans
+        columns.
+    k : int
+        Number of closest MRIs to return for each PET scan. If k > 1,
+        up to k rows are returned per PET scan, ranked in a
+        closest_mri_rank column (1 = closest), for auditing.
+    linked_scans : DataFrame, optional
+        pet_is_linked and linked_mri_date columns aligned with
+        pet_scans, as returned by get_linked_scans.
+
+    Returns
+    -------
+    merged_min : DataFrame
+        PET scan columns followed by days_mri_to_pet,
+        abs_days_mri_to_pet, and the MRI scan columns, sorted by
+        subject, tracer, and PET date.
+    """
     # Check that the necessary columns are present
     assert np.all(
         np.isin(["subj", "tracer", "pet_date", "pet_image_id"], pet_scans.columns)
@@ -734,63 +915,240 @@ def find_closest_mri_to_pet(pet_scans, mri_scans):
             ["subj", "mri_date", "mri_scan_number", "n_mri_scans"], mri_scans.columns
         )
     )
-
-    # Copy the input dataframes
-    pet_scans_cp = pet_scans.copy()
-    mri_scans_cp = mri_scans.copy()
+    if linked_scans is None:
+        pet_is_linked = np.zeros(len(pet_scans), dtype=bool)
+        linked_mri_dates = np.full(len(pet_scans), np.datetime64("NaT", "ns"))
+    else:
+        pet_is_linked = linked_scans["pet_is_linked"].to_numpy(dtype=bool)
+        linked_mri_dates = pd.to_datetime(linked_scans["linked_mri_date"]).to_numpy()
+
+    # Copy the input dataframes, keeping one PET scan per subject,
+    # tracer, and date (the linked one if a processed PET links to it)
+    first = np.argsort(~pet_is_linked, kind="stable")
+    dup = pet_scans.iloc[first].duplicated(["subj", "tracer", "pet_date"])
+    keep = np.sort(first[~dup.to_numpy()])
+    pet_scans_cp = pet_scans.iloc[keep].reset_index(drop=True)
+    mri_scans_cp = mri_scans.reset_index(drop=True)
+
+    # Find the k closest MRIs to each PET scan
+    pet_idx, mri_idx, rank = _nearest_dates(
+        pet_scans_cp["subj"],
+        pet_scans_cp["pet_date"],
+        mri_scans_cp["subj"],
+        mri_scans_cp["mri_date"],
+        k,
+        left_prefer=linked_mri_dates[keep],
+    )
 
     # Merge the dataframes
-    merged = pet_scans_cp.merge(mri_scans_cp, on="subj", how="left")
+    merged = (
+        pet_scans_cp.iloc[pet_idx]
+        .assign(_mri_row=mri_idx)
+        .merge(
+            mri_scans_cp.drop(columns=["subj"]).assign(
+                _mri_row=np.arange(len(mri_scans_cp))
+            ),
+            on="_mri_row",
+            how="left",
+        )
+        .drop(columns=["_mri_row"])
+    )
 
     # Compute the date difference between each PET and MRI scan
     ii = merged.columns.tolist().index("pet_date")
     merged.insert(
         ii + 1,
         "days_mri_to_pet",
-        (merged["pet_date"] - merged["mri_date"]).dt.days,
+        (merged["pet_date"] - merged["mri_date"]).dt.days.astype(float),
     )
     merged.insert(
         ii + 2,
         "abs_days_mri_to_pet",
         merged["days_mri_to_pet"].abs(),
     )
+    sort_cols = ["subj", "tracer", "pet_date"]
+    if k > 1:
+        merged.insert(ii + 3, "closest_mri_rank", rank + 1)
+        sort_cols.append("closest_mri_rank")
+
+    # Resort the dataframe and reset index before returning
+    merged_min = merged.sort_values(sort_cols, kind="stable").reset_index(drop=True)
+
+    return merged_min
+
+
+def _nearest_dates(
+    left_keys, left_dates, right_keys, right_dates, k=1, left_prefer=None
+):
+    """Return the k nearest right rows to each left row by date.
 
-    # Sort by |pet_date - mri_date| and drop duplicates
-    merged_min = merged.sort_values("abs_days_mri_to_pet").drop_duplicates(
-        ["subj", "tracer", "pet_date"]
+    Rows are only matched when their keys are equal. Distances are
+    whole days as in (left_date - right_date).days; ties go to a right
+    row dated left_prefer (one date per left row, NaT for none) and
+    then to the right row that comes first. Rows with a missing date
+    are only matched when fewer than k dated rows share the key.
+
+    Returns
+    -------
+    left_idx, right_idx, rank : ndarray of int
+        One entry per match, ordered by left row and then rank (0 =
+        nearest). Left rows without any match get one entry with
+        right_idx = -1.
+    """
+    n_left = len(left_keys)
+    codes, _ = pd.factorize(
+        pd.concat([pd.Series(left_keys), pd.Series(right_keys)], ignore_index=True),
+        use_na_sentinel=False,
     )
+    left_codes, right_codes = codes[:n_left], codes[n_left:]
+    left_dates = pd.to_datetime(pd.Series(left_dates)).to_numpy()
+    right_dates = pd.to_datetime(pd.Series(right_dates)).to_numpy()
+    left_nat = np.isnat(left_dates)
+    right_nat = np.isnat(right_dates)
+
+    # Rank every date so (key, date) fits in one sortable integer, with
+    # missing dates after all others
+    _, date_ranks = np.unique(
+        np.concatenate([left_dates[~left_nat], right_dates[~right_nat]]),
+        return_inverse=True,
+    )
+    n_ranks = int(date_ranks.max()) + 2 if len(date_ranks) else 2
+    left_rank = np.full(n_left, n_ranks - 1, dtype=np.int64)
+    left_rank[~left_nat] = date_ranks[: (~left_nat).sum()]
+    right_rank = np.full(len(right_codes), n_ranks - 1, dtype=np.int64)
+    right_rank[~right_nat] = date_ranks[(~left_nat).sum() :]
+    left_comp = left_codes * n_ranks + left_rank
+    right_comp = right_codes * n_ranks + right_rank
+
+    # Sort right rows by key, date, and input order
+    order = np.argsort(right_comp, kind="stable")
+    comp_sorted = right_comp[order]
+    group_start = np.searchsorted(comp_sorted, comp_sorted, side="left")
+    group_stop = np.searchsorted(comp_sorted, comp_sorted, side="right")
+
+    # Find the window of candidate right rows for each left row: k dated
+    # rows on either side of the left date, widened to whole same-date
+    # groups. Fall back to every row with the key if the left date is
+    # missing or there are fewer than k dated rows.
+    key_start = np.searchsorted(comp_sorted, left_codes * n_ranks, side="left")
+    key_stop = np.searchsorted(comp_sorted, (left_codes + 1) * n_ranks, side="left")
+    dated_stop = np.searchsorted(
+        comp_sorted, (left_codes + 1) * n_ranks - 1, side="left"
+    )
+    ins = np.searchsorted(comp_sorted, left_comp, side="left")
+    start = np.maximum(key_start, ins - k)
+    stop = np.minimum(dated_stop, ins + k)
+    has_window = start < stop
+    start[has_window] = group_start[start[has_window]]
+    stop[has_window] = group_stop[stop[has_window] - 1]
+    use_all = left_nat | ((dated_stop - key_start) < k)
+    start[use_all] = key_start[use_all]
+    stop[use_all] = key_stop[use_all]
+
+    # Expand windows into candidate pairs
+    lengths = stop - start
+    left_idx = np.repeat(np.arange(n_left), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+    right_idx = order[np.repeat(start, lengths) + offsets]
 
-    # Resort the dataframe and reset index before returning
-    merged_min = merged_min.sort_values(["subj", "tracer", "pet_date"]).reset_index(
-        drop=True
+    # Rank candidates by |days|, with missing distances last and ties
+    # broken by preferred date and then right row order
+    abs_days = np.abs(
+        pd.Series(left_dates[left_idx] - right_dates[right_idx]).dt.days.to_numpy(
+            dtype=float, na_value=np.nan
+        )
+    )
+    missing = np.isnan(abs_days)
+    if left_prefer is None:
+        not_preferred = np.ones(len(left_idx), dtype=bool)
+    else:
+        left_prefer = pd.to_datetime(pd.Series(left_prefer)).to_numpy()
+        not_preferred = right_dates[right_idx] != left_prefer[left_idx]
+    keep = np.lexsort(
+        (
+            right_idx,
+            not_preferred,
+            np.where(missing, 0, abs_days),
+            missing,
+            left_idx,
+        )
     )
+    left_idx, right_idx = left_idx[keep], right_idx[keep]
+    counts = np.bincount(left_idx, minlength=n_left)
+    rank = np.arange(len(left_idx)) - np.repeat(np.cumsum(counts) - counts, counts)
+    keep = rank < k
+    left_idx, right_idx, rank = left_idx[keep], right_idx[keep], rank[keep]
 
-    return merged_min
+    # Add left rows without a match
+    unmatched = np.setdiff1d(np.arange(n_left), left_idx)
+    left_idx = np.concatenate([left_idx, unmatched])
+    right_idx = np.concatenate([right_idx, np.full(len(unmatched), -1)])
+    rank = np.concatenate([rank, np.zeros(len(unmatched), dtype=rank.dtype)])
+    keep = np.lexsort((rank, left_idx))
+    return left_idx[keep], right_idx[keep], rank[keep]
+
+
+def get_linked_scans(pet_scans, proc_dir, n_threads=16):
+    """Return the scans that each processed PET scan is linked to.
+
+    Reads the 'raw' and 'mri' symlinks in the processed directory of
+    each PET scan, as set up by make_processed_scan_dirs.py.
+
+    Returns
+    -------
+    DataFrame
+        Aligned with pet_scans, with columns pet_is_linked (True if the
+        processed PET links to the raw directory of this PET scan) and
+        linked_mri_date (date of the processed MRI the PET links to, or
+        NaT).
+    """
+    pet_proc_dirs = get_pet_proc_dirs(
+        pet_scans["subj"], pet_scans["tracer"], pet_scans["pet_date"], proc_dir
+    )
+
+    def read_links(pet_proc_dir, pet_raw_niif):
+        links = []
+        for name in ["raw", "mri"]:
+            link = op.join(pet_proc_dir, name)
+            links.append(op.realpath(link) if op.islink(link) else None)
+        pet_is_linked = (links[0] is not None) and (
+            links[0] == op.realpath(op.dirname(pet_raw_niif))
+        )
+        return pet_is_linked, links[1]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        links = list(executor.map(read_links, pet_proc_dirs, pet_scans["pet_raw_niif"]))
+    linked_scans = pd.DataFrame(
+        links, index=pet_scans.index, columns=["pet_is_linked", "linked_mri_date"]
+    )
+    linked_scans["linked_mri_date"] = pd.to_datetime(
+        linked_scans["linked_mri_date"]
+        .str.extract(r"MRI-T1_(\d{4}-\d{2}-\d{2})$", expand=False)
+        .astype(object),
+        errors="coerce",
+    )
+    return linked_scans
 
 
 def get_orphan_mris(mri_scans, pet_scans, orphan_mri_tolerance=182):
     """Flag MRIs that are not used for PET processing"""
     ii = mri_scans.columns.tolist().index("n_mri_scans")
+    pet_mri_image_ids = set(pet_scans["mri_image_id"].dropna())
     mri_scans.insert(
         ii + 1,
         "mri_used_for_pet_proc",
-        mri_scans["mri_image_id"].apply(
-            lambda x: 1 if np.isin(x, pet_scans["mri_image_id"]) else 0
-        ),
+        mri_scans["mri_image_id"].isin(pet_mri_image_ids).astype(int),
     )
     today = pd.Timestamp("today")
     mri_scans.insert(
         ii + 2,
         "mri_is_orphan",
-        mri_scans.apply(
-            lambda x: (
-                1
-                if (x["mri_used_for_pet_proc"] == 0)
-                and ((today - x["mri_date"]).days > orphan_mri_tolerance)
-                else 0
-            ),
-            axis=1,
-        ),
+        (
+            (mri_scans["mri_used_for_pet_proc"] == 0)
+            & ((today - mri_scans["mri_date"]).dt.days > orphan_mri_tolerance)
+        ).astype(int),
     )
     return mri_scans
 
@@ -885,21 +1243,21 @@ def audit_pet(
 
     # Same MRI used to process multiple PET scans for the same tracer
     if audit_repeat_mri:
+        repeat_mri = (
+            pet_scans_cp.duplicated(["subj", "tracer", "mri_image_id"], keep=False)
+            & pet_scans_cp["mri_image_id"].notna()
+        )
         idx = pet_scans_cp.loc[
-            pet_scans_cp.groupby(["subj", "tracer"])["mri_image_id"].transform(
-                lambda x: (
-                    True if (np.max(np.unique(x, return_counts=True)[1]) > 1) else False
-                )
-            )
+            repeat_mri.groupby(
+                [pet_scans_cp["subj"], pet_scans_cp["tracer"]]
+            ).transform("any")
         ].index.tolist()
         pet_scans_cp.loc[idx, "flag"] = 1
         pet_scans_cp.loc[
             idx, "flag_notes"
         ] += "Same MRI would be used to process multiple timepoints for the same PET tracer; "
 
-    pet_scans_cp["flag_notes"] = pet_scans_cp["flag_notes"].apply(
-        lambda x: x[:-2] if (len(x) >= 2) else x
-    )
+    pet_scans_cp["flag_notes"] = pet_scans_cp["flag_notes"].str.removesuffix("; ")
     return pet_scans_cp
 
 
@@ -908,6 +1266,27 @@ def get_mri_proc_dir(subj, mri_date, proc_dir):
     return op.join(proc_dir, subj, "MRI-T1_{}".format(datetime_to_datestr(mri_date)))
 
 
+def get_mri_proc_dirs(subjs, mri_dates, proc_dir):
+    """Return the processed MRI directory for each MRI scan.
+
+    Vectorized equivalent of get_mri_proc_dir for Series inputs.
+    """
+    return proc_dir + os.sep + subjs + os.sep + "MRI-T1_" + _datestrs(mri_dates)
+
+
+def get_pet_proc_dirs(subjs, tracers, pet_dates, proc_dir):
+    """Return the processed PET directory for each PET scan.
+
+    Vectorized equivalent of get_pet_proc_dir for Series inputs.
+    """
+    return proc_dir + os.sep + subjs + os.sep + tracers + "_" + _datestrs(pet_dates)
+
+
+def _datestrs(dts):
+    """Return 'YYYY-MM-DD' strings, or 'nan' for missing dates."""
+    return pd.to_datetime(dts).dt.strftime("%Y-%m-%d").astype(object).fillna("nan")
+
+
 def get_pet_proc_dir(subj, tracer, pet_date, proc_dir):
     """Return the processed PET directory for each PET scan"""
     return op.join(
@@ -917,73 +1296,216 @@ def get_pet_proc_dir(subj, tracer, pet_date, proc_dir):
     )
 
 
-def check_if_freesurfer_run(mri_proc_dir, check_brainstem=True):
-    """Return True if the MRI has been processed by Freesurfer"""
-    freesurfer_dir = op.join(mri_proc_dir, "freesurfer")
-    if not op.isdir(freesurfer_dir):
-        return 0
-    # Search for the Freesurfer output directory
-    nuf = op.join(freesurfer_dir, "mri", "nu.mgz")
-    aparcf = op.join(freesurfer_dir, "mri", "aparc+aseg.mgz")
-    check_files = [nuf, aparcf]
-    if check_brainstem:
-        bstemf = op.join(
-            freesurfer_dir, "mri", "brainstemSsLabels.v12.FSvoxelSpace.mgz"
-        )
-        check_files.append(bstemf)
-    if all([op.isfile(f) for f in check_files]):
-        return 1
-    else:
-        return 0
+def list_scan_dir(scan_dir):
+    """Return {name: is_file} for the entries in scan_dir.
+
+    Hidden entries are skipped, as glob does. Returns None if scan_dir
+    does not exist.
+    """
+    try:
+        with os.scandir(scan_dir) as entries:
+            return {
+                entry.name: entry.is_file()
+                for entry in entries
+                if not entry.name.startswith(".")
+            }
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def load_ref_regions_by_tracer(ref_regionsf=None):
+    """Return {tracer: [ref_region, ...]} from the ref regions config."""
+    if ref_regionsf is None:
+        code_dir = op.dirname(op.dirname(op.abspath(__file__)))
+        ref_regionsf = op.join(code_dir, "config", "ref_regions.csv")
+    ref_regions = pd.read_csv(ref_regionsf)
+    return {
+        tracer: ref_regions.loc[ref_regions["tracer"] == tracer, "ref_region"].tolist()
+        for tracer in ref_regions["tracer"].unique()
+    }
 
 
-def check_if_mri_seg_complete(mri_proc_dir):
-    """Return True if the MRI has been segmented"""
-    if not op.isdir(mri_proc_dir):
-        return 0
+def missing_freesurfer_outputs(mri_proc_dir, check_brainstem=True):
+    """Return the expected Freesurfer output files that are missing."""
+    check_files = list(FREESURFER_OUTPUTS)
+    if not check_brainstem:
+        check_files.remove("brainstemSsLabels.v12.FSvoxelSpace.mgz")
+    listing = list_scan_dir(op.join(mri_proc_dir, "freesurfer", "mri")) or {}
+    return [f"freesurfer/mri/{f}" for f in check_files if not listing.get(f, False)]
+
+
+def missing_mri_outputs(mri_proc_dir, listing=None):
+    """Return {stage: [missing output, ...]} for a processed MRI.
+
+    Stages are 'mri_seg' and 'mri_processing', with outputs named as in
+    MRI_SEG_OUTPUTS and MRI_PROC_OUTPUTS. The directory is listed once
+    and every pattern is matched against that listing.
+    """
+    if listing is None:
+        listing = list_scan_dir(mri_proc_dir)
+    names = list(listing or [])
+    missing = {}
+    for stage, outputs in [
+        ("mri_seg", MRI_SEG_OUTPUTS),
+        ("mri_processing", MRI_PROC_OUTPUTS),
+    ]:
+        missing[stage] = [
+            key
+            for key, pattern in outputs.items()
+            if not any(fnmatch.fnmatchcase(name, pattern) for name in names)
+        ]
+    return missing
+
+
+def missing_pet_outputs(pet_proc_dir, listing=None, ref_regions_by_tracer=None):
+    """Return the expected processed PET files that are missing.
+
+    The directory is listed once, and the ref regions config is only
+    read the first time it is needed.
+    """
+    if listing is None:
+        listing = list_scan_dir(pet_proc_dir)
+    if ref_regions_by_tracer is None:
+        ref_regions_by_tracer = load_ref_regions_by_tracer()
 
-    # Search for the processed MRI files
+    # Get the scan info
+    pet_tag = uts.get_scan_tag(pet_proc_dir)
+    _, tracer, _ = uts.parse_scan_tag(pet_tag)
+
+    # List the files whose existence we will check for
     proc_files = {
-        "seg_nu": glob(op.join(mri_proc_dir, "c*nu.nii")),
+        "native_pet_pet": f"{pet_tag}.nii",
+        "native_mri_pet": f"r{pet_tag}.nii",
+        "ref_region_means": f"r{pet_tag}_ref-region-means.csv",
+        "qc_image": f"{pet_tag}_qc.png",
     }
+    if tracer in AMYLOID_TRACERS:
+        proc_files["cortical_summary_values"] = (
+            f"r{pet_tag}_amyloid-cortical-summary.csv"
+        )
+    for rr in ref_regions_by_tracer[tracer]:
+        proc_files[f"native_mri_suvr_{rr}"] = f"r{pet_tag}_suvr-{rr}.nii"
+        proc_files[f"warped_mni_suvr_{rr}"] = f"wr{pet_tag}_suvr-{rr}.nii"
+        proc_files[f"affine_mni_suvr_{rr}"] = f"ar{pet_tag}_suvr-{rr}.nii"
+        proc_files[f"native_mri_suvr_extractions_{rr}"] = (
+            f"r{pet_tag}_suvr-{rr}_roi-extractions.csv"
+        )
 
-    # Check if all file types are present
-    if all([len(proc_files[key]) > 0 for key in proc_files]):
-        return 1
-    else:
+    listing = listing or {}
+    return [key for key, f in proc_files.items() if not listing.get(f, False)]
+
+
+def check_mri_outputs(mri_proc_dirs, check_brainstem=True, n_threads=16):
+    """Check processed outputs for many MRI directories concurrently.
+
+    Parameters
+    ----------
+    mri_proc_dirs : list-like of str
+        Processed MRI directories. Duplicates are checked once.
+    check_brainstem : bool
+        Require the Freesurfer brainstem segmentation.
+    n_threads : int
+        Number of directories to check at once.
+
+    Returns
+    -------
+    report : DataFrame
+        Indexed by mri_proc_dir, with 0/1 columns freesurfer_complete,
+        mri_seg_complete, and mri_processing_complete, and a
+        missing_outputs column listing every missing output
+        (";"-separated; empty if the scan is complete).
+    """
+
+    def check(mri_proc_dir):
+        listing = list_scan_dir(mri_proc_dir)
+        if listing is None:
+            return {
+                "freesurfer_complete": 0,
+                "mri_seg_complete": 0,
+                "mri_processing_complete": 0,
+                "missing_outputs": "mri_proc_dir",
+            }
+        if "freesurfer" in listing:
+            missing_fs = missing_freesurfer_outputs(mri_proc_dir, check_brainstem)
+        else:
+            missing_fs = ["freesurfer"]
+        missing = missing_mri_outputs(mri_proc_dir, listing)
+        return {
+            "freesurfer_complete": int(len(missing_fs) == 0),
+            "mri_seg_complete": int(len(missing["mri_seg"]) == 0),
+            "mri_processing_complete": int(len(missing["mri_processing"]) == 0),
+            "missing_outputs": ";".join(
+                missing_fs + missing["mri_seg"] + missing["mri_processing"]
+            ),
+        }
+
+    columns = [
+        "freesurfer_complete",
+        "mri_seg_complete",
+        "mri_processing_complete",
+        "missing_outputs",
+    ]
+    return _check_scan_dirs(mri_proc_dirs, check, "mri_proc_dir", columns, n_threads)
+
+
+def check_pet_outputs(pet_proc_dirs, n_threads=16):
+    """Check processed outputs for many PET directories concurrently.
+
+    Returns
+    -------
+    report : DataFrame
+        Indexed by pet_proc_dir, with a 0/1 pet_processing_complete
+        column and a ";"-separated missing_outputs column.
+    """
+    ref_regions_by_tracer = load_ref_regions_by_tracer()
+
+    def check(pet_proc_dir):
+        listing = list_scan_dir(pet_proc_dir)
+        if listing is None:
+            return {"pet_processing_complete": 0, "missing_outputs": "pet_proc_dir"}
+        missing = missing_pet_outputs(pet_proc_dir, listing, ref_regions_by_tracer)
+        return {
+            "pet_processing_complete": int(len(missing) == 0),
+            "missing_outputs": ";".join(missing),
+        }
+
+    columns = ["pet_processing_complete", "missing_outputs"]
+    return _check_scan_dirs(pet_proc_dirs, check, "pet_proc_dir", columns, n_threads)
+
+
+def _check_scan_dirs(scan_dirs, check, index_name, columns, n_threads):
+    """Return a dataframe of check(scan_dir) for each unique scan_dir."""
+    scan_dirs = list(dict.fromkeys(scan_dirs))
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        results = list(executor.map(check, scan_dirs))
+    report = pd.DataFrame(
+        results, index=pd.Index(scan_dirs, name=index_name), columns=columns
+    )
+    return report
+
+
+def check_if_freesurfer_run(mri_proc_dir, check_brainstem=True):
+    """Return True if the MRI has been processed by Freesurfer"""
+    if not op.isdir(op.join(mri_proc_dir, "freesurfer")):
         return 0
+    return int(len(missing_freesurfer_outputs(mri_proc_dir, check_brainstem)) == 0)
 
 
-def check_if_mri_processed(mri_proc_dir):
-    """Return True if the MRI has been fully processed"""
-    if not op.isdir(mri_proc_dir):
+def check_if_mri_seg_complete(mri_proc_dir):
+    """Return True if the MRI has been segmented"""
+    listing = list_scan_dir(mri_proc_dir)
+    if listing is None:
         return 0
+    return int(len(missing_mri_outputs(mri_proc_dir, listing)["mri_seg"]) == 0)
 
-    # Search for the processed MRI files
-    proc_files = {
-        "affine_nu": glob(op.join(mri_proc_dir, "a*nu.nii")),
-        "c1": glob(op.join(mri_proc_dir, "c1*_nu.nii")),
-        "c2": glob(op.join(mri_proc_dir, "c1*_nu.nii")),
-        "fwd_deformation": glob(op.join(mri_proc_dir, "y*_nu.nii")),
-        "inv_deformation": glob(op.join(mri_proc_dir, "iy*_nu.nii")),
-        "mask_brainstem": glob(op.join(mri_proc_dir, "*mask-brainstem.nii")),
-        "mask_eroded_subcortwm": glob(
-            op.join(mri_proc_dir, "*mask-eroded-subcortwm.nii")
-        ),
-        "mask_infcblgm": glob(op.join(mri_proc_dir, "*mask-infcblgm.nii")),
-        "mask_pons": glob(op.join(mri_proc_dir, "*mask-pons.nii")),
-        "mask_wcbl": glob(op.join(mri_proc_dir, "*mask-wcbl.nii")),
-        "mwc1": glob(op.join(mri_proc_dir, "mwc1*_nu.nii")),
-        "warp_nu": glob(op.join(mri_proc_dir, "w*_nu.nii")),
-        "qc_image": glob(op.join(mri_proc_dir, "*_qc.png")),
-        "suit_atlas": glob(op.join(mri_proc_dir, "*_cbl-suit.nii")),
-    }
 
-    # Check if all file types are present
-    if all([len(proc_files[key]) > 0 for key in proc_files]):
-        return 1
-    else:
+def check_if_mri_processed(mri_proc_dir):
+    """Return True if the MRI has been fully processed"""
+    listing = list_scan_dir(mri_proc_dir)
+    if listing is None:
         return 0
+    return int(len(missing_mri_outputs(mri_proc_dir, listing)["mri_processing"]) == 0)
 
 
 def check_if_pet_not_processed_to_closest_mri(pet_proc_dir, closest_mri_proc_dir):
@@ -996,53 +1518,37 @@ def check_if_pet_not_processed_to_closest_mri(pet_proc_dir, closest_mri_proc_dir
     return 0
 
 
-def check_if_pet_processed(pet_proc_dir):
-    """Return True if the PET scan has been fully processed"""
-    if not op.isdir(pet_proc_dir):
-        return 0
-
-    # Get the scan info
-    pet_tag = uts.get_scan_tag(pet_proc_dir)
-    _, tracer, _ = uts.parse_scan_tag(pet_tag)
+def check_pets_not_processed_to_closest_mri(
+    pet_proc_dirs, closest_mri_proc_dirs, n_threads=16
+):
+    """Return 1 for each PET processed to a different MRI than closest.
 
-    # Get the list of reference regions used for each tracer
-    code_dir = op.dirname(op.dirname(__file__))
-    ref_regions = pd.read_csv(op.join(code_dir, "config", "ref_regions.csv"))
-    ref_regions_by_tracer = {
-        tracer: ref_regions.loc[ref_regions["tracer"] == tracer, "ref_region"].tolist()
-        for tracer in ref_regions["tracer"].unique()
-    }
+    Vectorized equivalent of check_if_pet_not_processed_to_closest_mri,
+    resolving the 'mri' symlinks concurrently.
 
-    # List the files whose existence we will check for
-    proc_files = {
-        "native_pet_pet": op.join(pet_proc_dir, f"{pet_tag}.nii"),
-        "native_mri_pet": op.join(pet_proc_dir, f"r{pet_tag}.nii"),
-        "ref_region_means": op.join(pet_proc_dir, f"r{pet_tag}_ref-region-means.csv"),
-        "qc_image": op.join(pet_proc_dir, f"{pet_tag}_qc.png"),
-    }
-    if tracer in AMYLOID_TRACERS:
-        proc_files["cortical_summary_values"] = op.join(
-            pet_proc_dir, f"r{pet_tag}_amyloid-cortical-summary.csv"
-        )
-    for rr in ref_regions_by_tracer[tracer]:
-        proc_files[f"native_mri_suvr_{rr}"] = op.join(
-            pet_proc_dir, f"r{pet_tag}_suvr-{rr}.nii"
-        )
-        proc_files[f"warped_mni_suvr_{rr}"] = op.join(
-            pet_proc_dir, f"wr{pet_tag}_suvr-{rr}.nii"
-        )
-        proc_files[f"affine_mni_suvr_{rr}"] = op.join(
-            pet_proc_dir, f"ar{pet_tag}_suvr-{rr}.nii"
-        )
-        proc_files[f"native_mri_suvr_extractions_{rr}"] = op.join(
-            pet_proc_dir, f"r{pet_tag}_suvr-{rr}_roi-extractions.csv"
+    Returns
+    -------
+    Series of int
+        Aligned with pet_proc_dirs.
+    """
+    pet_proc_dirs = pd.Series(pet_proc_dirs)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        flags = list(
+            executor.map(
+                check_if_pet_not_processed_to_closest_mri,
+                pet_proc_dirs,
+                closest_mri_proc_dirs,
+            )
         )
+    return pd.Series(flags, index=pet_proc_dirs.index, dtype=int)
 
-    # Check if all files are present
-    if all([op.isfile(f) for f in proc_files.values()]):
-        return 1
-    else:
+
+def check_if_pet_processed(pet_proc_dir):
+    """Return True if the PET scan has been fully processed"""
+    listing = list_scan_dir(pet_proc_dir)
+    if listing is None:
         return 0
+    return int(len(missing_pet_outputs(pet_proc_dir, listing)) == 0)
 
 
 def get_mri_to_process(
@@ -1074,6 +1580,51 @@ def get_mri_to_process(
         return 0
 
 
+def get_mris_to_process(
+    mri_scan_number,
+    mri_is_orphan,
+    already_processed,
+    baseline_processed,
+    overwrite,
+    schedule_all_mris,
+):
+    """Return 1 for each MRI scan that should be processed, otherwise 0.
+
+    Vectorized equivalent of get_mri_to_process for Series inputs.
+    """
+    skip_processed = already_processed.astype(bool) & (not overwrite)
+    schedule = np.select(
+        [
+            skip_processed,
+            mri_scan_number == 1,
+            baseline_processed.astype(bool)
+            & (schedule_all_mris | ~mri_is_orphan.astype(bool)),
+        ],
+        [0, 1, 1],
+        default=0,
+    )
+    return pd.Series(schedule, index=mri_scan_number.index)
+
+
+def get_pets_to_process(pet_processed, mri_processed, pet_flagged, overwrite):
+    """Return 1 for each PET scan that should be processed, otherwise 0.
+
+    Vectorized equivalent of get_pet_to_process for Series inputs.
+    Missing MRI processing values count as processed, as they do in
+    get_pet_to_process.
+    """
+    schedule = np.select(
+        [
+            pet_processed.astype(bool) & (not overwrite),
+            pet_flagged.astype(bool),
+            mri_processed != 0,
+        ],
+        [0, 0, 1],
+        default=0,
+    )
+    return pd.Series(schedule, index=pet_processed.index)
+
+
 def get_pet_to_process(pet_processed, mri_processed, pet_flagged, overwrite):
     """Return 1 if the PET scan should be processed, otherwise 0"""
     # Don't process PET scans that have already been processed unless
@@ -1121,6 +1672,10 @@ def save_raw_mri_index(mri_scans, scans_to_process_dir, timestamp):
     mri_scans.to_csv(outf, index=False)
     print(f"  * Saved raw MRI scan index to {outf}")
 
+    # Save a typed, versioned copy of the index
+    outf = scan_index.save_index(mri_scans, scans_to_process_dir, "MRI-T1", timestamp)
+    print(f"  * Saved typed raw MRI scan index to {outf}")
+
 
 def save_raw_pet_index(pet_scans, scans_to_process_dir, timestamp):
     """Save the PET scan index to a CSV file"""
@@ -1138,6 +1693,10 @@ def save_raw_pet_index(pet_scans, scans_to_process_dir, timestamp):
     pet_scans.to_csv(outf, index=False)
     print(f"  * Saved raw PET scan index to {outf}")
 
+    # Save a typed, versioned copy of the index
+    outf = scan_index.save_index(pet_scans, scans_to_process_dir, "PET", timestamp)
+    print(f"  * Saved typed raw PET scan index to {outf}")
+
 
 def _parse_args():
     """Parse and return command line arguments."""
@@ -1327,6 +1886,20 @@ def _parse_args():
             + "be scheduled if the program is rerun without --view-only"
         ),
     )
+    parser.add_argument(
+        "--no-manifest",
+        action="store_false",
+        dest="use_manifest",
+        help=(
+            "Walk and parse all of 'raw' from scratch instead of updating\n"
+            + "the raw nifti manifest in 'scans_to_process'"
+        ),
+    )
+    parser.add_argument(
+        "--rebuild-manifest",
+        action="store_true",
+        help="Clear the raw nifti manifest and rebuild it from scratch",
+    )
 
     # Parse the command line arguments
     return parser.parse_args()
@@ -1350,6 +1923,8 @@ if __name__ == "__main__":
         check_brainstem=args.check_brainstem,
         reprocess_pet_to_closest_mri=args.reprocess_pet_to_closest_mri,
         save_csv=args.save_csv,
+        use_manifest=args.use_manifest,
+        rebuild_manifest=args.rebuild_manifest,
     )
 
     # Exit successfully
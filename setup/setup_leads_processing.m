@@ -75,9 +75,11 @@ function setup_leads_processing( ...
         if isempty(newdatafs)
             fprintf('- %s is empty, skipping ahead\n', newdata_dir);
         else
-            % Unzip newdata files
+            % Unzip newdata files, extracting nifti scans straight to raw
             cmd = append(python, fullfile(code_dir, 'setup', 'unzip_files_in_dir.py'));
             cmd = append(cmd, ' -d ', newdata_dir);
+            cmd = append(cmd, ' --raw ', raw_dir);
+            cmd = append(cmd, ' --manifest ', fullfile(scans_to_process_dir, 'raw_nifti_manifest.sqlite'));
             fprintf('- Unzipping zip files\n');
             fprintf('  (unzip_files_in_dir.py)\n');
             system(cmd);
@@ -91,6 +93,7 @@ function setup_leads_processing( ...
             cmd = append(python, fullfile(code_dir, 'setup', 'move_newdata_to_raw.py'));
             cmd = append(cmd, ' --newdata ', newdata_dir);
             cmd = append(cmd, ' --raw ', raw_dir);
+            cmd = append(cmd, ' --manifest ', fullfile(scans_to_process_dir, 'raw_nifti_manifest.sqlite'));
             if overwrite_raw
                 cmd = append(cmd, ' -o');
             end
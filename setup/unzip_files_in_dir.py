@@ -2,22 +2,68 @@
 
 """
 Unzip all .zip files in a directory.
+
+Archives are extracted member by member across a pool of processes, so
+one large download no longer runs on a single core. Each member is
+streamed to a temporary file next to its destination, checked against
+the CRC-32 and size stored in the archive, and then renamed into place.
+Members that are already present with a matching size and CRC-32 are
+skipped, so an interrupted run can simply be rerun.
+
+If a raw directory is given, scan directories in the archives that
+contain niftis and no DICOMs are extracted straight to
+<raw>/<subj>/<...> (the same location move_newdata_to_raw.py would move
+them to), provided that location does not exist yet. Everything else is
+extracted to the source directory as before. Each of these scan
+directories is first extracted to <raw>/.unzip_staging/<subj>/<...> and
+only renamed into place once every one of its files has been verified,
+so an interrupted run never leaves a partial scan in raw. Rerunning
+picks up where the staged extraction left off.
 """
+
 import argparse
+import os
 import os.path as op
+import time
 import zipfile
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from glob import glob
 
+from move_newdata_to_raw import (
+    NIFTI_EXTS,
+    UNZIP_STAGING_DIRNAME,
+    file_crc32,
+    get_raw_dir,
+)
+from raw_manifest import RawManifest
+
+# Define globals
+BATCH_BYTES = 256 * 1024**2
+BATCH_MEMBERS = 256
+CHUNK_BYTES = 4 * 1024**2
+_OPEN_ZIPS = {}
 
-def fast_unzip_dir(source_dir):
+
+def fast_unzip_dir(source_dir, raw_dir=None, manifest_file=None, n_procs=None):
     """
-    Unzips all .zip files in source_dir using multiprocessing if needed.
+    Unzips all .zip files in source_dir, parallelizing over archive members.
 
     Parameters
     ----------
     source_dir : str
         Path to the directory with .zip files that you wish to unzip
+    raw_dir : str or None
+        If given, nifti scan directories are extracted straight to
+        their final location in raw_dir instead of to source_dir
+    manifest_file : str or None
+        Path to the raw nifti manifest (see raw_manifest.py). If the
+        file exists, scan directories extracted to raw_dir are recorded
+        in it
+    n_procs : int or None
+        Number of processes to extract with. Defaults to the number of
+        CPUs, up to 16
 
     Returns
     -------
@@ -26,30 +72,300 @@ def fast_unzip_dir(source_dir):
     # Ensure the source directory exists
     if not op.isdir(source_dir):
         raise ValueError(f"{source_dir} does not exist or is not a directory")
+    source_dir = op.abspath(source_dir)
+    if raw_dir is not None:
+        raw_dir = op.abspath(raw_dir)
+    if n_procs is None:
+        n_procs = min(16, os.cpu_count())
 
     # Find all .zip files in source_dir
-    zip_files = glob(op.join(source_dir, "*.zip"))
-
-    # Unzip the files, parallelizing if there are multiple .zip files
+    zip_files = sorted(glob(op.join(source_dir, "*.zip")))
     if len(zip_files) == 0:
         print(f"  * No files to unzip in {source_dir}")
+        return
     elif len(zip_files) == 1:
         print(f"  * Found 1 file to unzip in {source_dir}")
-        unzip_file(zip_files[0], source_dir)
     else:
         print(f"  * Found {len(zip_files)} files to unzip in {source_dir}")
-        max_workers = min(16, len(zip_files))
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_zip = {
-                executor.submit(unzip_file, zipf, source_dir): zipf
-                for zipf in zip_files
-            }
-            for future in as_completed(future_to_zip):
-                zipf = future_to_zip[future]
+
+    # Decide where each archive member will be extracted to
+    plan, raw_scan_dirs = plan_extraction(zip_files, source_dir, raw_dir)
+    if raw_scan_dirs:
+        print(
+            f"  * Extracting {len(raw_scan_dirs):,} nifti scan directories straight to {raw_dir}"
+        )
+
+    # Extract members in batches across processes
+    totals = defaultdict(int)
+    errors = []
+    start = time.time()
+    batches = {
+        (zipf, ii): batch
+        for zipf, members in plan.items()
+        for ii, batch in enumerate(_batch_members(members))
+    }
+    n_batches_left = defaultdict(int)
+    for zipf, _ in batches:
+        n_batches_left[zipf] += 1
+
+    # Count the files left to extract to each staged scan directory
+    staging_to_target = {
+        staging_dir: target_dir
+        for target_dir, staging_dir in raw_scan_dirs.items()
+        if staging_dir is not None
+    }
+    n_files_left = defaultdict(int)
+    staged_names = defaultdict(set)
+    for members in plan.values():
+        for info, dest in members:
+            if (not info.is_dir()) and (op.dirname(dest) in staging_to_target):
+                n_files_left[op.dirname(dest)] += 1
+                staged_names[op.dirname(dest)].add(op.basename(dest))
+    failed_staging_dirs = set()
+    with ProcessPoolExecutor(max_workers=n_procs) as executor:
+        future_to_batch = {
+            executor.submit(extract_members, zipf, batch): (zipf, batch)
+            for (zipf, _), batch in batches.items()
+        }
+        for future in as_completed(future_to_batch):
+            zipf, batch = future_to_batch[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {
+                    "errors": [f"{zipf}: {e}"],
+                    "failed": [dest for _, dest in batch],
+                }
+            for key in ("n_extracted", "n_skipped", "n_bytes"):
+                totals[key] += result.get(key, 0)
+            errors.extend(result["errors"])
+            failed = set(result["failed"])
+
+            # Move staged scan directories into raw once all their files
+            # have been extracted and verified
+            for info, dest in batch:
+                staging_dir = op.dirname(dest)
+                if info.is_dir() or (staging_dir not in staging_to_target):
+                    continue
+                if dest in failed:
+                    failed_staging_dirs.add(staging_dir)
+                n_files_left[staging_dir] -= 1
+                if n_files_left[staging_dir] > 0:
+                    continue
+                if staging_dir in failed_staging_dirs:
+                    errors.append(
+                        f"{staging_to_target[staging_dir]}: not moved into place "
+                        + f"because some files failed to extract; left in {staging_dir}"
+                    )
+                    del raw_scan_dirs[staging_to_target[staging_dir]]
+                    continue
                 try:
-                    future.result()
-                except Exception as e:
-                    print(f"Error unzipping {zipf}: {e}")
+                    # Drop temporary files left by an interrupted run
+                    for name in os.listdir(staging_dir):
+                        if name not in staged_names[staging_dir]:
+                            os.remove(op.join(staging_dir, name))
+                    os.makedirs(
+                        op.dirname(staging_to_target[staging_dir]), exist_ok=True
+                    )
+                    os.rename(staging_dir, staging_to_target[staging_dir])
+                except OSError as e:
+                    errors.append(f"{staging_to_target[staging_dir]}: {e}")
+                    del raw_scan_dirs[staging_to_target[staging_dir]]
+
+            n_batches_left[zipf] -= 1
+            if n_batches_left[zipf] == 0:
+                print(f"    - Unzipped {zipf}")
+    elapsed = time.time() - start
+    if raw_dir is not None:
+        _remove_empty_dirs(op.join(raw_dir, UNZIP_STAGING_DIRNAME))
+
+    # Report errors and throughput
+    for msg in errors:
+        print(f"ERROR: {msg}")
+    print(
+        "  * Extracted {:,} files ({:.2f} GB) in {:.1f}s ({:.1f} MB/s); {:,} already present".format(
+            totals["n_extracted"],
+            totals["n_bytes"] / 1024**3,
+            elapsed,
+            totals["n_bytes"] / 1024**2 / max(elapsed, 1e-6),
+            totals["n_skipped"],
+        )
+    )
+
+    # Record scans that were extracted to raw in the raw nifti manifest
+    if (manifest_file is not None) and op.isfile(manifest_file) and raw_scan_dirs:
+        with RawManifest(manifest_file) as manifest:
+            for target_dir in sorted(raw_scan_dirs):
+                manifest.scan(target_dir)
+        print(f"  * Added {len(raw_scan_dirs)} scan directories to {manifest_file}")
+
+
+def plan_extraction(zip_files, source_dir, raw_dir=None, n_threads=16):
+    """Return the destination of each member in each archive.
+
+    Parameters
+    ----------
+    zip_files : list of str
+        Paths to the .zip files.
+    source_dir : str
+        Members are extracted relative to this directory by default.
+    raw_dir : str or None
+        If given, members of scan directories that contain niftis and
+        no DICOMs are extracted to get_raw_dir(<member dir>, raw_dir)
+        instead, unless that directory already exists with different
+        contents (these are left for move_newdata_to_raw.py to handle).
+        Unless the directory already exists, members are extracted to
+        its staging directory in <raw_dir>/.unzip_staging, which is
+        renamed into place once every member has been extracted.
+    n_threads : int
+        Number of existing raw directories to compare at once.
+
+    Returns
+    -------
+    plan : dict
+        {zipf: [(ZipInfo, destination path), ...]}
+    raw_scan_dirs : dict
+        {scan directory in raw_dir: staging directory, or None if the
+        scan directory already exists with the same contents}
+    """
+    plan = {}
+    scan_dirs = defaultdict(list)
+    for zipf in zip_files:
+        try:
+            with zipfile.ZipFile(zipf) as zf:
+                infos = zf.infolist()
+        except zipfile.BadZipFile:
+            print(f"ERROR: {zipf} is not a valid zip file")
+            continue
+        plan[zipf] = []
+        for info in infos:
+            try:
+                dest = _member_path(info.filename, source_dir)
+            except ValueError as e:
+                print(f"ERROR: {zipf}: {e}")
+                continue
+            plan[zipf].append((info, dest))
+            if not info.is_dir():
+                scan_dirs[op.dirname(dest)].append((zipf, len(plan[zipf]) - 1))
+
+    if raw_dir is None:
+        return plan, {}
+
+    # Find scan directories that can go straight to raw
+    def raw_target(scan_dir):
+        names = [op.basename(plan[zipf][ii][1]) for zipf, ii in scan_dirs[scan_dir]]
+        rel_dir = op.relpath(scan_dir, source_dir)
+        if (
+            any(part.startswith(".") for part in rel_dir.split(os.sep))
+            or not any(name.endswith(NIFTI_EXTS) for name in names)
+            or any(name.lower().endswith(".dcm") for name in names)
+        ):
+            return None
+        target_dir = get_raw_dir(rel_dir, raw_dir)
+        if op.exists(target_dir):
+            # Only take over scans that were already extracted in full
+            for zipf, ii in scan_dirs[scan_dir]:
+                info, dest = plan[zipf][ii]
+                if not file_matches(op.join(target_dir, op.basename(dest)), info):
+                    return None
+        return target_dir
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        targets = dict(zip(scan_dirs, executor.map(raw_target, scan_dirs)))
+    raw_scan_dirs = {}
+    for scan_dir, target_dir in targets.items():
+        if target_dir is None:
+            continue
+        if op.exists(target_dir):
+            raw_scan_dirs[target_dir] = None
+            extract_dir = target_dir
+        else:
+            raw_scan_dirs[target_dir] = staging_path(target_dir, raw_dir)
+            extract_dir = raw_scan_dirs[target_dir]
+        for zipf, ii in scan_dirs[scan_dir]:
+            info, dest = plan[zipf][ii]
+            plan[zipf][ii] = (info, op.join(extract_dir, op.basename(dest)))
+    return plan, raw_scan_dirs
+
+
+def staging_path(target_dir, raw_dir):
+    """Return the staging directory of a scan directory in raw_dir."""
+    return op.join(raw_dir, UNZIP_STAGING_DIRNAME, op.relpath(target_dir, raw_dir))
+
+
+def extract_members(zipf, members):
+    """Extract archive members to their destinations.
+
+    Each member is written to a temporary file in its destination
+    directory and renamed into place once its size and CRC-32 have been
+    verified. Members whose destination already matches are skipped.
+
+    Parameters
+    ----------
+    zipf : str
+        Path to the .zip file.
+    members : list
+        [(ZipInfo, destination path), ...]
+
+    Returns
+    -------
+    result : dict
+        n_extracted, n_skipped, n_bytes (uncompressed bytes written),
+        errors (list of messages), and failed (destinations of members
+        that could not be extracted).
+    """
+    result = {
+        "n_extracted": 0,
+        "n_skipped": 0,
+        "n_bytes": 0,
+        "errors": [],
+        "failed": [],
+    }
+    # Keep archives open between batches, but never share an open file
+    # with a forked process
+    key = (os.getpid(), zipf)
+    if key not in _OPEN_ZIPS:
+        _OPEN_ZIPS[key] = zipfile.ZipFile(zipf)
+    zf = _OPEN_ZIPS[key]
+    for info, dest in members:
+        if info.is_dir():
+            os.makedirs(dest, exist_ok=True)
+            continue
+        if file_matches(dest, info):
+            result["n_skipped"] += 1
+            continue
+        os.makedirs(op.dirname(dest), exist_ok=True)
+        tmp_dest = op.join(op.dirname(dest), f".{op.basename(dest)}.part{os.getpid()}")
+        try:
+            crc = 0
+            n_bytes = 0
+            with zf.open(info) as src, open(tmp_dest, "wb") as dst:
+                while chunk := src.read(CHUNK_BYTES):
+                    crc = zlib.crc32(chunk, crc)
+                    n_bytes += len(chunk)
+                    dst.write(chunk)
+            if (crc != info.CRC) or (n_bytes != info.file_size):
+                raise zipfile.BadZipFile("CRC-32 or size does not match the archive")
+            os.replace(tmp_dest, dest)
+        except (OSError, zipfile.BadZipFile, EOFError, zlib.error) as e:
+            if op.exists(tmp_dest):
+                os.remove(tmp_dest)
+            result["errors"].append(f"{zipf}: {info.filename}: {e}")
+            result["failed"].append(dest)
+            continue
+        result["n_extracted"] += 1
+        result["n_bytes"] += n_bytes
+    return result
+
+
+def file_matches(filepath, info):
+    """Return True if filepath has the size and CRC-32 of a ZipInfo."""
+    try:
+        return (os.stat(filepath).st_size == info.file_size) and (
+            file_crc32(filepath) == info.CRC
+        )
+    except OSError:
+        return False
 
 
 def unzip_file(zipf, target_dir=None):
@@ -59,20 +375,57 @@ def unzip_file(zipf, target_dir=None):
     ----------
     zipf : str
         Path to the .zip file to be unzipped
+    target_dir : str or None
+        Directory to extract to. Defaults to the current directory
 
     Returns
     -------
     None
     """
-    with zipfile.ZipFile(zipf) as zf:
+    if target_dir is None:
+        target_dir = os.getcwd()
+    target_dir = op.abspath(target_dir)
+    plan, _ = plan_extraction([zipf], target_dir)
+    if zipf not in plan:
+        return
+    result = extract_members(zipf, plan[zipf])
+    for msg in result["errors"]:
+        print(f"ERROR: {msg}")
+    print(f"    - Unzipped {zipf} to {target_dir}")
+
+
+def _remove_empty_dirs(top_dir):
+    """Remove top_dir and the directories under it if they are empty."""
+    if not op.isdir(top_dir):
+        return
+    for dirpath, _, _ in os.walk(top_dir, topdown=False):
         try:
-            zf.extractall(target_dir)
-            msg = f"    - Unzipped {zipf}"
-            if target_dir is not None:
-                msg += f" to {target_dir}"
-            print(msg)
-        except zipfile.BadZipFile:
-            print(f"ERROR: {zipf} is not a valid zip file")
+            os.rmdir(dirpath)
+        except OSError:
+            pass
+
+
+def _member_path(name, target_dir):
+    """Return the extraction path of an archive member in target_dir."""
+    dest = op.normpath(op.join(target_dir, name))
+    if not dest.startswith(op.join(target_dir, "")):
+        raise ValueError(f"Refusing to extract {name} outside {target_dir}")
+    return dest
+
+
+def _batch_members(members):
+    """Split members into batches of similar uncompressed size."""
+    batch = []
+    batch_bytes = 0
+    for info, dest in members:
+        batch.append((info, dest))
+        batch_bytes += info.file_size
+        if (batch_bytes >= BATCH_BYTES) or (len(batch) >= BATCH_MEMBERS):
+            yield batch
+            batch = []
+            batch_bytes = 0
+    if batch:
+        yield batch
 
 
 def _parse_args():
@@ -84,10 +437,34 @@ def _parse_args():
         default=".",
         help="Directory containing the .zip files to be unzipped",
     )
+    parser.add_argument(
+        "--raw",
+        dest="raw_dir",
+        help=(
+            "Extract nifti scan directories straight to this raw directory "
+            + "instead of to source_dir"
+        ),
+    )
+    parser.add_argument(
+        "--manifest",
+        dest="manifest_file",
+        help="Raw nifti manifest to record scans extracted to --raw in",
+    )
+    parser.add_argument(
+        "-n",
+        "--n-procs",
+        type=int,
+        help="Number of processes to extract with (default: number of CPUs, up to 16)",
+    )
     return parser.parse_args()
 
 
 # If this script is run from the command line, parse arguments and run
 if __name__ == "__main__":
     args = _parse_args()
-    fast_unzip_dir(args.source_dir)
+    fast_unzip_dir(
+        args.source_dir,
+        raw_dir=args.raw_dir,
+        manifest_file=args.manifest_file,
+        n_procs=args.n_procs,
+    )
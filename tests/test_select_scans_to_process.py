@@ -0,0 +1,197 @@
+"""
+Regression tests for matching PET scans to their closest MRI.
+
+find_closest_mri_to_pet is compared against the implementation it
+replaced, which merged every PET x MRI pair per subject and kept the
+first row after an unstable sort. Where that sort made the old choice
+arbitrary (equidistant MRIs and PET scans sharing a date), the new
+function must pick one of the rows the old one could have picked, and
+must keep the scans that processed PET directories already link to.
+"""
+
+import os
+import os.path as op
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+setup_dir = op.join(op.dirname(__file__), "..", "setup")
+if setup_dir not in sys.path:
+    sys.path.append(setup_dir)
+import select_scans_to_process as ssp
+
+KEYS = ["subj", "tracer", "pet_date"]
+
+
+def baseline_find_closest_mri_to_pet(pet_scans, mri_scans):
+    """find_closest_mri_to_pet as it was before the nearest-date search."""
+    merged = pet_scans.copy().merge(mri_scans.copy(), on="subj", how="left")
+    ii = merged.columns.tolist().index("pet_date")
+    merged.insert(
+        ii + 1,
+        "days_mri_to_pet",
+        (merged["pet_date"] - merged["mri_date"]).dt.days,
+    )
+    merged.insert(ii + 2, "abs_days_mri_to_pet", merged["days_mri_to_pet"].abs())
+    merged_min = merged.sort_values("abs_days_mri_to_pet").drop_duplicates(KEYS)
+    return merged_min.sort_values(KEYS).reset_index(drop=True)
+
+
+def make_mris(rows):
+    """Return MRI scans from (subj, date, image_id) rows."""
+    mris = pd.DataFrame(rows, columns=["subj", "mri_date", "mri_image_id"])
+    mris["mri_date"] = pd.to_datetime(mris["mri_date"])
+    mris = mris.sort_values(["subj", "mri_date"]).reset_index(drop=True)
+    mris["mri_scan_number"] = mris.groupby("subj").cumcount() + 1
+    mris["n_mri_scans"] = mris.groupby("subj")["subj"].transform("size")
+    return mris
+
+
+def make_pets(rows, raw_dir="/raw"):
+    """Return PET scans from (subj, tracer, date, image_id) rows."""
+    pets = pd.DataFrame(rows, columns=["subj", "tracer", "pet_date", "pet_image_id"])
+    pets["pet_date"] = pd.to_datetime(pets["pet_date"])
+    pets["pet_raw_niif"] = [
+        op.join(raw_dir, x.subj, x.pet_image_id, f"{x.pet_image_id}.nii")
+        for x in pets.itertuples()
+    ]
+    return pets.sort_values(KEYS, kind="stable").reset_index(drop=True)
+
+
+def random_scans(n_subjs=200, seed=0):
+    """Return random PET and MRI scans, with many ties and repeat dates."""
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2018-01-01")
+    mri_rows, pet_rows = [], []
+    for i in range(n_subjs):
+        subj = f"LDS{i:07d}"
+        for _ in range(rng.integers(0, 4)):
+            day = int(rng.integers(0, 60)) * 10
+            mri_rows.append([subj, start + pd.Timedelta(days=day), f"I{len(mri_rows)}"])
+        for _ in range(rng.integers(1, 5)):
+            day = int(rng.integers(0, 120)) * 5
+            pet_rows.append(
+                [
+                    subj,
+                    rng.choice(["FBB", "FTP"]),
+                    start + pd.Timedelta(days=day),
+                    f"I{100000 + len(pet_rows)}",
+                ]
+            )
+    return make_pets(pet_rows), make_mris(mri_rows)
+
+
+def test_matches_baseline_distances():
+    pets, mris = random_scans()
+    new = ssp.find_closest_mri_to_pet(pets, mris)
+    old = baseline_find_closest_mri_to_pet(pets, mris)
+
+    pd.testing.assert_frame_equal(new[KEYS], old[KEYS])
+    pd.testing.assert_series_equal(
+        new["abs_days_mri_to_pet"], old["abs_days_mri_to_pet"], check_dtype=False
+    )
+    assert new["days_mri_to_pet"].dtype == np.float64
+    assert new["abs_days_mri_to_pet"].dtype == np.float64
+
+
+def test_matches_baseline_without_ties():
+    pets, mris = random_scans()
+    new = ssp.find_closest_mri_to_pet(pets, mris)
+    old = baseline_find_closest_mri_to_pet(pets, mris)
+
+    # PET scans where the old choice did not depend on the sort order
+    merged = pets.merge(mris, on="subj")
+    merged["abs_days"] = (merged["pet_date"] - merged["mri_date"]).dt.days.abs()
+    n_closest = (
+        merged.loc[
+            merged["abs_days"] == merged.groupby(KEYS)["abs_days"].transform("min")
+        ]
+        .groupby(KEYS)
+        .size()
+    )
+    n_pets = pets.groupby(KEYS).size()
+    unique = (n_closest.reindex(n_pets.index, fill_value=1) == 1) & (n_pets == 1)
+    unique = unique.reindex(pd.MultiIndex.from_frame(new[KEYS])).to_numpy()
+    assert unique.sum() > 0
+
+    cols = ["pet_image_id", "mri_image_id", "days_mri_to_pet"]
+    pd.testing.assert_frame_equal(
+        new.loc[unique, cols], old.loc[unique, cols], check_dtype=False
+    )
+
+
+def test_tie_keeps_linked_mri(tmp_path):
+    proc_dir = str(tmp_path / "processed")
+    mris = make_mris(
+        [["LDS3700047", "2020-01-01", "I1"], ["LDS3700047", "2020-03-01", "I2"]]
+    )
+    pets = make_pets([["LDS3700047", "FBB", "2020-01-31", "I100"]])
+    old = baseline_find_closest_mri_to_pet(pets, mris)
+    assert old.loc[0, "abs_days_mri_to_pet"] == 30
+
+    # Unprocessed PET scans get the earlier MRI
+    new = ssp.find_closest_mri_to_pet(
+        pets, mris, linked_scans=ssp.get_linked_scans(pets, proc_dir)
+    )
+    assert new.loc[0, "mri_image_id"] == "I1"
+    assert new.loc[0, "abs_days_mri_to_pet"] == old.loc[0, "abs_days_mri_to_pet"]
+
+    # PET scans processed to either equidistant MRI keep that MRI and
+    # are not flagged for reprocessing
+    pet_proc_dir = op.join(proc_dir, "LDS3700047", "FBB_2020-01-31")
+    for mri_image_id in ["I1", "I2"]:
+        mri = mris.loc[mris["mri_image_id"] == mri_image_id].iloc[0]
+        mri_proc_dir = ssp.get_mri_proc_dir(mri["subj"], mri["mri_date"], proc_dir)
+        os.makedirs(mri_proc_dir, exist_ok=True)
+        os.makedirs(pet_proc_dir, exist_ok=True)
+        link = op.join(pet_proc_dir, "mri")
+        if op.islink(link):
+            os.remove(link)
+        os.symlink(mri_proc_dir, link)
+
+        new = ssp.find_closest_mri_to_pet(
+            pets, mris, linked_scans=ssp.get_linked_scans(pets, proc_dir)
+        )
+        assert new.loc[0, "mri_image_id"] == mri_image_id
+        mri_proc_dirs = ssp.get_mri_proc_dirs(new["subj"], new["mri_date"], proc_dir)
+        pet_proc_dirs = ssp.get_pet_proc_dirs(
+            new["subj"], new["tracer"], new["pet_date"], proc_dir
+        )
+        flags = ssp.check_pets_not_processed_to_closest_mri(
+            pet_proc_dirs, mri_proc_dirs
+        )
+        assert flags.tolist() == [0]
+
+
+@pytest.mark.parametrize("linked_image_id", [None, "I100238", "I100239"])
+def test_same_date_pets_keep_linked_raw(tmp_path, linked_image_id):
+    raw_dir = str(tmp_path / "raw")
+    proc_dir = str(tmp_path / "processed")
+    mris = make_mris([["LDS3700047", "2020-01-15", "I1"]])
+    pets = make_pets(
+        [
+            ["LDS3700047", "FBB", "2020-02-06", "I100238"],
+            ["LDS3700047", "FBB", "2020-02-06", "I100239"],
+        ],
+        raw_dir=raw_dir,
+    )
+    for pet_raw_niif in pets["pet_raw_niif"]:
+        os.makedirs(op.dirname(pet_raw_niif))
+    if linked_image_id is not None:
+        pet_proc_dir = op.join(proc_dir, "LDS3700047", "FBB_2020-02-06")
+        os.makedirs(pet_proc_dir)
+        os.symlink(
+            op.join(raw_dir, "LDS3700047", linked_image_id),
+            op.join(pet_proc_dir, "raw"),
+        )
+
+    old = baseline_find_closest_mri_to_pet(pets, mris)
+    new = ssp.find_closest_mri_to_pet(
+        pets, mris, linked_scans=ssp.get_linked_scans(pets, proc_dir)
+    )
+    assert len(new) == len(old) == 1
+    assert new.loc[0, "pet_image_id"] in pets["pet_image_id"].tolist()
+    assert new.loc[0, "pet_image_id"] == (linked_image_id or "I100238")
+    assert new.loc[0, "mri_image_id"] == old.loc[0, "mri_image_id"]
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+"""
+Consolidated, columnar store of the ROI extraction CSV files saved in
+processed PET directories.
+
+The store keeps one Parquet file per (tracer, reference region) pair,
+laid out as a Hive-style dataset:
+
+    <store_dir>/tracer=<tracer>/ref_region=<ref_region>/roi-extractions.parquet
+
+Each file holds the long-format rows of every *_roi-extractions.csv for
+that pair, along with the path and modification time of the CSV they
+came from. Syncing the store only rereads CSV files that are new or
+have changed since the last sync, so reports can load all scans with a
+single Parquet read.
+
+This module also has the shared loader for the per-scan CSV files,
+which stats and reads files over a thread pool since the work is
+I/O-bound on network storage.
+"""
+
+import argparse
+import os
+import os.path as op
+import sys
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+utils_dir = op.dirname(op.abspath(__file__))
+if utils_dir not in sys.path:
+    sys.path.append(utils_dir)
+import utilities as uts
+
+# Number of threads used to stat and read per-scan CSV files
+N_IO_THREADS = 16
+
+# Columns and dtypes of the CSV files saved in processed PET
+# directories, keyed by file suffix
+SCAN_CSV_DTYPES = {
+    "roi-extractions": {
+        "image_file": str,
+        "roi_file": str,
+        "roi": str,
+        "mean": "float64",
+        "voxel_count": "int64",
+    },
+    "ref-region-means": {
+        "image_file": str,
+        "mask_file": str,
+        "mean": "float64",
+        "voxel_count": str,
+    },
+    "amyloid-cortical-summary": {
+        "image_file": str,
+        "mask_file": str,
+        "mean_suvr": "float64",
+        "centiloids": "float64",
+    },
+}
+
+# Columns of each store partition, in order
+STORE_DTYPES = {
+    "subject_id": str,
+    "pet_date": str,
+    "image_file": str,
+    "roi_file": str,
+    "roi": str,
+    "mean": "float64",
+    "voxel_count": "int64",
+    "source_file": str,
+    "source_mtime_ns": "int64",
+}
+
+
+def scan_csv_file(pet_proc_dir, suffix):
+    """Return the r<scan tag>_<suffix>.csv file in a processed PET directory."""
+    subj, tracer, pet_date = uts.parse_scan_tag(uts.get_scan_tag(pet_proc_dir))
+    return op.join(pet_proc_dir, f"r{subj}_{tracer}_{pet_date}_{suffix}.csv")
+
+
+def roi_extractions_file(pet_proc_dir, ref_region):
+    """Return the ROI extractions CSV file for a PET scan and ref. region."""
+    return scan_csv_file(pet_proc_dir, f"suvr-{ref_region}_roi-extractions")
+
+
+def stat_mtimes(files, n_threads=N_IO_THREADS):
+    """Return the modification time in ns of each file, or None if missing."""
+
+    def get_mtime(filepath):
+        try:
+            return os.stat(filepath).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(get_mtime, files))
+
+
+def load_scan_csvs(files, dtype, n_threads=N_IO_THREADS, warn_missing=True):
+    """Read per-scan CSV files concurrently into one long dataframe.
+
+    Parameters
+    ----------
+    files : list of str
+        CSV files to read.
+    dtype : dict
+        Map each column to read to its dtype (see SCAN_CSV_DTYPES).
+        Other columns are ignored.
+    n_threads : int
+        Number of files read at once.
+    warn_missing : bool
+        If true, warn about files that don't exist.
+
+    Returns
+    -------
+    df : DataFrame
+        Rows of all files that could be read, in the order of `files`,
+        with a "source_file" column added.
+    """
+
+    def read_csv(filepath):
+        try:
+            return pd.read_csv(filepath, usecols=list(dtype), dtype=dtype)
+        except FileNotFoundError:
+            if warn_missing:
+                warnings.warn(f"File not found: {filepath}")
+        except Exception as e:
+            print(e)
+
+    files = list(files)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        dfs = list(executor.map(read_csv, files))
+
+    n_rows = [0 if df is None else len(df) for df in dfs]
+    dfs = [df for df in dfs if df is not None]
+    if len(dfs) == 0:
+        df = pd.DataFrame({col: pd.Series(dtype=dt) for col, dt in dtype.items()})
+    else:
+        df = pd.concat(dfs, ignore_index=True)
+    df["source_file"] = pd.Series(files).repeat(n_rows).values
+    return df
+
+
+def add_scan_columns(df, from_col="source_file"):
+    """Insert "subject_id" and "pet_date" columns parsed from scan paths.
+
+    The processed PET directory of each `from_col` file is parsed with
+    utilities.get_scan_tag, once per unique directory.
+    """
+    scan_dirs = df[from_col].map(op.dirname)
+    tags = {
+        scan_dir: uts.parse_scan_tag(uts.get_scan_tag(scan_dir))
+        for scan_dir in scan_dirs.unique()
+    }
+    df.insert(0, "subject_id", scan_dirs.map(lambda x: tags[x][0]))
+    df.insert(1, "pet_date", scan_dirs.map(lambda x: tags[x][2]))
+    return df
+
+
+def add_image_scan_columns(df):
+    """Insert "subject_id" and "pet_date" columns parsed from image names.
+
+    Image files are named r<subject_id>_<tracer>_<pet_date>_*.nii.
+    """
+    image_names = df["image_file"].map(op.basename).str.split("_")
+    df.insert(0, "subject_id", image_names.str[0].str[1:])
+    df.insert(1, "pet_date", image_names.str[2])
+    return df
+
+
+class ExtractionStore:
+    """Consolidated Parquet store of per-scan ROI extraction files."""
+
+    def __init__(self, store_dir):
+        """Initialize the store.
+
+        Parameters
+        ----------
+        store_dir : str
+            Top-level directory of the store. It is created on the
+            first sync.
+        """
+        self.store_dir = op.abspath(store_dir)
+
+    def __repr__(self):
+        return f"ExtractionStore(store_dir={self.store_dir})"
+
+    def partition_file(self, tracer, ref_region):
+        """Return the Parquet file for a (tracer, ref. region) pair."""
+        return op.join(
+            self.store_dir,
+            f"tracer={tracer.lower()}",
+            f"ref_region={ref_region}",
+            "roi-extractions.parquet",
+        )
+
+    def load_partition(self, tracer, ref_region):
+        """Return all stored rows for a (tracer, ref. region) pair."""
+        infile = self.partition_file(tracer, ref_region)
+        if not op.isfile(infile):
+            return _empty_partition()
+        return pd.read_parquet(infile)
+
+    def sync(self, tracer, ref_region, pet_proc_dirs, verbose=False):
+        """Update the store from the CSV files in pet_proc_dirs.
+
+        CSV files whose modification time matches the stored one are
+        not reread. Rows from CSV files that no longer exist are
+        removed. Scans that are not in pet_proc_dirs are left as is.
+
+        Parameters
+        ----------
+        tracer : str
+            PET tracer (e.g. "fbb").
+        ref_region : str
+            Reference region of the SUVRs (e.g. "wcbl").
+        pet_proc_dirs : list of str
+            Processed PET directories to sync.
+        verbose : bool
+            If true, print how many files were added and removed.
+
+        Returns
+        -------
+        n_read : int
+            Number of CSV files that were read.
+        """
+        stored = self.load_partition(tracer, ref_region)
+        stored_mtimes = stored.groupby("source_file", sort=False)[
+            "source_mtime_ns"
+        ].first()
+
+        # Find CSV files that are new, changed, or missing
+        files = [roi_extractions_file(x, ref_region) for x in pet_proc_dirs]
+        to_read = {}
+        to_drop = set()
+        for filepath, mtime_ns in zip(files, stat_mtimes(files)):
+            if mtime_ns is None:
+                if filepath in stored_mtimes.index:
+                    to_drop.add(filepath)
+            elif stored_mtimes.get(filepath) != mtime_ns:
+                to_read[filepath] = mtime_ns
+                to_drop.add(filepath)
+
+        if (len(to_read) == 0) and (len(to_drop) == 0):
+            return 0
+
+        # Read the new and changed files
+        new = load_scan_csvs(list(to_read), SCAN_CSV_DTYPES["roi-extractions"])
+        new = add_image_scan_columns(new)
+        new["source_mtime_ns"] = new["source_file"].map(to_read)
+        n_read = new["source_file"].nunique()
+
+        stored = stored.loc[~stored["source_file"].isin(to_drop)]
+        merged = pd.concat([stored, new], ignore_index=True)
+        self.save_partition(merged, tracer, ref_region)
+        if verbose:
+            n_removed = len(to_drop) - len(to_read)
+            print(
+                f"  * {tracer}, {ref_region}: read {n_read} new or changed files, "
+                + f"removed {n_removed} missing files"
+            )
+        return n_read
+
+    def save_partition(self, df, tracer, ref_region):
+        """Atomically replace the Parquet file for a partition."""
+        outfile = self.partition_file(tracer, ref_region)
+        os.makedirs(op.dirname(outfile), exist_ok=True)
+        df = df[list(STORE_DTYPES)].astype(STORE_DTYPES)
+        tmpfile = f"{outfile}.{os.getpid()}.tmp"
+        try:
+            df.to_parquet(tmpfile, index=False)
+            os.replace(tmpfile, outfile)
+        finally:
+            if op.exists(tmpfile):
+                os.remove(tmpfile)
+
+    def read(self, tracer, ref_region, pet_proc_dirs=None, sync=True):
+        """Return stored ROI extractions in long format.
+
+        Parameters
+        ----------
+        tracer : str
+            PET tracer (e.g. "fbb").
+        ref_region : str
+            Reference region of the SUVRs (e.g. "wcbl").
+        pet_proc_dirs : list of str, optional
+            Only return rows for these processed PET directories, in
+            this order. Missing CSV files raise a warning. Default
+            returns all stored rows.
+        sync : bool
+            If true and pet_proc_dirs is given, sync these directories
+            before reading.
+
+        Returns
+        -------
+        df : DataFrame
+            Columns match the ROI extraction CSV files, plus
+            "subject_id" and "pet_date".
+        """
+        if sync and (pet_proc_dirs is not None):
+            self.sync(tracer, ref_region, pet_proc_dirs)
+        df = self.load_partition(tracer, ref_region)
+
+        if pet_proc_dirs is not None:
+            files = pd.Series(
+                [roi_extractions_file(x, ref_region) for x in pet_proc_dirs]
+            )
+            for filepath in files.loc[~files.isin(df["source_file"])]:
+                warnings.warn(f"File not found: {filepath}")
+            order = pd.Series(range(len(files)), index=files.values)
+            df = df.loc[df["source_file"].isin(files)]
+            df = df.iloc[
+                df["source_file"].map(order).argsort(kind="stable").values
+            ].reset_index(drop=True)
+
+        return df.drop(columns=["source_file", "source_mtime_ns"])
+
+
+def _empty_partition():
+    """Return an empty store partition."""
+    return pd.DataFrame(
+        {col: pd.Series(dtype=dtype) for col, dtype in STORE_DTYPES.items()}
+    )
+
+
+def _parse_args():
+    """Parse and return command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=(
+            "Sync the consolidated ROI extraction store with the ROI extraction\n"
+            + "CSV files in processed PET directories. Only new or modified files\n"
+            + "are read."
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "-p",
+        "--proj-dir",
+        default="/mnt/coredata/processing/leads",
+        help=(
+            "Full path to the top-level project directory, from which subdirectory\n"
+            "paths are inferred. Default: %(default)s"
+        ),
+    )
+    parser.add_argument(
+        "--store-dir",
+        help="Store directory. Default: <proj-dir>/data/extraction/roi_store",
+    )
+    return parser.parse_args()
+
+
+def main():
+    """Sync the store for every tracer and reference region."""
+    start_time = time.time()
+    args = _parse_args()
+
+    proc_dir = op.join(args.proj_dir, "data", "processed")
+    store_dir = args.store_dir
+    if store_dir is None:
+        store_dir = op.join(args.proj_dir, "data", "extraction", "roi_store")
+    store = ExtractionStore(store_dir)
+
+    ref_regions = pd.read_csv(
+        op.join(utils_dir, "..", "config", "ref_regions.csv"), encoding="utf-8-sig"
+    )
+    for tracer, grp in ref_regions.groupby("tracer", sort=False):
+        pet_proc_dirs = sorted(
+            uts.walk_files(
+                proc_dir,
+                pattern=f"{tracer}_*",
+                dirs=True,
+                min_depth=2,
+                max_depth=2,
+                skip_hidden=True,
+            )
+        )
+        for ref_region in grp["ref_region"]:
+            store.sync(tracer, ref_region, pet_proc_dirs, verbose=True)
+
+    elapsed = time.time() - start_time
+    minutes, seconds = divmod(elapsed, 60)
+    print(f"Elapsed time: {int(minutes)} min, {int(seconds)} s", end="\n" * 2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+"""
+Versioned, typed copies of the raw MRI and PET scan indexes.
+
+Each time select_scans_to_process.py saves raw_MRI-T1_index_<timestamp>.csv
+and raw_PET_index_<timestamp>.csv (which the MATLAB processing code
+reads), it also saves a Parquet copy of each index with a fixed schema:
+
+    <scans_to_process_dir>/scan_index/raw_<scan_type>_index_v<version>_<timestamp>.parquet
+
+Subject IDs and tracers are stored as categoricals, scan dates as
+datetime64, and 0/1 flags as (nullable) int8, so readers get typed
+columns without re-parsing dates or re-inferring dtypes. Versions are
+numbered from 1 and every version is kept, so any two can be compared
+with diff_versions.
+
+The CSVs remain the indexes that users edit and the MATLAB code reads,
+so load_index reads the latest CSV instead of the latest Parquet
+version whenever the CSV has been modified since that version was
+saved.
+"""
+
+import argparse
+import os
+import os.path as op
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+utils_dir = op.dirname(op.abspath(__file__))
+if utils_dir not in sys.path:
+    sys.path.append(utils_dir)
+import utilities as uts
+
+# Define globals
+SCAN_TYPES = ["MRI-T1", "PET"]
+INDEX_DIRNAME = "scan_index"
+VERSION_PATTERN = re.compile(r"^raw_(.+)_index_v(\d+)_(.+)\.parquet$")
+
+# Column dtypes of each index
+INDEX_DTYPES = {
+    "MRI-T1": {
+        "subj": "category",
+        "mri_date": "datetime64[ns]",
+        "mri_scan_number": "Int16",
+        "n_mri_scans": "Int16",
+        "mri_used_for_pet_proc": "Int8",
+        "mri_is_orphan": "Int8",
+        "days_from_baseline_mri": "Int32",
+        "days_from_last_mri": "float64",
+        "mri_image_id": "str",
+        "mri_raw_niif": "str",
+        "mri_proc_dir": "str",
+        "freesurfer_complete": "Int8",
+        "mri_seg_complete": "Int8",
+        "mri_processing_complete": "Int8",
+        "scheduled_for_processing": "Int8",
+    },
+    "PET": {
+        "subj": "category",
+        "tracer": "category",
+        "pet_date": "datetime64[ns]",
+        "days_mri_to_pet": "float64",
+        "abs_days_mri_to_pet": "float64",
+        "pet_scan_number": "Int16",
+        "n_pet_scans": "Int16",
+        "days_from_baseline_pet": "Int32",
+        "days_from_last_pet": "float64",
+        "pet_res": "Int8",
+        "pet_image_id": "str",
+        "pet_raw_niif": "str",
+        "pet_proc_dir": "str",
+        "mri_date": "datetime64[ns]",
+        "mri_scan_number": "Int16",
+        "n_mri_scans": "Int16",
+        "days_from_baseline_mri": "float64",
+        "days_from_last_mri": "float64",
+        "mri_image_id": "str",
+        "mri_raw_niif": "str",
+        "flag": "Int8",
+        "pet_not_processed_to_closest_mri": "Int8",
+        "mri_processing_complete": "Int8",
+        "pet_processing_complete": "Int8",
+        "flag_notes": "str",
+        "mri_proc_dir": "str",
+        "scheduled_for_processing": "Int8",
+    },
+}
+
+# Columns that identify a scan when comparing two versions
+KEY_COLS = {"MRI-T1": ["mri_raw_niif"], "PET": ["pet_raw_niif"]}
+
+
+def index_dir(scans_to_process_dir):
+    """Return the directory where index versions are saved."""
+    return op.join(scans_to_process_dir, INDEX_DIRNAME)
+
+
+def coerce_dtypes(df, scan_type):
+    """Return df with the columns and dtypes of the index schema.
+
+    Column order is kept, and columns not in the schema are left as
+    they are. Categories are sorted so categorical columns sort like
+    strings.
+    """
+    df = df.copy()
+    for col, dtype in INDEX_DTYPES[scan_type].items():
+        if col not in df:
+            continue
+        if dtype == "category":
+            df[col] = df[col].astype(
+                pd.CategoricalDtype(sorted(df[col].dropna().astype(str).unique()))
+            )
+        elif dtype == "str":
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+        elif dtype.startswith("datetime64"):
+            df[col] = pd.to_datetime(df[col], format="%Y-%m-%d").astype(dtype)
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def to_plain_dtypes(df):
+    """Return df with the dtypes it would have if read from the CSV index.
+
+    Categoricals become strings, dates become 'YYYY-MM-DD' strings,
+    empty strings become nulls, and nullable integers become int64, or
+    float64 if they have nulls.
+    """
+    df = df.copy()
+    for col in df:
+        dtype = df[col].dtype
+        if pd.api.types.is_string_dtype(dtype) and not isinstance(
+            dtype, pd.CategoricalDtype
+        ):
+            df[col] = df[col].where(df[col] != "", np.nan)
+        elif isinstance(dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("str").where(df[col].notna(), np.nan)
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            df[col] = df[col].dt.strftime("%Y-%m-%d")
+        elif isinstance(dtype, pd.core.arrays.integer.IntegerDtype):
+            if df[col].isna().any():
+                df[col] = df[col].astype("float64")
+            else:
+                df[col] = df[col].astype("int64")
+    return df
+
+
+def list_versions(scans_to_process_dir, scan_type):
+    """Return the saved versions of an index.
+
+    Returns
+    -------
+    versions : DataFrame
+        Columns version, timestamp, and filepath, sorted by version.
+    """
+    rows = []
+    if op.isdir(index_dir(scans_to_process_dir)):
+        for entry in os.scandir(index_dir(scans_to_process_dir)):
+            match = VERSION_PATTERN.match(entry.name)
+            if match and (match.group(1) == scan_type):
+                rows.append((int(match.group(2)), match.group(3), entry.path))
+    versions = pd.DataFrame(rows, columns=["version", "timestamp", "filepath"])
+    return versions.sort_values("version").reset_index(drop=True)
+
+
+def save_index(df, scans_to_process_dir, scan_type, timestamp):
+    """Save df as the next version of an index.
+
+    Parameters
+    ----------
+    df : DataFrame
+        The MRI or PET index, as saved to CSV by select_scans_to_process.py.
+    scans_to_process_dir : str
+        The scans_to_process directory.
+    scan_type : str
+        "MRI-T1" or "PET".
+    timestamp : str
+        Timestamp of the matching CSV file.
+
+    Returns
+    -------
+    outf : str
+        Path to the saved Parquet file.
+    """
+    versions = list_versions(scans_to_process_dir, scan_type)
+    version = (versions["version"].max() + 1) if len(versions) else 1
+    outf = op.join(
+        index_dir(scans_to_process_dir),
+        f"raw_{scan_type}_index_v{version:05d}_{timestamp}.parquet",
+    )
+    os.makedirs(op.dirname(outf), exist_ok=True)
+    df = coerce_dtypes(df, scan_type)
+    tmpfile = f"{outf}.{os.getpid()}.tmp"
+    try:
+        df.to_parquet(tmpfile, index=False)
+        os.replace(tmpfile, outf)
+    finally:
+        if op.exists(tmpfile):
+            os.remove(tmpfile)
+    return outf
+
+
+def load_index(scans_to_process_dir, scan_type, version=None, columns=None):
+    """Return a version of the MRI or PET index with typed columns.
+
+    Parameters
+    ----------
+    scans_to_process_dir : str
+        The scans_to_process directory.
+    scan_type : str
+        "MRI-T1" or "PET".
+    version : int or None
+        Version number to load. Negative numbers count back from the
+        latest version (-1 is the latest, -2 the one before it). If
+        None, the latest raw_<scan_type>_index*.csv is loaded when no
+        Parquet versions have been saved yet or when it was modified
+        after the latest version was saved (i.e. it was edited by
+        hand); otherwise the latest version is loaded.
+    columns : list of str or None
+        Only load these columns.
+
+    Returns
+    -------
+    df : DataFrame
+    """
+    versions = list_versions(scans_to_process_dir, scan_type)
+    if version is None:
+        files = uts.glob_sort_mtime(
+            op.join(scans_to_process_dir, f"raw_{scan_type}_index*.csv")
+        )
+        if (len(files) == 0) and (len(versions) == 0):
+            raise FileNotFoundError(
+                f"No raw_{scan_type}_index*.csv file found in {scans_to_process_dir}"
+            )
+        if (len(files) > 0) and (
+            (len(versions) == 0)
+            or (op.getmtime(files[0]) > op.getmtime(versions["filepath"].iloc[-1]))
+        ):
+            df = coerce_dtypes(pd.read_csv(files[0]), scan_type)
+            return df if columns is None else df[columns]
+    return pd.read_parquet(
+        _version_file(versions, scan_type, -1 if version is None else version),
+        columns=columns,
+    )
+
+
+def diff_index(old, new, scan_type):
+    """Return the scans that were added, removed, or changed between indexes.
+
+    Scans are matched on KEY_COLS[scan_type].
+
+    Returns
+    -------
+    diff : DataFrame
+        The key columns, 'change' ('added', 'removed', or 'changed'),
+        and 'changed_columns' (';'-separated names of the columns whose
+        values differ, for changed scans).
+    """
+    key = KEY_COLS[scan_type]
+    old = to_plain_dtypes(old).drop_duplicates(key).set_index(key)
+    new = to_plain_dtypes(new).drop_duplicates(key).set_index(key)
+
+    added = new.index.difference(old.index, sort=False)
+    removed = old.index.difference(new.index, sort=False)
+    common = new.index.intersection(old.index, sort=False)
+    cols = [col for col in new if col in old]
+    old_vals = old.loc[common, cols].astype(object)
+    new_vals = new.loc[common, cols].astype(object)
+    differs = old_vals.ne(new_vals) & ~(old_vals.isna() & new_vals.isna())
+    changed_columns = differs.apply(
+        lambda row: ";".join(row.index[row.to_numpy(dtype=bool)]), axis=1
+    )
+    changed = changed_columns.loc[changed_columns != ""]
+
+    diff = pd.concat(
+        [
+            pd.DataFrame({"change": "added", "changed_columns": ""}, index=added),
+            pd.DataFrame({"change": "removed", "changed_columns": ""}, index=removed),
+            pd.DataFrame({"change": "changed", "changed_columns": changed}),
+        ]
+    )
+    return diff.reset_index()
+
+
+def diff_versions(scans_to_process_dir, scan_type, old_version=-2, new_version=-1):
+    """Return diff_index between two saved versions of an index."""
+    return diff_index(
+        load_index(scans_to_process_dir, scan_type, old_version),
+        load_index(scans_to_process_dir, scan_type, new_version),
+        scan_type,
+    )
+
+
+def _version_file(versions, scan_type, version):
+    """Return the file for a version number in list_versions output."""
+    if version < 0:
+        if -version > len(versions):
+            raise ValueError(
+                f"Only {len(versions)} versions of the {scan_type} index are saved"
+            )
+        return versions["filepath"].iloc[version]
+    match = versions.loc[versions["version"] == version, "filepath"]
+    if len(match) == 0:
+        raise ValueError(f"Version {version} of the {scan_type} index does not exist")
+    return match.iloc[0]
+
+
+def _parse_args():
+    """Parse and return command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=(
+            "List saved versions of the raw MRI and PET scan indexes, or compare\n"
+            + "two versions"
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+        exit_on_error=False,
+    )
+    parser.add_argument(
+        "-p",
+        "--proj-dir",
+        default="/mnt/coredata/processing/leads",
+        help="Full path to the top-level project directory (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-s",
+        "--scan-type",
+        choices=SCAN_TYPES,
+        default="PET",
+        help="Which index to use (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--diff",
+        nargs=2,
+        type=int,
+        metavar=("OLD", "NEW"),
+        help=(
+            "Print scans that were added, removed, or changed between two\n"
+            + "versions. Negative numbers count back from the latest version\n"
+            + "(e.g. --diff -2 -1)"
+        ),
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    scans_to_process_dir = op.join(args.proj_dir, "metadata", "scans_to_process")
+    if args.diff is None:
+        versions = list_versions(scans_to_process_dir, args.scan_type)
+        print(versions[["version", "timestamp"]].to_string(index=False))
+    else:
+        diff = diff_versions(scans_to_process_dir, args.scan_type, *args.diff)
+        print(diff["change"].value_counts().to_string())
+        print(diff.to_string(index=False))
+    sys.exit(0)
@@ -6,7 +6,10 @@ within the processing pipeline.
 """
 
 import datetime
+import fnmatch
+import os
 import os.path as op
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from glob import glob
 
 
@@ -66,6 +69,101 @@ def glob_sort_mtime(pattern):
     return files
 
 
+def walk_files(
+    top_dir,
+    exts=None,
+    pattern=None,
+    dirs=False,
+    min_depth=1,
+    max_depth=None,
+    skip_hidden=False,
+    follow_symlinks=True,
+    n_threads=8,
+):
+    """Yield paths under top_dir as they are found.
+
+    Directories are listed concurrently by a bounded thread pool, and
+    matching paths are yielded as soon as their parent directory has
+    been listed, so callers can start work before the walk finishes.
+    Entry types are read from the directory listing (d_type), so
+    regular files and directories are not stat'd; only symlinks and
+    entries on filesystems that don't report d_type are.
+
+    Parameters
+    ----------
+    top_dir : str
+        The directory to walk.
+    exts : str or tuple of str
+        Only yield entries whose name ends with one of these
+        extensions (e.g. (".nii", ".nii.gz")).
+    pattern : str
+        Only yield entries whose name matches this fnmatch pattern.
+    dirs : bool
+        If True, yield matching directories instead of files.
+    min_depth : int
+        Only yield entries at least this deep (1 = entries directly in
+        top_dir).
+    max_depth : int or None
+        Don't descend below this depth. None walks the whole tree.
+    skip_hidden : bool
+        If True, skip files and directories whose name starts with '.',
+        as glob does.
+    follow_symlinks : bool
+        If True, symlinks to directories are walked and symlinks to
+        files are yielded.
+    n_threads : int
+        Maximum number of directories to list at once.
+
+    Yields
+    ------
+    path : str
+        Path to each matching file or directory, in no particular order.
+    """
+
+    def match(name):
+        if (exts is not None) and not name.endswith(exts):
+            return False
+        if (pattern is not None) and not fnmatch.fnmatchcase(name, pattern):
+            return False
+        return True
+
+    def list_dir(path, depth):
+        matches = []
+        subdirs = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if skip_hidden and entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=follow_symlinks):
+                    if dirs and (depth >= min_depth) and match(entry.name):
+                        matches.append(entry.path)
+                    if (max_depth is None) or (depth < max_depth):
+                        subdirs.append(entry.path)
+                elif (
+                    (not dirs)
+                    and (depth >= min_depth)
+                    and match(entry.name)
+                    and entry.is_file(follow_symlinks=follow_symlinks)
+                ):
+                    matches.append(entry.path)
+        return matches, subdirs, depth
+
+    if isinstance(exts, list):
+        exts = tuple(exts)
+    executor = ThreadPoolExecutor(max_workers=n_threads)
+    try:
+        pending = {executor.submit(list_dir, top_dir, 1)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                matches, subdirs, depth = future.result()
+                for subdir in subdirs:
+                    pending.add(executor.submit(list_dir, subdir, depth + 1))
+                yield from matches
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
 def get_scan_tag(scan_dir):
     """Return the scan tag from the processed scan directory."""
     scan_dir = op.abspath(scan_dir)